@@ -8,11 +8,15 @@ EverNote WebClipper publisher.
 @date 2013-06-30
 """
 
+import time
+START_TIME = time.time()
+
 import os, sys
 import settings
 from lib.errorcodes import *
-from lib.collector import Collector
-from lib.generator import HtmlGenerator
+
+# n.b. Action-specific modules (the Evernote SDK, jinja2, bs4, etc) are
+# imported lazily inside `main' so each action only pays for what it uses.
 
 
 def initialize():
@@ -26,43 +30,235 @@ def initialize():
         if not os.path.exists(path):
             os.mkdir(path)
 
+def popFlag(args, flag):
+    """Remove `flag' from args, returning True if it was present."""
+    if flag in args:
+        args.remove(flag)
+        return True
+    return False
+
+def popOption(args, option, default=None):
+    """Remove `option' and its value from args, returning the value (or `default' when absent)."""
+    if option not in args:
+        return default
+    i = args.index(option)
+    if i + 1 >= len(args):
+        sys.stderr.write('error: missing value for option: {0}\n'.format(option))
+        sys.exit(ERR_MISSING_REQUIRED_PARAM)
+    value = args[i + 1]
+    del args[i:i + 2]
+    return value
+
+def popIntOption(args, option, default=None):
+    """Like `popOption', for a value which must be a positive integer."""
+    value = popOption(args, option)
+    if value is None:
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        sys.stderr.write('error: invalid value for option {0}: {1} (expected a positive integer)\n'.format(option, value))
+        sys.exit(ERR_INVALID_PARAM)
+    return number
+
+def logStartup(action):
+    """Report how long it took to get from process start to running the action."""
+    from lib.logger import logger
+    logger.info('startup for action "%s" took %.0fms', action, (time.time() - START_TIME) * 1000)
+
 def main():
     initialize()
 
-    if len(sys.argv) < 2:
+    args = sys.argv[1:]
+    full = popFlag(args, '--full')
+    jobs = popIntOption(args, '--jobs', 1)
+    sync = popFlag(args, '--sync')
+    interval = popIntOption(args, '--interval')
+    logLevel = popOption(args, '--log-level')
+    profile = popFlag(args, '--profile')
+    allMatches = popFlag(args, '--all-matching')
+    notebooks = []
+    while '--notebook' in args:
+        notebooks.append(popOption(args, '--notebook'))
+
+    if len(args) < 1:
         sys.stderr.write('error: missing required parameter: action\n')
         sys.exit(ERR_MISSING_REQUIRED_PARAM)
 
-    action = sys.argv[1].lower()
+    action = args[0].lower()
 
     if action == 'help':
         sys.stderr.write('''
 available commands:
-    collect [notebook-name] - retrieve and organize the latest notes
+    collect [notebook(s)]   - retrieve and organize the latest notes of one or more notebooks
     generate                - alias to `rebuild'
     generate-indices        - alias to `rebuild-indices'
     rebuild                 - rebuild static site
     rebuild-indices         - rebuild static site indices *only*
-    refresh [notebook-name] - collect + rebuild
+    refresh [notebook(s)]   - collect + rebuild, rendering notes as they are collected
+    watch [notebook(s)]     - keep running, syncing and incrementally rebuilding whenever notes change
+    reindex                 - rebuild the note index from the data files
+    migrate-resources       - move resource bodies out of note pickles into the resource store
+    migrate-storage         - move notes from their JSON and pickle data files into the segment store
+    compact-storage         - reclaim space in the segment store from rewritten and removed notes
+    migrate-layout          - move an existing output tree into OUTPUT_LAYOUT in place, then rebuild
+
+options:
+    --full                  - ignore the build manifest and re-render every page
+    --jobs N                - render note pages across N worker processes
+    --sync                  - collect incrementally from the account's update sequence number
+    --all-matching          - collect every notebook matching each name fragment, not just the first
+    --notebook NAME         - (generate, refresh, migrate-layout) publish only the named notebook(s) (repeatable), as a site of
+                              their own under OUTPUT_PATH/<notebook-name>
+    --interval N            - (watch) seconds between polls, defaults to WATCH_INTERVAL
+    --log-level LEVEL       - DEBUG, INFO, WARNING or ERROR, defaults to LOG_LEVEL
+    --profile               - write cProfile stats for the action (main process only) to DATA_PATH/profile-<action>.pstats
+
+every action writes its metrics to DATA_PATH/metrics/<action>.json and .prom
 
 usage: {0} [action] [additional parameters?]
 '''.format(sys.argv[0]))
+        return
+
+    from lib.logger import logger
+    from lib.metrics import metrics
+    if logLevel:
+        logger.setLevel(logLevel.upper())
+
+    profiler = None
+    if profile:
+        import cProfile
+        profiler = cProfile.Profile()
+
+    outcome = 'error'
+    try:
+        if profiler is not None:
+            profiler.runcall(dispatch, action, args, full=full, jobs=jobs, sync=sync, interval=interval, allMatches=allMatches, notebooks=notebooks)
+        else:
+            dispatch(action, args, full=full, jobs=jobs, sync=sync, interval=interval, allMatches=allMatches, notebooks=notebooks)
+        outcome = 'ok'
+    except SystemExit:
+        # Usage errors; there is nothing worth reporting.
+        outcome = None
+        raise
+    finally:
+        if profiler is not None:
+            profilePath = getattr(settings, 'PROFILE_PATH', None) or '{0}/profile-{1}.pstats'.format(settings.DATA_PATH, action)
+            profiler.dump_stats(profilePath)
+            logger.info('profile written to %s (view with `python -m pstats %s\')', profilePath, profilePath)
+        if outcome is not None:
+            metrics.incr('runs', outcome=outcome)
+            logger.info('metrics written to %s (peak RSS %.1f MiB)', metrics.emit(action), metrics.peakRssBytes() / 1048576.0)
 
-    if action in ('collect', 'refresh'):
-        if len(sys.argv) < 3:
+def selectSite(notebookNames, allMatches=False):
+    """
+    Point OUTPUT_PATH and the build state at a site of its own for the named
+    notebooks, e.g. `generate --notebook work' publishes to OUTPUT_PATH/work.
+
+    @return list of str Guids of the notebooks to publish.
+    """
+    from lib.logger import logger
+    from lib.noteindex import getNoteIndex
+    from lib.util import matchNotebooks, slugify
+    collected = getNoteIndex().notebooks()
+    picked, unmatched = matchNotebooks(collected, notebookNames, allMatches)
+    if unmatched:
+        sys.stderr.write('error: no collected notebook matches: "{0}" (collected notebooks are: {1})\n'.format('", "'.join(unmatched), ', '.join(notebook.name for notebook in collected)))
+        sys.exit(ERR_NOTEBOOK_NOT_FOUND)
+    site = '+'.join(slugify(notebook.name) for notebook in picked)
+    settings.OUTPUT_PATH = '{0}/{1}'.format(settings.OUTPUT_PATH, site)
+    settings.BUILD_STATE_PATH = '{0}/sites/{1}'.format(settings.DATA_PATH, site)
+    for path in (settings.OUTPUT_PATH, settings.BUILD_STATE_PATH):
+        if not os.path.exists(path):
+            os.makedirs(path)
+    logger.info('publishing %s to %s', ', '.join('notebook "{0}"'.format(notebook.name) for notebook in picked), settings.OUTPUT_PATH)
+    return [notebook.guid for notebook in picked]
+
+def dispatch(action, args, full=False, jobs=1, sync=False, interval=None, allMatches=False, notebooks=None):
+    """Run a single action (anything but `help')."""
+    if action == 'collect':
+        if len(args) < 2:
+            sys.stderr.write('error: missing required parameter: notebook-name\n')
+            sys.exit(ERR_MISSING_REQUIRED_PARAM)
+
+        from lib.collector import Collector
+        logStartup(action)
+        collector = Collector(args[1:], allMatches=allMatches)
+        if sync:
+            collector.sync()
+        else:
+            collector.run()
+
+    elif action == 'refresh':
+        if len(args) < 2:
             sys.stderr.write('error: missing required parameter: notebook-name\n')
             sys.exit(ERR_MISSING_REQUIRED_PARAM)
 
-        myNotebook = sys.argv[2]
-        Collector(myNotebook).run()
+        from lib.collector import Collector
+        from lib.generator import HtmlGenerator
+        from lib.pipeline import RefreshPipeline
+        logStartup(action)
+        collector = Collector(args[1:], allMatches=allMatches)
+        if notebooks:
+            # So notebooks collected for the first time can be published as sites of their own.
+            collector.resolveNotebooks()
+        generator = HtmlGenerator(notebookGuids=selectSite(notebooks, allMatches) if notebooks else None)
+        RefreshPipeline(collector, generator, jobs=jobs).run(full=full, sync=sync)
 
-    elif action in ('rebuild', 'generate', 'refresh'):
-        generator = HtmlGenerator()
-        generator.generate()
+    elif action in ('rebuild', 'generate'):
+        from lib.generator import HtmlGenerator
+        logStartup(action)
+        generator = HtmlGenerator(notebookGuids=selectSite(notebooks, allMatches) if notebooks else None)
+        generator.generate(full=full, jobs=jobs)
 
     elif action in ('rebuild-indices', 'generate-indices', 'refresh-indices'):
-        generator = HtmlGenerator()
-        generator.generateIndices()
+        from lib.generator import HtmlGenerator
+        logStartup(action)
+        generator = HtmlGenerator(notebookGuids=selectSite(notebooks, allMatches) if notebooks else None)
+        generator.generateIndices(full=full)
+
+    elif action == 'watch':
+        if len(args) < 2:
+            sys.stderr.write('error: missing required parameter: notebook-name\n')
+            sys.exit(ERR_MISSING_REQUIRED_PARAM)
+
+        from lib.collector import Collector
+        from lib.generator import HtmlGenerator
+        from lib.watcher import Watcher
+        logStartup(action)
+        watcher = Watcher(Collector(args[1:], allMatches=allMatches), HtmlGenerator(notebookGuids=selectSite(notebooks, allMatches) if notebooks else None), interval=interval, jobs=jobs)
+        watcher.installSignalHandlers()
+        watcher.run()
+
+    elif action == 'reindex':
+        from lib.noteindex import getNoteIndex
+        logStartup(action)
+        getNoteIndex().rebuild()
+
+    elif action == 'migrate-resources':
+        from lib.resources import ResourceStore
+        logStartup(action)
+        ResourceStore().migratePickles()
+
+    elif action == 'migrate-storage':
+        from lib.segments import getSegmentStore
+        logStartup(action)
+        getSegmentStore().migrateLegacy()
+
+    elif action == 'compact-storage':
+        from lib.segments import getSegmentStore
+        logStartup(action)
+        getSegmentStore().compact()
+
+    elif action == 'migrate-layout':
+        from lib.generator import HtmlGenerator
+        logStartup(action)
+        generator = HtmlGenerator(notebookGuids=selectSite(notebooks, allMatches) if notebooks else None)
+        generator.layout.migrate(generator.writer)
+        # Node pages link relative to where they are, so they're re-rendered where they now live.
+        generator.generate(full=full, jobs=jobs)
 
     else:
         sys.stderr.write('error: unrecognized action: "{0}", view help by running `{1} help`\n'.format(action, sys.argv[0]))
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks, run from the repository root, e.g.:
+
+    python -m bench.enmedia
+"""
+
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+import types
+
+def setupSettings(prefix='evernote-publisher-bench-', root=None):
+    """
+    Point DATA_PATH and OUTPUT_PATH at a scratch directory which is removed
+    at exit (or, given `root', at an existing one, left in place).  No Evernote
+    credentials are needed, so a missing settings.py is tolerated.
+
+    @return settings module
+    """
+    try:
+        import settings
+    except ImportError:
+        settings = types.ModuleType('settings')
+        settings.consumerKey = settings.consumerSecret = settings.developerToken = ''
+        sys.modules['settings'] = settings
+    if root is None:
+        root = tempfile.mkdtemp(prefix=prefix)
+        atexit.register(shutil.rmtree, root, True)
+    settings.DATA_PATH = '{0}/data'.format(root)
+    settings.OUTPUT_PATH = '{0}/output'.format(root)
+    for path in (settings.DATA_PATH, settings.OUTPUT_PATH):
+        os.makedirs(path, exist_ok=True)
+    return settings
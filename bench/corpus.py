@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""Synthetic Evernote notes for benchmarking."""
+
+import hashlib
+import random
+
+import evernote.edam.type.ttypes as Types
+
+# Declarations the CSS scrubber (lib/cssScrubRules.txt) strips, as they
+# turn up in the `style' attributes of clipped pages.
+CSS_JUNK = (
+    'position:absolute;top:-10000px;height:1px;width:1px',
+    'overflow:hidden',
+    'opacity:0',
+    'box-sizing:border-box;float:right',
+    'display:none !important',
+    'left:0px;top:0px;width:100%;height:0px',
+    'position:fixed;margin:0px;border:0px;padding:0px',
+    'float:left;height:16px;width:14px;',
+    'z-index:800;color:rgb(255, 255, 255)',
+    'overflow-x:auto',
+    'overflow-y:scroll',
+)
+# Declarations which survive scrubbing.
+CSS_KEEP = (
+    'color:rgb(51, 51, 51)',
+    'font-size:14px',
+    'margin:0px 0px 1em',
+    'line-height:1.5',
+)
+
+WORDS = (
+    'lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'eiusmod',
+    'tempor', 'incididunt', 'labore', 'dolore', 'magna', 'aliqua', 'enim', 'minim', 'veniam', 'quis',
+    'nostrud', 'exercitation', 'ullamco', 'laboris', 'nisi', 'aliquip', 'commodo', 'consequat',
+)
+
+def makeResource(rng, guid, size, mime='image/png'):
+    body = rng.randbytes(size)
+    return Types.Resource(
+        guid=guid,
+        mime=mime,
+        data=Types.Data(bodyHash=hashlib.md5(body).digest(), size=len(body), body=body),
+    )
+
+def makeStyle(rng, cssJunk):
+    """@return str A style attribute value, carrying scrubber junk with probability `cssJunk'."""
+    declarations = [rng.choice(CSS_KEEP)]
+    if rng.random() < cssJunk:
+        declarations.append(rng.choice(CSS_JUNK))
+    rng.shuffle(declarations)
+    return ';'.join(declarations)
+
+def makeContent(rng, resources, contentSize, shuffleMedia=False, cssJunk=0.0):
+    """
+    ENML with about `contentSize' bytes of paragraphs and one <en-media> per
+    resource.  With `cssJunk' > 0, paragraphs get style attributes, that
+    fraction of them containing declarations the scrubber removes.
+    """
+    media = ['<en-media type="%s" hash="%s"/>' % (r.mime, hashlib.md5(r.data.body).hexdigest()) for r in resources]
+    if shuffleMedia:
+        rng.shuffle(media)
+    numParagraphs = max(len(media), 1)
+    paragraph = 'lorem ipsum dolor sit amet ' * max(contentSize // numParagraphs // 27, 1)
+    parts = []
+    for i in range(numParagraphs):
+        style = ' style="%s"' % (makeStyle(rng, cssJunk),) if cssJunk > 0 else ''
+        parts.append('<div%s><p>%s</p>%s</div>' % (style, paragraph, media[i] if i < len(media) else ''))
+    return '<?xml version="1.0" encoding="UTF-8"?><en-note>%s</en-note>' % (''.join(parts),)
+
+def makeNote(rng, i, numResources=0, resourceSize=1024, contentSize=4096, shuffleMedia=False, cssJunk=0.0, tagGuids=None, notebookGuid=None, updateSequenceNum=None):
+    guid = 'note-%08d' % (i,)
+    resources = [makeResource(rng, '%s-r%d' % (guid, j), resourceSize) for j in range(numResources)]
+    content = makeContent(rng, resources, contentSize, shuffleMedia, cssJunk)
+    created = 1370000000000 + i * 60000
+    return Types.Note(
+        guid=guid,
+        title='Synthetic note %d: %s' % (i, ' '.join(rng.choice(WORDS) for _ in range(4))),
+        content=content,
+        contentHash=hashlib.md5(content.encode('utf-8')).digest(),
+        contentLength=len(content),
+        created=created,
+        updated=created + 1000,
+        active=True,
+        notebookGuid=notebookGuid,
+        tagGuids=tagGuids,
+        updateSequenceNum=updateSequenceNum,
+        resources=resources or None,
+        attributes=Types.NoteAttributes(sourceURL='https://example%d.com/%d' % (i % 20, i)),
+    )
+
+def makeTags(numTags):
+    return [Types.Tag(guid='tag-%06d' % (i,), name='Tag %d' % (i,), updateSequenceNum=i + 1) for i in range(numTags)]
+
+def makeCorpus(rng, numNotes, contentSize=4096, numResources=1, resourceSize=1024, numTags=50, tagsPerNote=3, cssJunk=0.1):
+    """
+    @return (Notebook, list of Tag, list of Note).  Tags are drawn with a
+        skewed distribution, so a few are on most notes, like real tag usage.
+        Tags and then notes get increasing update sequence numbers, as if
+        created in that order, so the corpus can be synced.
+    """
+    notebook = Types.Notebook(guid='notebook-bench', name='Benchmark')
+    tags = makeTags(numTags)
+    weights = [1.0 / rank for rank in range(1, numTags + 1)]
+    notes = []
+    for i in range(numNotes):
+        tagGuids = None
+        if tags and tagsPerNote:
+            tagGuids = sorted(set(tag.guid for tag in rng.choices(tags, weights=weights, k=tagsPerNote)))
+        notes.append(makeNote(rng, i, numResources=numResources, resourceSize=resourceSize, contentSize=contentSize, cssJunk=cssJunk, tagGuids=tagGuids, notebookGuid=notebook.guid, updateSequenceNum=numTags + i + 1))
+    return notebook, tags, notes
+
+def splitNotebooks(notebook, notes, numNotebooks):
+    """
+    Spread notes round-robin over `numNotebooks' notebooks, the first of which is `notebook'.
+
+    @return list of Notebook.
+    """
+    notebooks = [notebook] + [Types.Notebook(guid='%s-%d' % (notebook.guid, i), name='%s %d' % (notebook.name, i)) for i in range(2, numNotebooks + 1)]
+    for i, note in enumerate(notes):
+        note.notebookGuid = notebooks[i % len(notebooks)].guid
+    return notebooks
+
+def rng(seed=1):
+    return random.Random(seed)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark <en-media> substitution on synthetic notes with many resources,
+against the previous one-`re.subn'-per-resource implementation.
+
+    python -m bench.enmedia [--repeat N]
+"""
+
+import base64
+import re
+import simplejson
+import sys
+import time
+
+from . import setupSettings
+
+settings = setupSettings()
+
+from lib.generator import HtmlGenerator, Note
+from lib.resources import hexHash
+from . import corpus
+
+def legacyContentWithTranslatedAssets(generator, note):
+    """The previous O(resources x content) implementation, kept for comparison."""
+    content = note.content
+    resourcesAndFilenames = list(note.resourceFilenameTuples())
+    i = 1
+    numAssets = len(resourcesAndFilenames)
+    for resource, filename in resourcesAndFilenames:
+        relPath = generator.assetHref(note, filename)
+        if filename.lower().endswith('.pdf'):
+            replacementMarkup = '<a href="%s">View PDF: %s </a> (Asset %s/%s)' % (relPath, filename, i, numAssets)
+        else:
+            replacementMarkup = '<a href="%s"><img src="%s" alt="Image (Asset %s/%s) alt="Image (Asset %s/%s)" /></a>' % (relPath, relPath, i, numAssets, i, numAssets)
+        content = re.subn(r'<en-media(?:[^\/]|\/[^>])+/>', replacementMarkup, content, 1)[0]
+        i += 1
+    return content
+
+def toNote(evernoteNote):
+    data = {
+        'guid': evernoteNote.guid,
+        'title': evernoteNote.title,
+        'created': evernoteNote.created,
+        'updated': evernoteNote.updated,
+        'deleted': None,
+        'b64Content': base64.b64encode(evernoteNote.content.encode('utf-8')).decode('ascii'),
+        'tags': [],
+    }
+    note = Note(data, '{0}/{1}.json'.format(settings.DATA_PATH, evernoteNote.created))
+    note._obj = evernoteNote
+    # Decode and scrub up front so only the substitution itself is timed.
+    note.content
+    return note
+
+def timeIt(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def matchesHashes(note, translated):
+    """@return True when every <img> points at the asset whose body hash its <en-media> named."""
+    filenames = dict((hexHash(resource.data.bodyHash), filename) for resource, filename in note.resourceFilenameTuples())
+    expected = [filenames[h] for h in re.findall(r'<en-media[^>]*hash="([0-9a-f]+)"', note.content)]
+    return expected == re.findall(r'<img src="[^"]*/([^"/]+)"', translated)
+
+def main():
+    repeat = int(sys.argv[sys.argv.index('--repeat') + 1]) if '--repeat' in sys.argv else 5
+    generator = HtmlGenerator()
+    rng = corpus.rng()
+    results = []
+    for numResources in (1, 10, 100, 500):
+        for shuffled in (False, True):
+            note = toNote(corpus.makeNote(rng, numResources, numResources=numResources, resourceSize=64, contentSize=numResources * 2048, shuffleMedia=shuffled))
+            results.append({
+                'resources': numResources,
+                'contentBytes': len(note.content),
+                'shuffledMedia': shuffled,
+                'legacySeconds': timeIt(lambda: legacyContentWithTranslatedAssets(generator, note), repeat),
+                'singlePassSeconds': timeIt(lambda: generator.contentWithTranslatedAssets(note), repeat),
+                'legacyMatchesHashes': matchesHashes(note, legacyContentWithTranslatedAssets(generator, note)),
+                'singlePassMatchesHashes': matchesHashes(note, generator.contentWithTranslatedAssets(note)),
+            })
+    print(simplejson.dumps(results, indent=2))
+
+if __name__ == '__main__':
+    main()
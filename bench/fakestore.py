@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+"""In-process stand-in for the Evernote NoteStore, for benchmarking the collector offline."""
+
+import collections
+import copy
+import threading
+import time
+
+import evernote.edam.error.ttypes as Errors
+import evernote.edam.notestore.ttypes as NoteStoreTypes
+import evernote.edam.type.ttypes as Types
+
+class FakeNoteStore(object):
+    """
+    Serves fixed notebooks, tags and notes.  Every call sleeps `latency'
+    seconds, and with `rateLimitEvery' set, every N'th call fails with
+    RATE_LIMIT_REACHED asking the client to wait `rateLimitDuration' seconds.
+    Call counts are kept in `calls'.  Safe to share between threads.
+    Notes are changed between syncs with `update' and `expunge'.
+    """
+
+    def __init__(self, notebook, tags, notes, latency=0.0, rateLimitEvery=None, rateLimitDuration=1):
+        """@param notebook Notebook, or list of them."""
+        self.notebooks = notebook if isinstance(notebook, list) else [notebook]
+        self.notebook = self.notebooks[0]
+        self.tags = dict((tag.guid, tag) for tag in tags)
+        self.notes = dict((note.guid, note) for note in notes)
+        self.resources = dict((resource.guid, resource) for note in notes for resource in note.resources or [])
+        # guid -> USN of notes removed from the account.
+        self.expunged = {}
+        self.latency = latency
+        self.rateLimitEvery = rateLimitEvery
+        self.rateLimitDuration = rateLimitDuration
+        self.calls = collections.Counter()
+        self.rateLimited = 0
+        self.lock = threading.Lock()
+        self.numCalls = 0
+
+    def call(self, name):
+        with self.lock:
+            self.calls[name] += 1
+            self.numCalls += 1
+            limited = self.rateLimitEvery and self.numCalls % self.rateLimitEvery == 0
+            if limited:
+                self.rateLimited += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if limited:
+            raise Errors.EDAMSystemException(errorCode=Errors.EDAMErrorCode.RATE_LIMIT_REACHED, rateLimitDuration=self.rateLimitDuration)
+
+    @staticmethod
+    def withoutBodies(note, withContent=False):
+        """@return shallow copy of note without resource bodies (and, unless asked for, content)."""
+        note = copy.copy(note)
+        if not withContent:
+            note.content = None
+        if note.resources:
+            resources = []
+            for resource in note.resources:
+                resource = copy.copy(resource)
+                resource.data = copy.copy(resource.data)
+                resource.data.body = None
+                resources.append(resource)
+            note.resources = resources
+        return note
+
+    def listNotebooks(self, *args):
+        self.call('listNotebooks')
+        return list(self.notebooks)
+
+    def listTags(self, *args):
+        self.call('listTags')
+        return list(self.tags.values())
+
+    def getTag(self, authenticationToken, guid):
+        self.call('getTag')
+        return self.tags[guid]
+
+    @property
+    def updateCount(self):
+        return max([tag.updateSequenceNum or 0 for tag in self.tags.values()] + [note.updateSequenceNum or 0 for note in self.notes.values()] + list(self.expunged.values()) + [0])
+
+    def update(self, guid, **fields):
+        """Change a note's fields (e.g. notebookGuid, or active=False to trash it), as a new update."""
+        with self.lock:
+            note = self.notes[guid]
+            for name, value in fields.items():
+                setattr(note, name, value)
+            note.updateSequenceNum = self.updateCount + 1
+
+    def expunge(self, guid):
+        with self.lock:
+            self.notes.pop(guid)
+            self.expunged[guid] = self.updateCount + 1
+
+    def getSyncState(self, authenticationToken):
+        self.call('getSyncState')
+        return NoteStoreTypes.SyncState(currentTime=int(time.time() * 1000), fullSyncBefore=0, updateCount=self.updateCount)
+
+    def getFilteredSyncChunk(self, authenticationToken, afterUSN, maxEntries, chunkFilter):
+        """Tags and notes changed or expunged after `afterUSN'."""
+        self.call('getFilteredSyncChunk')
+        entries = []
+        if chunkFilter.includeTags:
+            entries.extend(('tag', tag) for tag in self.tags.values() if (tag.updateSequenceNum or 0) > afterUSN)
+        if chunkFilter.includeNotes:
+            entries.extend(('note', note) for note in self.notes.values() if (note.updateSequenceNum or 0) > afterUSN)
+        if chunkFilter.includeExpunged:
+            entries.extend(('expunged', Types.Note(guid=guid, updateSequenceNum=usn)) for guid, usn in self.expunged.items() if usn > afterUSN)
+        entries.sort(key=lambda entry: entry[1].updateSequenceNum)
+        entries = entries[0:maxEntries]
+        return NoteStoreTypes.SyncChunk(
+            currentTime=int(time.time() * 1000),
+            chunkHighUSN=entries[-1][1].updateSequenceNum if entries else None,
+            updateCount=self.updateCount,
+            tags=[entry for kind, entry in entries if kind == 'tag'] or None,
+            notes=[self.withoutBodies(entry) for kind, entry in entries if kind == 'note'] or None,
+            expungedNotes=[entry.guid for kind, entry in entries if kind == 'expunged'] or None,
+        )
+
+    def findNotes(self, authenticationToken, noteFilter, offset, maxNotes):
+        self.call('findNotes')
+        notes = [note for note in self.notes.values() if noteFilter.notebookGuid in (None, note.notebookGuid)]
+        # order=1 is by created, anything else by updated.
+        key = (lambda note: note.created) if noteFilter.order == 1 else (lambda note: note.updated)
+        notes.sort(key=key, reverse=not noteFilter.ascending)
+        page = [self.withoutBodies(note) for note in notes[offset:offset + maxNotes]]
+        for note in page:
+            note.resources = None
+        return NoteStoreTypes.NoteList(startIndex=offset, totalNotes=len(notes), notes=page)
+
+    def findNoteCounts(self, authenticationToken, noteFilter, withTrash):
+        self.call('findNoteCounts')
+        counts = collections.Counter(note.notebookGuid for note in self.notes.values())
+        return NoteStoreTypes.NoteCollectionCounts(notebookCounts=dict(counts))
+
+    def getNote(self, authenticationToken, guid, withContent, withResourcesData, withResourcesRecognition, withResourcesAlternateData):
+        self.call('getNote')
+        note = self.notes[guid]
+        if withResourcesData:
+            return note if withContent else self.withoutBodies(note)
+        return self.withoutBodies(note, withContent=withContent)
+
+    def getResourceData(self, authenticationToken, guid):
+        self.call('getResourceData')
+        return self.resources[guid].data.body
+
+class FakeClient(object):
+    """Stands in for evernote.api.client.EvernoteClient, see `Collector(client=...)'."""
+
+    def __init__(self, noteStore):
+        self.noteStore = noteStore
+
+    def get_note_store(self):
+        return self.noteStore
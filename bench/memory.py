@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+"""
+Check that `generate' runs in bounded memory: collect synthetic corpora of
+increasing size from the fake NoteStore, run a full generate over each in a
+fresh interpreter and compare their peak RSS.
+
+Notes are loaded, rendered and released one at a time, so all that should
+grow with the archive is the per-note bookkeeping (titles, tags, sort keys
+and output digests), not note content or resources.  Exits non-zero when
+peak RSS grows by more than --max-kib-per-note KiB per additional note, or
+exceeds --max-rss MiB.
+
+    python -m bench.memory [--sizes 200,800,3200] [--resource-size BYTES] [--jobs N] [--max-kib-per-note KIB] [--max-rss MIB]
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import traceback
+
+from . import setupSettings
+from . import corpus
+from .fakestore import FakeClient, FakeNoteStore
+
+CONTENT_SIZE = 16384
+NUM_RESOURCES = 2
+
+# Runs in the child interpreter: generate into `root' and print peak RSS in KiB.
+CHILD = '''
+import resource, sys
+from bench import setupSettings
+setupSettings(root=sys.argv[1])
+from lib.generator import HtmlGenerator
+HtmlGenerator().generate(full=True, jobs=int(sys.argv[2]))
+print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+def option(argv, flag, kind, default):
+    return kind(argv[argv.index(flag) + 1]) if flag in argv else default
+
+def collect(root, numNotes, resourceSize):
+    """Populate root/data with a corpus of numNotes notes, in a child process so the corpus isn't shared with the parent."""
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            setupSettings(root=root)
+            import lib.collector
+            from lib.logger import logger
+            logger.setLevel('CRITICAL')
+            notebook, tags, notes = corpus.makeCorpus(corpus.rng(numNotes), numNotes, contentSize=CONTENT_SIZE, numResources=NUM_RESOURCES, resourceSize=resourceSize, numTags=200, cssJunk=0.2)
+            collector = lib.collector.Collector(notebook.name, client=FakeClient(FakeNoteStore(notebook, tags, notes)))
+            collector.run()
+            collector.saveTagCache()
+            status = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            sys.stderr.flush()
+            os._exit(status)
+    _, status = os.waitpid(pid, 0)
+    if status != 0:
+        raise Exception('collecting {0} notes failed'.format(numNotes))
+
+def peakRssKiB(root, jobs):
+    out = subprocess.check_output([sys.executable, '-c', CHILD, root, str(jobs)], stderr=subprocess.DEVNULL)
+    return int(out.decode('ascii').strip().splitlines()[-1])
+
+def main():
+    argv = sys.argv[1:]
+    sizes = [int(size) for size in option(argv, '--sizes', str, '200,800,3200').split(',')]
+    resourceSize = option(argv, '--resource-size', int, 32768)
+    jobs = option(argv, '--jobs', int, 1)
+    maxKiBPerNote = option(argv, '--max-kib-per-note', float, 16.0)
+    maxRss = option(argv, '--max-rss', float, None)
+
+    results = []
+    for size in sizes:
+        root = tempfile.mkdtemp(prefix='evernote-publisher-memory-')
+        try:
+            collect(root, size, resourceSize)
+            peak = peakRssKiB(root, jobs) / 1024.0
+        finally:
+            shutil.rmtree(root, True)
+        results.append((size, peak))
+        print('%6d notes (%.1f MiB of content and resources): peak RSS %.1f MiB' % (size, size * (CONTENT_SIZE + NUM_RESOURCES * resourceSize) / 1048576.0, peak))
+
+    failures = []
+    (firstSize, firstPeak), (lastSize, lastPeak) = results[0], results[-1]
+    kibPerNote = 1024 * (lastPeak - firstPeak) / (lastSize - firstSize) if lastSize > firstSize else 0.0
+    print('peak RSS grows %.1f KiB per note (%.1f KiB of content and resources each)' % (kibPerNote, (CONTENT_SIZE + NUM_RESOURCES * resourceSize) / 1024.0))
+    if kibPerNote > maxKiBPerNote:
+        failures.append('peak RSS grew %.1f KiB per note (allowed %.1f)' % (kibPerNote, maxKiBPerNote))
+    if maxRss is not None and max(peak for _, peak in results) > maxRss:
+        failures.append('peak RSS exceeded %.1f MiB' % (maxRss,))
+    for failure in failures:
+        print('FAIL: ' + failure)
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
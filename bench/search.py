@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark the sharded search index on a synthetic corpus: full build time,
+index size, incremental update cost and query latency (loading shards from
+disk the way the search page fetches them).
+
+    python -m bench.search [--notes N] [--queries N]
+"""
+
+import itertools
+import os
+import simplejson
+import sys
+import time
+
+from . import setupSettings
+
+settings = setupSettings()
+
+from lib.search import SearchIndex, query
+from lib.writer import OutputWriter
+from . import corpus
+
+class SyntheticNote(object):
+    __slots__ = ('id', 'created', 'updated', 'contentHash', 'title', 'tags', 'sourceDomain', 'body')
+
+    def __init__(self, rng, vocabulary, i):
+        self.created = 1370000000000 + i * 60000
+        self.id = '%s' % (self.created,)
+        self.updated = self.created
+        self.title = ' '.join(vocabulary.words(rng, rng.randint(3, 10)))
+        self.tags = [{'name': name} for name in vocabulary.words(rng, rng.randint(0, 4))]
+        self.sourceDomain = 'example%d.com' % (rng.randint(0, 50),)
+        self.body = '<div><p>%s</p></div>' % (' '.join(vocabulary.words(rng, rng.randint(200, 3000))),)
+        self.contentHash = '%x' % (hash(self.body) & 0xffffffff,)
+
+class Vocabulary(object):
+    """Random words drawn with Zipfian frequencies, roughly like natural language."""
+
+    def __init__(self, rng, size=20000):
+        letters = 'abcdefghijklmnopqrstuvwxyz'
+        self.vocabulary = [''.join(rng.choice(letters) for _ in range(rng.randint(3, 10))) for _ in range(size)]
+        self.cumulative = list(itertools.accumulate(1.0 / rank for rank in range(1, size + 1)))
+
+    def words(self, rng, n):
+        return rng.choices(self.vocabulary, cum_weights=self.cumulative, k=n)
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def build(notes, full=False):
+    writer = OutputWriter()
+    writer.load()
+    searchIndex = SearchIndex(writer)
+    start = time.time()
+    searchIndex.build(notes, lambda note: note.body, full=full)
+    elapsed = time.time() - start
+    changes = writer.finish()
+    return elapsed, len(changes['created']) + len(changes['changed'])
+
+def main():
+    numNotes = int(sys.argv[sys.argv.index('--notes') + 1]) if '--notes' in sys.argv else 2000
+    numQueries = int(sys.argv[sys.argv.index('--queries') + 1]) if '--queries' in sys.argv else 200
+    rng = corpus.rng()
+    vocabulary = Vocabulary(rng)
+    notes = [SyntheticNote(rng, vocabulary, i) for i in range(numNotes)]
+
+    fullSeconds, fullWrites = build(notes, full=True)
+
+    shardDir = '{0}/search/terms'.format(settings.OUTPUT_PATH)
+    shardSizes = [os.path.getsize('{0}/{1}'.format(shardDir, name)) for name in os.listdir(shardDir)]
+    docDir = '{0}/search/docs'.format(settings.OUTPUT_PATH)
+    docSizes = [os.path.getsize('{0}/{1}'.format(docDir, name)) for name in os.listdir(docDir)]
+
+    notes[-1] = SyntheticNote(rng, vocabulary, numNotes - 1)
+    incrementalSeconds, incrementalWrites = build(notes)
+    noopSeconds, noopWrites = build(notes)
+
+    def loadShard(prefix):
+        try:
+            with open('{0}/{1}.json'.format(shardDir, prefix), 'r') as fh:
+                return simplejson.load(fh)
+        except (IOError, OSError):
+            return None
+
+    latencies = []
+    for _ in range(numQueries):
+        text = ' '.join(vocabulary.words(rng, rng.randint(1, 3)))
+        start = time.time()
+        query(text, loadShard)
+        latencies.append(time.time() - start)
+
+    print(simplejson.dumps({
+        'notes': numNotes,
+        'fullBuildSeconds': round(fullSeconds, 3),
+        'fullBuildFilesWritten': fullWrites,
+        'shards': len(shardSizes),
+        'shardBytesTotal': sum(shardSizes),
+        'shardBytesMedian': percentile(shardSizes, 0.5),
+        'shardBytesMax': max(shardSizes),
+        'docShardBytesTotal': sum(docSizes),
+        'docShardBytesMax': max(docSizes),
+        'oneNoteChangedSeconds': round(incrementalSeconds, 3),
+        'oneNoteChangedFilesWritten': incrementalWrites,
+        'noChangeSeconds': round(noopSeconds, 3),
+        'noChangeFilesWritten': noopWrites,
+        'queryMillisMedian': round(1000 * percentile(latencies, 0.5), 2),
+        'queryMillisP95': round(1000 * percentile(latencies, 0.95), 2),
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+"""
+Check that server.py delivers large files whole to slow clients: serve a
+file of --size MiB and read it through a small receive buffer, pausing
+between reads so the server's socket keeps filling up, both whole and as a
+byte range.  Also reports the throughput of an unthrottled download.  Exits
+non-zero when any download comes up short or doesn't match.
+
+    python -m bench.server [--size MIB]
+"""
+
+import functools
+import http.server
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import server
+
+FILENAME = 'large.pdf'
+
+def option(argv, flag, kind, default):
+    return kind(argv[argv.index(flag) + 1]) if flag in argv else default
+
+class QuietHandler(server.StaticHandler):
+    def log_message(self, *args):
+        pass
+
+def startServer(directory):
+    handlerClass = functools.partial(QuietHandler, directory=directory)
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handlerClass)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+def download(port, path, rangeHeader=None, rcvbuf=None, pause=0.0):
+    """@return tuple of (status line, body bytes)."""
+    sock = socket.socket()
+    if rcvbuf:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sock.connect(('127.0.0.1', port))
+    request = 'GET /{0} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n'.format(path)
+    if rangeHeader:
+        request += 'Range: {0}\r\n'.format(rangeHeader)
+    sock.sendall((request + '\r\n').encode('ascii'))
+    chunks = []
+    while True:
+        chunk = sock.recv(rcvbuf or 1 << 16)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        if pause:
+            time.sleep(pause)
+    sock.close()
+    head, _, body = b''.join(chunks).partition(b'\r\n\r\n')
+    return head.split(b'\r\n', 1)[0].decode('ascii'), body
+
+def main():
+    argv = sys.argv[1:]
+    size = option(argv, '--size', int, 50) * 1048576
+    directory = tempfile.mkdtemp(prefix='evernote-publisher-server-')
+    failures = []
+    try:
+        data = os.urandom(size)
+        with open('{0}/{1}'.format(directory, FILENAME), 'wb') as fh:
+            fh.write(data)
+        httpd = startServer(directory)
+        port = httpd.server_address[1]
+
+        start = time.time()
+        status, body = download(port, FILENAME)
+        elapsed = time.time() - start
+        print('fast client: %s, %d of %d bytes in %.2fs (%.0f MiB/s)' % (status, len(body), size, elapsed, size / 1048576.0 / elapsed))
+        if body != data:
+            failures.append('fast client got %d of %d bytes' % (len(body), size))
+
+        start = time.time()
+        status, body = download(port, FILENAME, rcvbuf=4096, pause=0.0005)
+        print('slow client: %s, %d of %d bytes in %.2fs' % (status, len(body), size, time.time() - start))
+        if body != data:
+            failures.append('slow client got %d of %d bytes' % (len(body), size))
+
+        offset = size // 3
+        status, body = download(port, FILENAME, rangeHeader='bytes={0}-'.format(offset), rcvbuf=4096, pause=0.0005)
+        print('slow client, range from %d: %s, %d of %d bytes' % (offset, status, len(body), size - offset))
+        if body != data[offset:]:
+            failures.append('slow range client got %d of %d bytes' % (len(body), size - offset))
+        httpd.shutdown()
+    finally:
+        shutil.rmtree(directory, True)
+
+    for failure in failures:
+        print('FAIL: ' + failure)
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
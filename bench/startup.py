@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+"""
+Measure cold-start wall time of each CLI action in a fresh interpreter,
+against an empty scratch DATA_PATH/OUTPUT_PATH.  `generate' is run twice so
+the second run shows the effect of the persistent template bytecode cache.
+
+    python -m bench.startup [--repeat N]
+"""
+
+import os
+import shutil
+import simplejson
+import subprocess
+import sys
+import tempfile
+import time
+
+# `collect' needs network access, so only its import cost is measured.
+ACTIONS = (
+    ('help', ['help']),
+    ('reindex', ['reindex']),
+    ('generate-indices', ['generate-indices']),
+    ('generate (cold template cache)', ['generate']),
+    ('generate (warm template cache)', ['generate']),
+)
+
+RUNNER = '''
+import runpy, sys
+sys.path.insert(0, {scratch!r})
+sys.argv = ['app.py'] + {args!r}
+runpy.run_path('app.py', run_name='__main__')
+'''
+
+SETTINGS = '''
+consumerKey = consumerSecret = developerToken = ''
+DATA_PATH = {data!r}
+OUTPUT_PATH = {output!r}
+'''
+
+def runOnce(scratch, code):
+    start = time.time()
+    subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.time() - start
+
+def main():
+    repeat = int(sys.argv[sys.argv.index('--repeat') + 1]) if '--repeat' in sys.argv else 3
+    results = []
+    for _ in range(repeat):
+        scratch = tempfile.mkdtemp(prefix='evernote-publisher-bench-')
+        try:
+            data, output = '{0}/data'.format(scratch), '{0}/output'.format(scratch)
+            for path in (data, output):
+                os.makedirs(path)
+            with open('{0}/settings.py'.format(scratch), 'w') as fh:
+                fh.write(SETTINGS.format(data=data, output=output))
+            for label, args in ACTIONS:
+                results.append((label, runOnce(scratch, RUNNER.format(scratch=scratch, args=args))))
+            importCollector = 'import sys; sys.path.insert(0, {0!r}); import lib.collector'.format(scratch)
+            results.append(('import lib.collector', runOnce(scratch, importCollector)))
+        finally:
+            shutil.rmtree(scratch, True)
+
+    best = {}
+    for label, elapsed in results:
+        best[label] = min(best.get(label, elapsed), elapsed)
+    print(simplejson.dumps([{'action': label, 'bestSeconds': round(best[label], 4)} for label, _ in ACTIONS] + [{'action': 'import lib.collector', 'bestSeconds': round(best['import lib.collector'], 4)}], indent=2))
+
+if __name__ == '__main__':
+    main()
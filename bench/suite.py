@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+"""
+End-to-end benchmark: collect a synthetic corpus from an in-process fake
+NoteStore, then generate the site from it, timing each stage and the
+individual content transforms.  Last, incremental syncs are timed: a full
+one, a no-op, one after some notes changed, one after some were moved out
+and one of the notebook they were moved to.  Results are written as JSON so
+runs from different commits can be compared.
+
+    python -m bench.suite [options] [--output results.json] [--compare baseline.json]
+
+options (defaults in parentheses):
+    --notes N               notes in the corpus (500)
+    --content-size BYTES    approximate content size per note (8192)
+    --resources N           resources per note (2)
+    --resource-size BYTES   size of each resource (4096)
+    --tags N                distinct tags on the account (100)
+    --tags-per-note N       tags drawn per note (3)
+    --notebooks N           notebooks the notes are spread over, all collected in one run (1)
+    --css-junk FRACTION     fraction of styled paragraphs carrying scrubber junk (0.2)
+    --latency SECONDS       simulated latency of every API call (0)
+    --rate-limit-every N    fail every N'th API call with RATE_LIMIT_REACHED (off)
+    --jobs N                also time a full generate across N worker processes
+    --seed N                corpus random seed (1)
+"""
+
+import os
+import platform
+import simplejson
+import subprocess
+import sys
+import time
+
+import evernote.edam.type.ttypes as Types
+
+from . import setupSettings
+
+settings = setupSettings()
+
+from lib.collector import Collector
+from lib.generator import HtmlGenerator, NoteSummary
+from lib.noteindex import getNoteIndex
+from lib.scrubber import getScrubber
+from lib.search import textOf, weighTerms
+from . import corpus
+from .fakestore import FakeClient, FakeNoteStore
+
+OPTIONS = (
+    # (flag, key, type, default)
+    ('--notes', 'notes', int, 500),
+    ('--content-size', 'contentSize', int, 8192),
+    ('--resources', 'resources', int, 2),
+    ('--resource-size', 'resourceSize', int, 4096),
+    ('--tags', 'tags', int, 100),
+    ('--tags-per-note', 'tagsPerNote', int, 3),
+    ('--notebooks', 'notebooks', int, 1),
+    ('--css-junk', 'cssJunk', float, 0.2),
+    ('--latency', 'latency', float, 0.0),
+    ('--rate-limit-every', 'rateLimitEvery', int, None),
+    ('--jobs', 'jobs', int, None),
+    ('--seed', 'seed', int, 1),
+)
+
+def parseArgs(argv):
+    params = {}
+    for flag, key, kind, default in OPTIONS:
+        params[key] = kind(argv[argv.index(flag) + 1]) if flag in argv else default
+    output = argv[argv.index('--output') + 1] if '--output' in argv else None
+    compare = argv[argv.index('--compare') + 1] if '--compare' in argv else None
+    return params, output, compare
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+def collect(store, params):
+    collector = Collector([notebook.name for notebook in store.notebooks], client=FakeClient(store))
+    before = dict(store.calls)
+    seconds, _ = timed(collector.run)
+    collector.saveTagCache()
+    calls = dict((name, count - before.get(name, 0)) for name, count in store.calls.items() if count - before.get(name, 0))
+    return {'seconds': seconds, 'notesPerSecond': params['notes'] / seconds if seconds else None, 'apiCalls': calls}
+
+def sync(store, names):
+    collector = Collector(names, client=FakeClient(store))
+    before = dict(store.calls)
+    seconds, numUpdated = timed(collector.sync)
+    calls = dict((name, count - before.get(name, 0)) for name, count in store.calls.items() if count - before.get(name, 0))
+    return {'seconds': seconds, 'notesUpdated': numUpdated, 'notesRemoved': collector.numRemoved, 'apiCalls': calls}
+
+def syncs(store):
+    """Sync the collected notebooks from scratch, then again after each change to the account."""
+    names = [notebook.name for notebook in store.notebooks]
+    guids = sorted(store.notes)
+    results = {}
+    results['sync.full'] = sync(store, names)
+    results['sync.noop'] = sync(store, names)
+    for guid in guids[0::10]:
+        store.update(guid, updated=store.notes[guid].updated + 1000)
+    results['sync.incremental'] = sync(store, names)
+    # Moved to a notebook of their own, then collected from it by a separate
+    # sync, which must leave the other notebooks' notes alone.
+    other = Types.Notebook(guid='notebook-bench-other', name='Other')
+    store.notebooks.append(other)
+    for guid in guids[5::10]:
+        store.update(guid, notebookGuid=other.guid)
+    results['sync.movedOut'] = sync(store, names)
+    results['sync.secondNotebook'] = sync(store, [other.name])
+    return results
+
+def generate(full, jobs=1):
+    generator = HtmlGenerator()
+    seconds, _ = timed(lambda: generator.generate(full=full, jobs=jobs))
+    return {'seconds': seconds, 'pagesRendered': generator.manifest.rendered, 'pagesSkipped': generator.manifest.skipped}
+
+def generateIndices():
+    generator = HtmlGenerator()
+    seconds, _ = timed(generator.generateIndices)
+    return {'seconds': seconds}
+
+def transforms(limit=200):
+    """Time each per-note content transform over (up to) `limit' notes, already loaded and with the scrub cache warm."""
+    generator = HtmlGenerator()
+    summaries = [NoteSummary(row) for row in getNoteIndex().notes()][0:limit]
+    notes = [generator.loadNote(summary.created) for summary in summaries]
+    scrubber = getScrubber()
+    raw = [note.rawContent.replace('evernote', 'note') for note in notes]
+    for note in notes:
+        note.obj
+
+    results = {}
+    seconds, _ = timed(lambda: [scrubber.scrub(content) for content in raw])
+    results['scrub'] = {'seconds': seconds, 'notes': len(raw), 'bytes': sum(len(content) for content in raw)}
+    seconds, _ = timed(lambda: [note.content for note in notes])
+    results['scrubCached'] = {'seconds': seconds, 'notes': len(notes)}
+    seconds, _ = timed(lambda: [generator.contentWithTranslatedAssets(note) for note in notes])
+    results['translateAssets'] = {'seconds': seconds, 'notes': len(notes)}
+    seconds, _ = timed(lambda: [weighTerms(note.title, [], note.sourceDomain, textOf(note.content)) for note in notes])
+    results['searchTerms'] = {'seconds': seconds, 'notes': len(notes)}
+    return results
+
+def outputBytes():
+    total = 0
+    for directory, _, fileNames in os.walk(settings.OUTPUT_PATH):
+        total += sum(os.path.getsize(os.path.join(directory, fileName)) for fileName in fileNames)
+    return total
+
+def run(params):
+    rng = corpus.rng(params['seed'])
+    seconds, (notebook, tags, notes) = timed(lambda: corpus.makeCorpus(
+        rng,
+        params['notes'],
+        contentSize=params['contentSize'],
+        numResources=params['resources'],
+        resourceSize=params['resourceSize'],
+        numTags=params['tags'],
+        tagsPerNote=params['tagsPerNote'],
+        cssJunk=params['cssJunk'],
+    ))
+    notebooks = corpus.splitNotebooks(notebook, notes, params['notebooks'])
+    store = FakeNoteStore(notebooks, tags, notes, latency=params['latency'], rateLimitEvery=params['rateLimitEvery'])
+
+    results = {'corpus': {'seconds': seconds}}
+    results['collect.cold'] = collect(store, params)
+    results['collect.warm'] = collect(store, params)
+    results['collect.cold']['rateLimited'] = store.rateLimited
+    results['generate.full'] = generate(full=True)
+    results['generate.full']['outputBytes'] = outputBytes()
+    results['generate.noop'] = generate(full=False)
+    if params['jobs']:
+        results['generate.full.jobs'] = generate(full=True, jobs=params['jobs'])
+    results['generateIndices'] = generateIndices()
+    for name, result in transforms().items():
+        results['transform.' + name] = result
+    results.update(syncs(store))
+    return results
+
+def compare(results, baseline):
+    """@return list of lines comparing `seconds' per benchmark against a previous run."""
+    lines = ['%-26s %10s %10s %8s' % ('benchmark', 'baseline', 'current', 'ratio')]
+    for name, result in sorted(results.items()):
+        old = baseline.get('results', {}).get(name, {}).get('seconds')
+        new = result.get('seconds')
+        if old is None or new is None:
+            continue
+        lines.append('%-26s %9.3fs %9.3fs %7.2fx' % (name, old, new, new / old if old else float('inf')))
+    return lines
+
+def main():
+    params, output, comparePath = parseArgs(sys.argv[1:])
+    report = {
+        'commit': gitCommit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': int(time.time()),
+        'params': params,
+        'results': run(params),
+    }
+    data = simplejson.dumps(report, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as fh:
+            fh.write(data + '\n')
+    else:
+        print(data)
+    if comparePath:
+        with open(comparePath, 'r') as fh:
+            baseline = simplejson.load(fh)
+        sys.stderr.write('\n'.join(compare(report['results'], baseline)) + '\n')
+
+if __name__ == '__main__':
+    main()
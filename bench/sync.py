@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+"""
+Check incremental sync of two notebooks collected by separate runs into the
+same DATA_PATH: syncing one must leave the other's notes alone, and notes
+trashed, moved out or expunged must be removed (and counted) only by the
+sync of the notebook they were collected from.  Exits non-zero on failure.
+
+    python -m bench.sync [--notes N]
+"""
+
+import sys
+
+from . import setupSettings
+
+settings = setupSettings()
+
+from lib.collector import Collector
+from lib.noteindex import getNoteIndex
+from . import corpus
+from .fakestore import FakeClient, FakeNoteStore
+
+def sync(store, name):
+    """@return tuple of (notes updated, notes removed) by a sync of the named notebook."""
+    collector = Collector([name], client=FakeClient(store))
+    numUpdated = collector.sync()
+    return numUpdated, collector.numRemoved
+
+def main():
+    argv = sys.argv[1:]
+    numNotes = int(argv[argv.index('--notes') + 1]) if '--notes' in argv else 40
+    notebook, tags, notes = corpus.makeCorpus(corpus.rng(), numNotes, contentSize=512, numResources=0, numTags=5)
+    alpha, beta = corpus.splitNotebooks(notebook, notes, 2)
+    alpha.name, beta.name = 'Alpha', 'Beta'
+    store = FakeNoteStore([alpha, beta], tags, notes)
+    alphaGuids = [note.guid for note in notes if note.notebookGuid == alpha.guid]
+    betaGuids = [note.guid for note in notes if note.notebookGuid == beta.guid]
+
+    failures = []
+    def check(label, actual, expected):
+        print('%s: %s' % (label, actual))
+        if actual != expected:
+            failures.append('%s was %s, expected %s' % (label, actual, expected))
+    def counts():
+        index = getNoteIndex()
+        return index.count(notebookGuid=alpha.guid), index.count(notebookGuid=beta.guid)
+
+    check('first Alpha sync (updated, removed)', sync(store, 'Alpha'), (len(alphaGuids), 0))
+    check('first Beta sync (updated, removed)', sync(store, 'Beta'), (len(betaGuids), 0))
+    check('indexed notes (Alpha, Beta)', counts(), (len(alphaGuids), len(betaGuids)))
+
+    store.update(alphaGuids[0], active=False)
+    store.update(alphaGuids[1], notebookGuid='notebook-elsewhere')
+    store.expunge(alphaGuids[2])
+    store.update(betaGuids[0], active=False)
+    check('Alpha sync after trashing, moving and expunging 3 of its notes (updated, removed)', sync(store, 'Alpha'), (0, 3))
+    check('indexed notes (Alpha, Beta)', counts(), (len(alphaGuids) - 3, len(betaGuids)))
+    check('Beta sync after trashing 1 of its notes (updated, removed)', sync(store, 'Beta'), (0, 1))
+    check('indexed notes (Alpha, Beta)', counts(), (len(alphaGuids) - 3, len(betaGuids) - 1))
+    check('Alpha sync with nothing changed (updated, removed)', sync(store, 'Alpha'), (0, 0))
+
+    for failure in failures:
+        print('FAIL: ' + failure)
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
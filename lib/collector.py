@@ -9,11 +9,12 @@ EverNote WebClipper publisher.
 """
 
 import base64
-import glob
+import concurrent.futures
 import os
 import settings
 import simplejson
 import sys
+import threading
 import time
 
 import bs4
@@ -23,35 +24,72 @@ import evernote.edam.notestore.ttypes
 
 from .errorcodes import *
 from .logger import logger
-
-try:
-    import cPickle as pickle
-except ImportError:
-    logger.warn('cPickle import failed, falling back to plain pickle')
-    import pickle
-
-TAG_CACHE_FILENAME = 'data/.tagCache.pickle'
+from .metrics import metrics
+from .noteindex import getNoteIndex, resourceHashesOf
+from .ratelimit import RateLimiter
+from .resources import ResourceStore
+from .scrubber import removeCached
+from .segments import getSegmentStore
+from .tagcache import TagCache
+from .util import matchNotebooks
+
+SYNC_STATE_FILENAME = '.syncState.json'
+SYNC_CHUNK_SIZE = 100
+TAG_CHUNK_SIZE = 1000
+HYDRATE_WORKERS = getattr(settings, 'HYDRATE_WORKERS', 4)
 
 class Collector(object):
     """Note collector."""
 
-    def __init__(self, notebookName):
-        """@param notebookName str Notebook name (or name fragment)."""
-        self.notebookName = notebookName
-        self.client = evernote.api.client.EvernoteClient(
+    def __init__(self, notebookNames, client=None, allMatches=False):
+        """
+        @param notebookNames str or list of str Notebook names (or name fragments).
+        @param client Optional stand-in for the EvernoteClient, e.g. for benchmarks.
+        @param allMatches bool When True, collect every notebook matching each fragment, otherwise just the first.
+        """
+        self.notebookNames = [notebookNames] if isinstance(notebookNames, str) else list(notebookNames)
+        self.allMatches = allMatches
+        self.client = client or evernote.api.client.EvernoteClient(
             consumer_key=settings.consumerKey,
             consumer_secret=settings.consumerSecret,
             token=settings.developerToken,
             sandbox=False
         )
         self.noteStore = self.client.get_note_store()
-        self.tagCache = {}
-        self.loadTagCache()
+        self.threadLocal = threading.local()
+        self.threadLocal.noteStore = self.noteStore
+        self.rateLimiter = RateLimiter()
+        # Held while refreshing the tag cache, so concurrent misses cost one refresh.
+        self.tagLock = threading.Lock()
+        self.tagCache = TagCache()
+        self.tagCache.load()
+        self.index = getNoteIndex()
+        self.resourceStore = ResourceStore()
+        self.storage = getSegmentStore()
+        # Notebooks are collected on threads of their own, but the note index
+        # and segment store are only ever used by one at a time.
+        self.storageLock = threading.RLock()
+        self.countsLock = threading.Lock()
         self.remoteNoteCounts = None
+        self.numRemoved = 0
+        # Called with the `created' stamps of each batch of notes once they are stored (see `lib.pipeline').
+        self.onStored = None
 
     def run(self):
-        """Retrieve the latest notes."""
-        notebook = self.resolveNotebook()
+        """Retrieve the latest notes, from each notebook concurrently."""
+        notebooks = self.resolveNotebooks()
+        self.refreshTags()
+        self.saveTagCache()
+        if len(notebooks) == 1:
+            self.collectNotebook(notebooks[0])
+            return
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(notebooks)) as executor:
+            futures = [executor.submit(self.collectNotebook, notebook) for notebook in notebooks]
+            for future in futures:
+                future.result()
+
+    def collectNotebook(self, notebook):
+        """Retrieve the latest notes of one notebook, newest-updated first, until reaching ones already collected."""
         offset = 0
         noteList = self.getNoteList(notebook, offset)
         while len(noteList.notes) > 0:
@@ -63,99 +101,282 @@ class Collector(object):
             offset += len(noteList.notes)
             noteList = self.getNoteList(notebook, offset)
 
-    def resolveNotebook(self):
-        notebooks = self.noteStore.listNotebooks()
+    def sync(self):
+        """
+        Retrieve only what changed since the last sync, driven by the account's
+        update sequence number (USN).  When nothing changed this costs a
+        `listNotebooks' and a `getSyncState' round-trip and nothing else.
+        Sync chunks cover the whole account, so every notebook is brought up
+        to date from the same pass, starting at the one furthest behind.
+
+        @return int Number of notes updated.
+        """
+        notebooks = self.resolveNotebooks()
+        states = self.loadSyncStates(notebooks)
+        syncState = self.rateLimiter.call(self.noteStore.getSyncState, settings.developerToken)
+        self.refreshTags(syncState)
+        self.saveTagCache()
+
+        afterUSN = min(state['lastUpdateCount'] for state in states.values())
+        if syncState.fullSyncBefore > min(state['lastSyncTime'] for state in states.values()):
+            logger.info('server requested a full sync (fullSyncBefore=%s)', syncState.fullSyncBefore)
+            afterUSN = 0
+        elif afterUSN == syncState.updateCount:
+            logger.info('already in sync at usn=%s', afterUSN)
+            return 0
+
+        logger.info('syncing %s from usn=%s to usn=%s', ', '.join('notebook "{0}"'.format(notebook.name) for notebook in notebooks), afterUSN, syncState.updateCount)
+        # Tags were already brought up to date by `refreshTags'.
+        chunkFilter = evernote.edam.notestore.ttypes.SyncChunkFilter(
+            includeNotes=True,
+            includeNoteAttributes=True,
+            includeExpunged=True,
+        )
+        numUpdated = 0
+        while afterUSN < syncState.updateCount:
+            chunk = self.rateLimiter.call(self.noteStore.getFilteredSyncChunk, settings.developerToken, afterUSN, SYNC_CHUNK_SIZE, chunkFilter)
+            numUpdated += self.applySyncChunk(notebooks, chunk)
+            if chunk.chunkHighUSN is None:
+                break
+            afterUSN = chunk.chunkHighUSN
+            # Checkpoint after every chunk so an interrupted sync resumes where it left off.
+            self.saveSyncStates(notebooks, states, afterUSN, chunk.currentTime)
+
+        self.saveSyncStates(notebooks, states, syncState.updateCount, syncState.currentTime)
+        return numUpdated
 
-        filteredNotebooks = [nb for nb in notebooks if self.notebookName.lower() in nb.name.lower()]
+    def applySyncChunk(self, notebooks, chunk):
+        """Store changed notes and remove expunged notes found in a sync chunk."""
+        logger.debug('-> chunkHighUSN=%s notes=%s expungedNotes=%s', chunk.chunkHighUSN, len(chunk.notes or []), len(chunk.expungedNotes or []))
+
+        notebookGuids = set(notebook.guid for notebook in notebooks)
+        changed = []
+        for note in chunk.notes or []:
+            if note.notebookGuid in notebookGuids and note.active is not False and not note.deleted:
+                changed.append(note)
+            else:
+                # Moved to a notebook which isn't collected or into the trash,
+                # or just a note of some other notebook: chunks cover the whole account.
+                self.removeLocalNote(note.created, note.guid, notebookGuids)
+
+        if chunk.expungedNotes:
+            with self.storageLock:
+                localNotes = self.index.createdByGuid()
+            for guid in chunk.expungedNotes:
+                if guid in localNotes:
+                    self.removeLocalNote(localNotes[guid], guid)
+
+        return self.hydrateAndStore(changed)
+
+    def removeLocalNote(self, created, guid, notebookGuids=None):
+        """
+        Remove the local data files and index entry for a note, if present.
+
+        @param notebookGuids set Only remove the note if it was collected from one of these notebooks (defaults to any).
+        @return bool Whether the note was removed.
+        """
+        with self.storageLock, self.index.transaction(), self.storage.transaction():
+            if notebookGuids is not None and self.index.notebookGuidOf(guid) not in notebookGuids:
+                return False
+            if not self.index.remove(guid):
+                return False
+            self.storage.remove(created)
+        self.numRemoved += 1
+        self.removeLegacyFiles(created)
+        removeCached(guid)
+        return True
 
-        if len(filteredNotebooks) < 1:
-            logger.error('requested notebook "{0}" not found (candidates were: {1})\n'.format(self.notebookName, ', '.join([nb.name for nb in notebooks])))
+    @staticmethod
+    def removeLegacyFiles(created):
+        """Remove a note's data files from before the segment store, if any."""
+        for fileName in ('{0}/{1}.json'.format(settings.DATA_PATH, created), '{0}/{1}.pickle'.format(settings.DATA_PATH, created)):
+            if os.path.exists(fileName):
+                logger.info('removing %s', fileName)
+                os.remove(fileName)
+
+    def loadSyncStates(self, notebooks):
+        """@return dict of notebook guid -> dict with the last synced USN and server time for the notebook."""
+        allState = {}
+        try:
+            with open('{0}/{1}'.format(settings.DATA_PATH, SYNC_STATE_FILENAME), 'r') as fh:
+                allState = simplejson.load(fh)
+        except (IOError, OSError):
+            logger.info('no pre-existing sync state found, doing a full sync')
+        except simplejson.errors.JSONDecodeError:
+            logger.exception('sync state is corrupted, doing a full sync')
+        states = {}
+        for notebook in notebooks:
+            states[notebook.guid] = {'lastUpdateCount': 0, 'lastSyncTime': 0}
+            states[notebook.guid].update(allState.get(notebook.guid, {}))
+        return states
+
+    def saveSyncStates(self, notebooks, states, updateCount, syncTime):
+        """
+        Atomically persist the last synced USN and server time for the
+        notebooks, leaving any which were already further along as they were.
+        """
+        path = '{0}/{1}'.format(settings.DATA_PATH, SYNC_STATE_FILENAME)
+        allState = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as fh:
+                    allState = simplejson.load(fh)
+            except simplejson.errors.JSONDecodeError:
+                pass
+        for notebook in notebooks:
+            state = states[notebook.guid]
+            if updateCount >= state['lastUpdateCount']:
+                state.update({'lastUpdateCount': updateCount, 'lastSyncTime': syncTime})
+            allState[notebook.guid] = state
+        with open(path + '.tmp', 'w') as fh:
+            simplejson.dump(allState, fh)
+        os.rename(path + '.tmp', path)
+
+    def resolveNotebooks(self):
+        """@return list of Notebook matching the requested names, exiting when any name matches none."""
+        notebooks = self.rateLimiter.call(self.noteStore.listNotebooks)
+
+        picked, unmatched = matchNotebooks(notebooks, self.notebookNames, self.allMatches)
+
+        if unmatched:
+            logger.error('requested notebook "{0}" not found (candidates were: {1})\n'.format('", "'.join(unmatched), ', '.join([nb.name for nb in notebooks])))
             sys.exit(ERR_NOTEBOOK_NOT_FOUND)
 
-        notebook = filteredNotebooks[0]
-        logger.info('found notebook "{0}"'.format(notebook.name))
-        return notebook
+        with self.storageLock, self.index.transaction():
+            for notebook in picked:
+                logger.info('found notebook "{0}"'.format(notebook.name))
+                # So `generate --notebook' can find the notebook's notes offline.
+                self.index.upsertNotebook(notebook.guid, notebook.name)
+        return picked
 
     def getNoteList(self, notebook, offset):
         """Retrieve the NoteList for the named notebook."""
         pageSize = 49
-        noteList = self.noteStore.findNotes(settings.developerToken, self.defaultSearchFilter(notebook), offset, pageSize)
-        logger.debug('-> offset=%s count=%s' % (offset, len(noteList.notes)))
+        noteList = self.rateLimiter.call(self.threadNoteStore().findNotes, settings.developerToken, self.defaultSearchFilter(notebook), offset, pageSize)
+        logger.debug('-> offset=%s count=%s', offset, len(noteList.notes))
         return noteList
 
     def hydrateAndStore(self, partialNotes):
-        numUpdated = 0
-        for partialNote in partialNotes:
-            #if partialNote.guid != '26cd3186-1044-4d0c-b1a3-7ec47f1a0549':
-            #    continue
-            #if '%s' % partialNote.created != '1467826537000':
-            #    continue
-            # args: authenticationToken, guid, withContent, withResourcesData, withResourcesRecognition, withResourcesAlternateData
-            jsonFileName = '{0}/{1}.json'.format(settings.DATA_PATH, partialNote.created)
-            pickleFileName = '{0}/{1}.pickle'.format(settings.DATA_PATH, partialNote.created)
-            if os.path.exists(jsonFileName) and os.path.exists(pickleFileName):
-                logger.debug('jsonFileName=%s', jsonFileName)
-                with open(jsonFileName, 'r') as fh:
-                    try:
-                        detail = simplejson.load(fh)
-                        if isinstance(detail, dict) and detail.get('updated', None) == partialNote.updated:
-                            logger.debug('Already up to date for note=%s' % (partialNote.title,))
-                            continue
-                    except simplejson.errors.JSONDecodeError:
-                        logger.exception('Found malformed or corrupted JSON file: %s (will auto-rename)', jsonFileName)
-                        stamp = datetime.datetime.now().strftime('%Y-%m-%dT%H_%M_%S')
-                        os.rename(jsonFileName, 'corrupted--%s.%s' % (jsonFileName, stamp))
-
-            note = self.getNote(partialNote.guid)
-            tags = self.getNoteTags(note)
-
-            #logger.debug('b64Content: %s' % (type(note.content)))
-            data = {
-                'title': bs4.BeautifulSoup(note.title, 'html.parser').string,
-                #'b64Title': base64.b64encode(note.title),
-                'guid': note.guid,
-                'created': note.created,
-                'updated': note.updated,
-                'deleted': note.deleted,
-                'b64Content': base64.b64encode(note.content.encode('utf-8')),
-                'b64ContentHash': base64.b64encode(note.contentHash),
-                'contentLength': note.contentLength,
-                'tags': tags,
-                'tagNames': note.tagNames,
-                'tagGuids': note.tagGuids,
-            }
-
-            with open(pickleFileName, 'wb') as fh:
-                pickle.dump(note, fh)
-
-            with open(jsonFileName, 'w') as fh:
-                simplejson.dump(data, fh)
-
-#            out = '''
-#    title: {title}
-#    created: {created}
-#    updated: {updated}
-#    deleted: {deleted}
-#    content: {content}
-#    tags: {tags}
-#            '''.format(
-#                title=note.title,
-#                created=note.created,
-#                updated=note.updated,
-#                deleted=note.deleted,
-#                content=note.content,
-#                tags=', '.join(note.tagNames) if note.tagNames is not None else '',
-#            ).strip()
-            # print type(note.contentHash), note.contentHash
-            # print dir(note)
-            # print note.tagNames
-
-            #print dir(note)
-            #print str(note.attributes
-
-            numUpdated += 1
+        """
+        Fetch and store full copies of any new or changed notes.  The `getNote'
+        and `getNoteTags' calls run on a bounded pool of threads; once the
+        whole batch is in, it is written in the order given, in a single
+        transaction, while holding the storage lock.
+
+        @return int Number of notes updated.
+        """
+        with self.storageLock:
+            staleNotes = [partialNote for partialNote in partialNotes if not self.isUpToDate(partialNote)]
+        metrics.incr('notes_skipped', len(partialNotes) - len(staleNotes))
+        if len(staleNotes) == 0:
+            return 0
+
+        # Resolve the whole batch's tags up front, so hydration threads only read the cache.
+        self.resolveTags(guid for partialNote in staleNotes for guid in partialNote.tagGuids or [])
+
+        start = time.time()
+        numBytes = 0
+        fetched = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=HYDRATE_WORKERS) as executor:
+            futures = [executor.submit(self.fetchNote, partialNote.guid) for partialNote in staleNotes]
+            for i, future in enumerate(futures, 1):
+                try:
+                    note, tags, numFetched = future.result()
+                except Exception:
+                    for pending in futures:
+                        pending.cancel()
+                    raise
+                fetched.append((note, tags))
+                numBytes += numFetched
+                metrics.incr('notes_fetched')
+                metrics.incr('bytes_downloaded', numFetched)
+                if i % 10 == 0 or i == len(futures):
+                    elapsed = max(time.time() - start, 0.001)
+                    logger.info('hydrated %s/%s notes (%.1f notes/s, %.1f KiB/s)', i, len(futures), i / elapsed, numBytes / 1024.0 / elapsed)
+
+        with self.storageLock:
+            with self.index.transaction(), self.storage.transaction():
+                for note, tags in fetched:
+                    self.storeNote(note, tags)
+            # Only now that the new copies are safely stored.
+            for partialNote in staleNotes:
+                self.removeLegacyFiles(partialNote.created)
+        self.saveTagCache()
+        if self.onStored is not None:
+            self.onStored([note.created for note, _ in fetched])
+
+        return len(staleNotes)
+
+    def isUpToDate(self, partialNote):
+        """@return True when the note index shows the local copy has the same `updated' stamp and notebook."""
+        if self.index.stampFor(partialNote.created) != (partialNote.updated, partialNote.notebookGuid):
+            return False
+        if not self.storage.has(partialNote.created) and not os.path.exists('{0}/{1}.pickle'.format(settings.DATA_PATH, partialNote.created)):
+            # Stored data went missing out from under the index.
+            return False
+        logger.debug('Already up to date for note=%s', partialNote.title)
+        return True
 
-        return numUpdated
+    def fetchNote(self, guid):
+        """
+        Runs on a hydration thread.
+
+        @return tuple of (full note, tag dicts, number of bytes downloaded).
+        """
+        note = self.getNote(guid)
+        numBytes = (note.contentLength or 0) + self.fetchResources(note)
+        return note, self.getNoteTags(note), numBytes
+
+    def fetchResources(self, note):
+        """
+        Download the bodies of any of the note's resources which aren't already
+        in the resource store.
+
+        @return int Number of bytes downloaded.
+        """
+        numBytes = 0
+        for resource in note.resources or []:
+            if resource.data is None or self.resourceStore.has(resource.data.bodyHash):
+                continue
+            body = self.rateLimiter.call(self.threadNoteStore().getResourceData, settings.developerToken, resource.guid)
+            self.resourceStore.put(resource.data.bodyHash, body)
+            numBytes += len(body)
+        return numBytes
+
+    def storeNote(self, note, tags):
+        """Store a fully hydrated note (minus its resource bodies, see `fetchResources') in the segment store."""
+        content = note.content
+        data = {
+            'title': bs4.BeautifulSoup(note.title, 'html.parser').string,
+            #'b64Title': base64.b64encode(note.title),
+            'guid': note.guid,
+            'created': note.created,
+            'updated': note.updated,
+            'deleted': note.deleted,
+            # Filled back in when the note is published through the API, see `segments.apiJson'.
+            'b64Content': None,
+            'b64ContentHash': base64.b64encode(note.contentHash).decode('ascii'),
+            'contentLength': note.contentLength,
+            'tags': tags,
+            'tagNames': note.tagNames,
+            'tagGuids': note.tagGuids,
+        }
+        note.content = None
+        self.storage.put(note.created, data, note, content)
+
+        self.index.upsert(
+            note.guid,
+            note.created,
+            note.updated,
+            note.deleted,
+            data['title'],
+            note.attributes.sourceURL if note.attributes else None,
+            note.tagGuids,
+            tags,
+            data['b64ContentHash'],
+            note.notebookGuid,
+            resourceHashesOf(note),
+        )
 
     def defaultSearchFilter(self, notebook):
         # `order = 1' -> order by created
@@ -165,74 +386,93 @@ class Collector(object):
         return searchFilter
 
     def localCountsMatchRemote(self, notebook):
-        localJsonCount = len(glob.glob('{0}/[0-9]*.json'.format(settings.DATA_PATH)))
-        localPickleCount = len(glob.glob('{0}/[0-9]*.pickle'.format(settings.DATA_PATH)))
-        if localJsonCount != localPickleCount:
-            logger.debug('local-json-len=%s local-pikl-len=%s', localJsonCount, localPickleCount)
-            return False
-        if self.remoteNoteCounts is None:
-            self.remoteNoteCounts = self.noteStore.findNoteCounts(settings.developerToken, self.defaultSearchFilter(notebook), False)
+        with self.storageLock:
+            localCount = self.index.count(notebookGuid=notebook.guid)
+        with self.countsLock:
+            if self.remoteNoteCounts is None:
+                # One call covers every notebook.
+                self.remoteNoteCounts = self.rateLimiter.call(self.threadNoteStore().findNoteCounts, settings.developerToken, evernote.edam.notestore.ttypes.NoteFilter(), False)
         remoteCount = self.remoteNoteCounts.notebookCounts[notebook.guid]
-        logger.debug('local-json-len=%s local-pikl-len=%s remote-book-len=%s', localJsonCount, localPickleCount, remoteCount)
-        if localPickleCount != remoteCount and localPickleCount != remoteCount-1: # There seems to be a counting bug on Evernotes side.
+        logger.debug('local-len=%s remote-book-len=%s', localCount, remoteCount)
+        if localCount != remoteCount and localCount != remoteCount-1: # There seems to be a counting bug on Evernotes side.
             return False
         return True
 
-    def loadTagCache(self):
-        """Try to load tag cache from disk."""
-        logger.info('loading tag cache..')
-
-        try:
-            with open(TAG_CACHE_FILENAME, 'rb') as fh:
-                self.tagCache = pickle.loads(fh.read(), encoding='latin1')
-            logger.info('tag cache successfully loadded')
+    def saveTagCache(self):
+        """Checkpoint the tag cache to disk (a no-op when nothing changed)."""
+        self.tagCache.save()
 
-        except Exception:
-            logger.exception('notice: pre-existing tag cache not found or loading failed')
-
-    def __del__(self):
-        """Persist tag cache to disk."""
-        if not hasattr(self, 'tagCache') or len(self.tagCache) == 0:
-           return
-
-        logger.info('shutdown: saving tag cache to disk...')
-        with open(TAG_CACHE_FILENAME, 'wb') as fh:
-            fh.write(pickle.dumps(self.tagCache))
+    def threadNoteStore(self):
+        """Thrift clients are not thread-safe, so each thread gets a NoteStore of its own."""
+        noteStore = getattr(self.threadLocal, 'noteStore', None)
+        if noteStore is None:
+            noteStore = self.threadLocal.noteStore = self.client.get_note_store()
+        return noteStore
 
     def getNote(self, guid):
-        """Given a note guid, retrieves and returns the full note."""
-        return self.noteStore.getNote(settings.developerToken, guid, True, True, True, True)
+        """
+        Given a note guid, retrieves and returns the full note, minus resource
+        bodies, which are fetched separately by `fetchResources'.
+        """
+        # args: authenticationToken, guid, withContent, withResourcesData, withResourcesRecognition, withResourcesAlternateData
+        return self.rateLimiter.call(self.threadNoteStore().getNote, settings.developerToken, guid, True, False, True, False)
 
     def getNoteTags(self, note):
-        """Given a note, retrieves associated tag records and converts them to dicts."""
-        logger.info('guids=%s for note=%s' % (note.tagGuids, note.title))
-        return list(map(self.tagToDict, list(map(self.resolveGuidToTag, note.tagGuids or []))))
-
-    def resolveGuidToTag(self, guid):
-        """Given a tag guid, will look in cache and return cached item, otherwise will pull the tag from the Evernote API."""
-        if guid in self.tagCache:
-           # Read from cache.
-           return self.tagCache[guid]
-
-        # Otherwise, retrieve a fresh list of all tags on the account.
-        logger.info('fetching full tag list for the account')
-        tags = self.noteStore.listTags(settings.developerToken)
-        for tag in tags:
-            # Add to cache.
-            self.tagCache[tag.guid] = tag
-
-        if guid in self.tagCache:
-            # Return cached
-            return self.tagCache[guid]
-
-        # Otherwise, this is unexpected.  Attempt a direct lookup.
-        logger.warn('requested tag guid not found in full listing, will attempt a direct lookup')
-        tag = self.noteStore.getTag(settings.developerToken, guid)
-        # Add to cache.
-        self.tagCache[tag.guid] = tag
-        return tag
-
-    @staticmethod
-    def tagToDict(tag):
-        """Convert a Tag object to a dict representation."""
-        return dict([(key, getattr(tag, key)) for key in ('updateSequenceNum', 'guid', 'name', 'parentGuid')])
+        """Given a note, retrieves associated tag records as dicts."""
+        logger.debug('guids=%s for note=%s', note.tagGuids, note.title)
+        self.resolveTags(note.tagGuids or [])
+        return [self.tagCache.get(guid) for guid in note.tagGuids or []]
+
+    def resolveTags(self, guids):
+        """
+        Make sure every one of `guids' is in the tag cache: one refresh covers
+        all the misses, and only tags still unknown after it are fetched one by
+        one.
+        """
+        missing = self.tagCache.missing(guids)
+        if not missing:
+            return
+        with self.tagLock:
+            missing = self.tagCache.missing(missing)
+            if not missing:
+                # Another thread already resolved them.
+                return
+            self.refreshTags(locked=True)
+            for guid in self.tagCache.missing(missing):
+                logger.warn('tag guid=%s not found after refreshing tags, will attempt a direct lookup', guid)
+                self.tagCache.update([self.rateLimiter.call(self.threadNoteStore().getTag, settings.developerToken, guid)])
+
+    def refreshTags(self, syncState=None, locked=False):
+        """
+        Bring the tag cache up to date with the account.  When the account's
+        update count (USN) hasn't moved since the last refresh this costs one
+        `getSyncState' (or nothing, given `syncState'); otherwise only the tags
+        changed since then are fetched, in bulk sync chunks.  A cold (or
+        invalidated) cache is filled from a single `listTags'.
+        """
+        if not locked:
+            with self.tagLock:
+                return self.refreshTags(syncState, locked=True)
+
+        if syncState is None:
+            syncState = self.rateLimiter.call(self.threadNoteStore().getSyncState, settings.developerToken)
+        if self.tagCache.isCurrent(syncState):
+            return
+
+        if self.tagCache.needsFullRefresh(syncState):
+            logger.info('fetching full tag list for the account')
+            tags = self.rateLimiter.call(self.threadNoteStore().listTags, settings.developerToken)
+            self.tagCache.reset()
+            self.tagCache.update(tags)
+        else:
+            logger.info('refreshing tags changed since usn=%s', self.tagCache.updateCount)
+            chunkFilter = evernote.edam.notestore.ttypes.SyncChunkFilter(includeTags=True, includeExpunged=True)
+            afterUSN = self.tagCache.updateCount
+            while afterUSN < syncState.updateCount:
+                chunk = self.rateLimiter.call(self.threadNoteStore().getFilteredSyncChunk, settings.developerToken, afterUSN, TAG_CHUNK_SIZE, chunkFilter)
+                self.tagCache.update(chunk.tags or [])
+                self.tagCache.remove(chunk.expungedTags or [])
+                if chunk.chunkHighUSN is None:
+                    break
+                afterUSN = chunk.chunkHighUSN
+        self.tagCache.advance(syncState.updateCount, syncState.currentTime)
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+"""
+Resized and recompressed derivatives of image resources, so node pages can
+offer browsers a `srcset' instead of full-size screenshots.  Requires the
+optional Pillow module.
+"""
+
+import concurrent.futures
+import glob
+import hashlib
+import io
+import os
+import simplejson
+
+from .logger import logger
+from .metrics import metrics
+from .resources import ResourceStore, hexHash
+
+import settings
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+DERIVATIVES_DIRNAME = 'derivatives'
+DEFAULT_WIDTHS = (480, 960, 1600)
+INFO_FILENAME = 'info.json'
+
+def enabled():
+    """@return True when IMAGE_DERIVATIVES is on and Pillow is importable."""
+    if not getattr(settings, 'IMAGE_DERIVATIVES', False):
+        return False
+    if Image is None:
+        logger.warn('IMAGE_DERIVATIVES is set but Pillow is not installed, images will be published as-is')
+        return False
+    return True
+
+class DerivativeStore(object):
+    """
+    Derivatives stored under `DATA_PATH/derivatives/ab/cd/<md5>/', keyed by
+    the original resource's body hash, next to an `info.json' recording the
+    original's dimensions, the variants made from it and the widths and
+    quality they were made with.  A resource is processed again only when
+    those settings change (or never, once recorded not to be an image).
+    """
+
+    def __init__(self, root=None):
+        self.root = root or '{0}/{1}'.format(settings.DATA_PATH, DERIVATIVES_DIRNAME)
+        self.widths = tuple(sorted(getattr(settings, 'IMAGE_DERIVATIVE_WIDTHS', DEFAULT_WIDTHS)))
+        self.quality = getattr(settings, 'IMAGE_DERIVATIVE_QUALITY', 80)
+        self.infos = {}
+
+    def directory(self, bodyHash):
+        h = hexHash(bodyHash)
+        return '{0}/{1}/{2}/{3}'.format(self.root, h[0:2], h[2:4], h)
+
+    def variantPath(self, bodyHash, filename):
+        return '{0}/{1}'.format(self.directory(bodyHash), filename)
+
+    def isCurrent(self, bodyHash):
+        """@return True when the resource was processed with the current widths and quality."""
+        info = self.info(bodyHash)
+        if info is None:
+            return False
+        if info['width'] is None:
+            # Not an image, whatever the settings.
+            return True
+        return info.get('widths') == list(self.widths) and info.get('quality') == self.quality
+
+    def info(self, bodyHash):
+        """
+        @return dict with the original's `width' and `height' and its
+            `variants' as a list of [width, height, filename, md5] (largest
+            last), or None when the resource hasn't been processed (yet).
+        """
+        h = hexHash(bodyHash)
+        if h not in self.infos:
+            try:
+                with open('{0}/{1}'.format(self.directory(h), INFO_FILENAME), 'r') as fh:
+                    self.infos[h] = simplejson.load(fh)
+            except (IOError, OSError):
+                return None
+        return self.infos[h]
+
+    def derive(self, bodyHash, sourcePath):
+        """
+        Make a WebP copy of an image at each configured width narrower than
+        the original, plus one at its full width.  Animated images are left
+        alone.
+
+        @return dict See `info', or None when the original is missing.
+        """
+        try:
+            fh = open(sourcePath, 'rb')
+        except (IOError, OSError):
+            # Processed again once the resource is stored.
+            logger.warn('resource %s is missing, not making derivatives of it', hexHash(bodyHash))
+            return None
+        info = {'width': None, 'height': None, 'variants': [], 'widths': list(self.widths), 'quality': self.quality}
+        with fh:
+            try:
+                image = Image.open(fh)
+                image.load()
+                animated = getattr(image, 'is_animated', False)
+            except Exception:
+                # Not an image (PDF, SVG, etc.) or not one Pillow can read.
+                image = None
+        if image is not None:
+            if not animated:
+                # Camera photos are commonly stored sideways with an EXIF
+                # orientation; the (tag-less) variants need to be upright.
+                try:
+                    image = ImageOps.exif_transpose(image)
+                except Exception:
+                    logger.warn('ignoring unreadable EXIF orientation of resource %s', hexHash(bodyHash))
+            info['width'], info['height'] = image.size
+            if not animated:
+                if image.mode not in ('RGB', 'RGBA'):
+                    image = image.convert('RGBA' if 'A' in image.mode or 'transparency' in image.info else 'RGB')
+                widths = [width for width in self.widths if width < image.width] + [image.width]
+                for width in widths:
+                    height = max(1, int(round(image.height * width / float(image.width))))
+                    variant = image if width == image.width else image.resize((width, height), Image.LANCZOS)
+                    filename = '{0}w.webp'.format(width)
+                    info['variants'].append([width, height, filename, self.save(bodyHash, filename, variant)])
+
+        # Written last, so an interrupted run gets the image processed again.
+        self.write(bodyHash, INFO_FILENAME, simplejson.dumps(info).encode('utf-8'))
+        self.infos[hexHash(bodyHash)] = info
+        self.removeStale(bodyHash, info)
+        return info
+
+    def removeStale(self, bodyHash, info):
+        """Remove variants made at widths no longer configured."""
+        keep = set(variant[2] for variant in info['variants'])
+        for path in glob.glob('{0}/*w.webp'.format(self.directory(bodyHash))):
+            if os.path.basename(path) not in keep:
+                os.remove(path)
+
+    def save(self, bodyHash, filename, image):
+        """@return str md5 of the encoded variant."""
+        buf = io.BytesIO()
+        image.save(buf, 'WEBP', quality=self.quality, method=4)
+        data = buf.getvalue()
+        self.write(bodyHash, filename, data)
+        return hashlib.md5(data).hexdigest()
+
+    def write(self, bodyHash, filename, data):
+        path = self.variantPath(bodyHash, filename)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmpPath = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(tmpPath, 'wb') as fh:
+            fh.write(data)
+        os.replace(tmpPath, path)
+
+    @staticmethod
+    def pool(jobs=None):
+        """
+        @return ProcessPoolExecutor for `deriveAll' to reuse across calls, its
+            workers started right away, before the caller starts any threads.
+        """
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs or defaultJobs())
+        executor.submit(os.getpid).result()
+        return executor
+
+    def deriveAll(self, hashes, jobs=None, executor=None):
+        """
+        Process those of the given resources which haven't been yet, across a
+        pool of worker processes.
+
+        @param hashes list Body hashes of the resources to consider.
+        @param jobs int Number of worker processes (defaults to IMAGE_DERIVATIVE_JOBS, or one per CPU).
+        @param executor Optional pool from `pool' (or any other) to process on, otherwise one is started for the call.
+        @return int Number of resources processed.
+        """
+        hashes = [h for h in map(hexHash, hashes) if not self.isCurrent(h)]
+        if not hashes:
+            return 0
+        jobs = jobs or defaultJobs()
+        logger.info('making image derivatives of %s resources', len(hashes))
+        with metrics.timer('phase', phase='derive'):
+            if executor is not None:
+                for numVariants in executor.map(_deriveWorker, hashes, chunksize=8):
+                    metrics.incr('image_derivatives', numVariants)
+            elif jobs > 1 and len(hashes) > 1:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+                    for numVariants in executor.map(_deriveWorker, hashes, chunksize=8):
+                        metrics.incr('image_derivatives', numVariants)
+            else:
+                for h in hashes:
+                    metrics.incr('image_derivatives', _deriveWorker(h))
+        # Processed by the workers, so what's cached here is out of date.
+        for h in hashes:
+            self.infos.pop(hexHash(h), None)
+        return len(hashes)
+
+def defaultJobs():
+    return getattr(settings, 'IMAGE_DERIVATIVE_JOBS', None) or os.cpu_count() or 1
+
+def _deriveWorker(h):
+    """@return int Number of variants made."""
+    info = DerivativeStore().derive(h, ResourceStore().path(h))
+    return len(info['variants']) if info is not None else 0
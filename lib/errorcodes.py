@@ -2,4 +2,5 @@
 
 ERR_MISSING_REQUIRED_PARAM = 1
 ERR_NOTEBOOK_NOT_FOUND = 2
+ERR_INVALID_PARAM = 3
 
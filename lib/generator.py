@@ -3,22 +3,37 @@
 """Note renderer."""
 
 import base64
+import collections
+import concurrent.futures
 import datetime
+import functools
 import glob
+import itertools
 import os
 import re
 import simplejson
-import shutil
+import time
 import unicodedata
 import urllib
 import uuid
 
 import bs4
 import jinja2
-import unidecode
 
+from . import derivatives
+from .layout import REDIRECT_MAP_PATH, OutputLayout
 from .logger import logger
-from .util import fileGetContents, safeUnicode
+from .manifest import BuildManifest, digest
+from .metrics import metrics
+from .noteindex import getNoteIndex
+from .pagination import Paginator, rootFor
+from .resources import ResourceStore, hexHash
+from .scrubber import getScrubber
+from .search import PREFIX_LENGTH, SearchIndex
+from .segments import apiJson, getSegmentStore
+from .tagindex import TagIndex
+from .writer import OutputWriter
+from .util import fileGetContents
 
 import settings
 
@@ -28,105 +43,127 @@ except ImportError:
     logger.warn('cPickle import failed, falling back to plain pickle')
     import pickle
 
-# CSS scrubber expressions.
-_evernoteBrokenCssFragments = (
-    r'position:(?:absolute|fixed);(?:top:-10000px;)?(?:height|width):[01]px;(?:width|height):[01]px',
-    r'overflow:hidden|position:fixed;top:0px;left:0px', # GitHub.
-    r'opacity:0',                                       # GitHub.
-    r'box-sizing:border-box;float:right',               # GitHub.
-    r'position:static;visibility:visible;width:61px;height:20px;', # GitHub/Twitter tweet button.
-    r'display:none !important',
-    r'(?:left|top):0px;(?:left|top):0px;width:100%;height:0px', # StackOverflow.
-    r'position:fixed;margin:0px;border:0px;padding:0px',        # StackOverflow.
-    r'rgb\(255, 255, 255\);position:fixed;left:0px;width:100%',                                                      # Quora.
-    r'float:left;height:16px;width:14px;',                                                                           # Quora.
-    r'display:table;width:100%;padding-left:88px;box-sizing:border-box',                                             # Quora.
-    r'z-index:800(?:[^"]*(?:background|color): *rgb\(255, *255, *255\))+',                                           # Quora.
-    r'filter:url\(http:\/\/gigaom.com\/wp-content\/themes\/vip\/gigaom5\/css\/img\/post-page-blur.svg#blur\);margin:0px;bottom:0px;-webkit-filter:blur\(5px\)',          # Gigaom.
-    r'left:0px;position:absolute;right:0px;background:rgb\(255, 255, 255\)',                                                                                             # Gigaom.
-    r'bottom:0px;left:0px;position:absolute;right:0px;top:0px;background:rgba\(0, 0, 0, 0.498039\)',                                                                     # Gigaom.
-    r'overflow-x:auto',   # Never good.
-    r'overflow-y:scroll', # Never good.
-    r'''height:12px;width:12px;background-image:url\(['"]?[^\)]*facebook\.com\/rsrc\.php[^\)]*\)''', # Facebook.
-    r'background:transparent;box-sizing:border-box;width:100%;left:0px;top:0px;height:75px;position:fixed;z-index:10101;display:block;vertical-align:baseline;', # LifeHacker.
-#:    r'color:rgb\(255, 255, 255\);position:fixed;left:0px;width:100%;min-height:53px;box-sizing:border-box;z-index:800;font-size:14px;top:0px',  # Quora.
-)
-evernoteStyleCleanerExpr = re.compile(r'([ \t\r\n]style[ \t\r\n]*=[ \t\r\n]*"[^"]*)(?:%s)([^"]*")' % r'|'.join(_evernoteBrokenCssFragments), re.I)
+TEMPLATES_PATH = 'templates'
+JINJA_CACHE_DIRNAME = '.jinjaCache'
+# Notes queued per render worker process.
+RENDER_QUEUE_DEPTH = 4
+
+enMediaExpr = re.compile(r'<en-media\b([^>]*?)\s*(?:/>|>\s*</en-media>)', re.I)
+enMediaHashExpr = re.compile(r'\bhash[ \t\r\n]*=[ \t\r\n]*"([0-9a-fA-F]+)"', re.I)
 
 jsonFilenameToPickleExpr = re.compile(r'^(.*)\.json$', re.I)
 jsonFilenameToPickle = lambda filename: jsonFilenameToPickleExpr.subn(r'\1.pickle', filename, 1)[0]
 
+def sourceDomainOf(sourceUrl):
+    if not sourceUrl:
+        return ''
+    return re.sub(r'^(?:(?:https?:)?//)?([^/]+).*$', r'\1', sourceUrl, re.I)
+
+def plainString(string):
+    return None if string is None else str(string)
+
+# Shared between notes, one per domain.
+@functools.lru_cache(maxsize=None)
+def domainTag(domain):
+    """
+    'Fake' tag with article source domain name, e.g.:
+    {"parentGuid": null, "guid": "fbc37285-2796-45a2-8199-abeb8b48905b", "updateSequenceNum": 2226, "name": "windows"}
+    """
+    return {
+        'parentGuid': None,
+        'guid': '%s' % (uuid.uuid3(uuid.NAMESPACE_DNS, 'foo.com'),),
+        'updateSequenceNum': -1,
+        'name': domain,
+    }
+
 class Note(object):
-    def __init__(self, data, obj, path, indicesOnly=False):
+    """
+    A collected note for rendering its node page.  Notes read from the
+    segment store come with their Evernote Note and content; for legacy data
+    files the pickled Evernote Note (resource metadata, source URL) is only
+    loaded on first use.  Either way the scrubbed content is computed on
+    first use.
+    """
+
+    def __init__(self, data, path, obj=None, rawContent=None):
+        """
+        @param data dict Note data, as stored by the collector.
+        @param path str Path of the note's (legacy) JSON data file, which also names it.
+        @param obj Evernote Note, or None to load it from the legacy pickle.
+        @param rawContent str ENML content, or None to decode it from data['b64Content'].
+        """
         self.data = data
-        self.obj = obj
-        self.createdTs = datetime.datetime.fromtimestamp(self.data['created'] / 1000.0)
         self.path = path
         self.jsonFileName = path[path.rindex('/') + 1:]
-        self.destinationFileName = '{0}/api/{1}'.format(settings.OUTPUT_PATH, self.jsonFileName)
         self.id = self.jsonFileName[0:self.jsonFileName.index('.')]
+        self.guid = data['guid']
+        self.created = data['created']
+        self.updated = data['updated']
+        self.deleted = data['deleted']
+        self.contentHash = data.get('b64ContentHash')
+        self.createdTs = datetime.datetime.fromtimestamp(self.created / 1000.0)
+        self.title = bs4.BeautifulSoup(data['title'], 'html.parser', from_encoding='iso8859-15').string
+        self._obj = obj
+        self._rawContent = rawContent
+        self._tags = None
+        self._content = None
 
-        self.content = base64.b64decode(self.data['b64Content']).decode('utf-8').replace('evernote', 'note')
-
-        if not indicesOnly:
-            # Cleanup Evernote's poor clipping CSS butchery.
-            last = ''
-            while last != self.content:
-                last = self.content
-                self.content = evernoteStyleCleanerExpr.sub(r'\1\2', self.content)
-
-        # print self.data.keys() #dir(self.data)
-        # print self.data['tagNames']
-
-        self.data['title'] = bs4.BeautifulSoup(self.data['title'], 'html.parser', from_encoding='iso8859-15').string
-
-        if 'tags' not in data:
-            data['tags'] = []
-
-        # Inject 'fake' tag with article source domain name.
-        # e.g.:
-        # {"parentGuid": null, "guid": "fbc37285-2796-45a2-8199-abeb8b48905b", "updateSequenceNum": 2226, "name": "windows"}
-        self.data['tags'] += [{
-            'parentGuid': None,
-            'guid': '%s' % (uuid.uuid3(uuid.NAMESPACE_DNS, 'foo.com'),),
-            'updateSequenceNum': -1,
-            'name': self.sourceDomain,
-        }]
+    @property
+    def obj(self):
+        """The unpickled Evernote Note."""
+        if self._obj is None:
+            with open(jsonFilenameToPickle(self.path), 'rb') as fh:
+                self._obj = pickle.load(fh, encoding='latin1')
+        return self._obj
 
-        #tagStrings = [tag['name'].encode('utf-8') for tag in self.data.get('tags', [])]
-        tagStrings = [('%s' % (tag['name'],)) for tag in self.data.get('tags', [])]
-        #self.data['urlencoded_query'] = urllib.parse.quote_plus('%s %s' % (self.data['title'].encode('utf-8'), ' '.join(tagStrings)))
-        self.data['urlencoded_query'] = urllib.parse.quote_plus('%s %s' % (('%s' % (self.data['title'],)), ' '.join(tagStrings)))
+    @property
+    def resources(self):
+        return self.obj.resources
 
-    def __getattr__(self, attr):
-        """Pass-through from self to `data` keys and then `object' attributes."""
-        if attr in self.__dict__:
-            return getattr(self, attr)
+    @property
+    def tags(self):
+        """Tag dicts, plus an injected 'fake' tag with the article source domain name."""
+        if self._tags is None:
+            self._tags = self.data.get('tags', []) + [domainTag(self.sourceDomain)]
+        return self._tags
 
-        if attr in self.data:
-            return self.data[attr]
+    @property
+    def urlencoded_query(self):
+        tagStrings = [('%s' % (tag['name'],)) for tag in self.tags]
+        return urllib.parse.quote_plus('%s %s' % (('%s' % (self.title,)), ' '.join(tagStrings)))
 
-        if hasattr(self.obj, attr):
-            return getattr(self.obj, attr)
+    @property
+    def content(self):
+        """Scrubbed content, computed on first access so unchanged notes don't pay for it."""
+        if self._content is None:
+            with metrics.timer('phase', phase='scrub'):
+                content = self.rawContent.replace('evernote', 'note')
+                # Cleanup Evernote's poor clipping CSS butchery.
+                self._content = getScrubber().scrubCached(content, self.guid)
+        return self._content
 
-        if hasattr(self.obj.attributes, attr):
-            return getattr(self.obj.attributes, attr)
+    @property
+    def rawContent(self):
+        if self._rawContent is None:
+            return base64.b64decode(self.data['b64Content']).decode('utf-8')
+        return self._rawContent
 
-        raise AttributeError("'Note' object has no attribute '{0}'".format(attr))
+    def apiJson(self):
+        """@return The note's JSON data file, as published under api/."""
+        if self._rawContent is None:
+            return fileGetContents(self.path, 'rb')
+        return apiJson(self.data, self._rawContent)
 
     @property
     def sourceUrl(self):
-        sourceUrl = self.sourceURL
-        if not sourceUrl:
+        attributes = self.obj.attributes
+        if attributes is None or not attributes.sourceURL:
             return ''
-        return sourceUrl
+        return attributes.sourceURL
 
     @property
     def sourceDomain(self):
-        if not self.sourceUrl:
-            return ''
-        domain = re.sub(r'^(?:(?:https?:)?//)?([^/]+).*$', r'\1', self.sourceUrl, re.I)
-        return domain
+        return sourceDomainOf(self.sourceUrl)
 
     @property
     def sourceDomainUrl(self):
@@ -146,6 +183,33 @@ class Note(object):
             out.append((resource, filename))
         return out
 
+    @staticmethod
+    def resourceBody(resource):
+        """Resource body, from the note itself for legacy pickles, otherwise from the resource store."""
+        if resource.data.body is not None:
+            return resource.data.body
+        return ResourceStore().get(resource.data.bodyHash)
+
+class NoteSummary(object):
+    """Just enough of a note, straight from the note index, to build listing and tag pages."""
+
+    __slots__ = ('id', 'guid', 'created', 'updated', 'deleted', 'contentHash', 'createdTs', 'title', 'sourceUrl', 'sourceDomain', 'tags', 'resourceHashes')
+
+    def __init__(self, row):
+        self.id = '%s' % (row['created'],)
+        self.guid = row['guid']
+        self.created = row['created']
+        self.updated = row['updated']
+        self.deleted = row['deleted']
+        self.contentHash = row['contentHash']
+        self.createdTs = datetime.datetime.fromtimestamp(row['created'] / 1000.0)
+        # n.b. A plain str, as a NavigableString would keep its whole parse tree alive.
+        self.title = plainString(bs4.BeautifulSoup(row['title'] or '', 'html.parser').string)
+        self.sourceUrl = row['sourceUrl'] or ''
+        self.sourceDomain = sourceDomainOf(self.sourceUrl)
+        self.tags = row['tags'] + [domainTag(self.sourceDomain)]
+        self.resourceHashes = row['resourceHashes']
+
 #def renderNote(fileName):
 #    """Render a single note."""
 #    with open(fileName, 'rb') as fh:
@@ -169,46 +233,137 @@ class Note(object):
 class HtmlGenerator(object):
     """Generate and render HTML output."""
 
-    def __init__(self):
-        """Prepare jinja2 template environment."""
-        self.assetsRelPubPath = '../assets'
-
-        def contentWithTranslatedAssets(note):
-            content = note.content
-            # Replace media objects in content with ones that actually exist :)
-            resourcesAndFilenames = list(note.resourceFilenameTuples())
-            i = 1
-            numAssets = len(resourcesAndFilenames)
-            for resource, filename in resourcesAndFilenames:
-                relPath = '%s/%s' % (self.assetsRelPubPath, filename)
-                filenameLower = filename.lower()
-                if filenameLower.endswith('.pdf'):
-                    replacementMarkup = '<a href="%s">View PDF: %s </a> (Asset %s/%s)' % (relPath, filename, i, numAssets)
-                elif filenameLower.endswith('.octet-stream') and (resource.data.body[0:3] == b'<svg' or resource.data.body[0:3] == '<svg' or resource.data.body[0:3] == b'<SVG' or resource.data.body[0:3] == '<SVG'):
-                    replacementMarkup = resource.data.body
-                else:
-                    replacementMarkup = '<a href="%s"><img src="%s" alt="Image (Asset %s/%s) alt="Image (Asset %s/%s)" /></a>' % (relPath, relPath, i, numAssets, i, numAssets)
-                content = re.subn(r'<en-media(?:[^\/]|\/[^>])+/>', replacementMarkup, content, 1)[0]
-                # TODO: investigate "recognition" later.  Looks like it is image OCR, pretty cool!.
-                #if resource.recognition:
-                #    content += resource.recognition.body
-                i += 1
-            return content
-        jinja2.filters.FILTERS['contentWithTranslatedAssets'] = contentWithTranslatedAssets
-
-        self.env = jinja2.environment.Environment()
-        self.templates = dict((name[10:], open(name, 'r').read()) for name in glob.glob('templates/*.html'))
-        self.env.loader = jinja2.DictLoader(self.templates)
-
-    def generateIndices(self):
+    def __init__(self, notebookGuids=None):
+        """
+        Prepare jinja2 template environment.
+
+        @param notebookGuids list Only publish notes from these notebooks (defaults to every collected notebook).
+        """
+        self.notebookGuids = notebookGuids
+        self.layout = OutputLayout()
+
+        # Template sources are still read for the build manifest's template
+        # hashes, but compiled templates come from a persistent bytecode cache.
+        self.templates = dict((name[10:], fileGetContents(name)) for name in glob.glob('{0}/*.html'.format(TEMPLATES_PATH)))
+        bytecodeCachePath = '{0}/{1}'.format(settings.DATA_PATH, JINJA_CACHE_DIRNAME)
+        if not os.path.exists(bytecodeCachePath):
+            os.makedirs(bytecodeCachePath, exist_ok=True)
+        self.env = jinja2.environment.Environment(
+            loader=jinja2.FileSystemLoader(TEMPLATES_PATH),
+            bytecode_cache=jinja2.FileSystemBytecodeCache(bytecodeCachePath),
+        )
+        self.env.filters['contentWithTranslatedAssets'] = self.contentWithTranslatedAssets
+        self.env.globals['nodePath'] = self.layout.nodePath
+        self.manifest = None
+        self.renderedIds = set()
+        self.searchIndex = None
+        self.paginator = Paginator()
+        self.writer = OutputWriter()
+        self.writer.load()
+        self.derivatives = derivatives.DerivativeStore() if derivatives.enabled() else None
+
+    def contentWithTranslatedAssets(self, note):
+        """
+        Replace media objects in content with ones that actually exist :)
+
+        Done in a single pass over the content, matching each <en-media> to its
+        resource by body hash and falling back to document order for any
+        without a recognizable hash.
+        """
+        resourcesAndFilenames = note.resourceFilenameTuples()
+        numAssets = len(resourcesAndFilenames)
+        byHash = {}
+        for i, (resource, filename) in enumerate(resourcesAndFilenames):
+            if resource.data is not None and resource.data.bodyHash is not None:
+                byHash.setdefault(hexHash(resource.data.bodyHash).lower(), i)
+        position = [0]
+
+        def replace(match):
+            hashMatch = enMediaHashExpr.search(match.group(1))
+            i = byHash.get(hashMatch.group(1).lower()) if hashMatch else None
+            if i is None:
+                i = position[0]
+            position[0] += 1
+            if i >= numAssets:
+                return match.group(0)
+            resource, filename = resourcesAndFilenames[i]
+            return self.assetMarkup(note, resource, filename, i + 1, numAssets)
+
+        # TODO: investigate "recognition" later.  Looks like it is image OCR, pretty cool!.
+        #if resource.recognition:
+        #    content += resource.recognition.body
+        content = note.content
+        with metrics.timer('phase', phase='translate_assets'):
+            return enMediaExpr.sub(replace, content)
+
+    def assetMarkup(self, note, resource, filename, i, numAssets):
+        """@return str Markup standing in for the i'th of a note's numAssets resources."""
+        relPath = self.assetHref(note, filename)
+        filenameLower = filename.lower()
+        info = self.derivatives.info(resource.data.bodyHash) if self.derivatives is not None and resource.data is not None else None
+        if info and info['variants']:
+            return self.responsiveImageMarkup(note, filename, info, i, numAssets)
+        if filenameLower.endswith('.pdf'):
+            return '<a href="%s">View PDF: %s </a> (Asset %s/%s)' % (relPath, filename, i, numAssets)
+        if filenameLower.endswith('.octet-stream'):
+            body = note.resourceBody(resource)
+            if body[0:4] in (b'<svg', '<svg', b'<SVG', '<SVG'):
+                # Inline SVG.
+                return body.decode('utf-8', 'replace') if isinstance(body, bytes) else body
+        return '<a href="%s"><img src="%s" alt="Image (Asset %s/%s) alt="Image (Asset %s/%s)" /></a>' % (relPath, relPath, i, numAssets, i, numAssets)
+
+    def assetHref(self, note, filename):
+        """@return str Link to an asset from the note's node page."""
+        return rootFor(self.layout.nodePath(note.id)) + self.layout.assetPath(filename)
+
+    def responsiveImageMarkup(self, note, filename, info, i, numAssets):
+        """Lazily loaded <img> offering each derivative in a srcset, still linking to the original."""
+        srcset = ', '.join('%s %sw' % (self.assetHref(note, self.derivativeFilename(filename, variant)), variant[0]) for variant in info['variants'])
+        largest = info['variants'][-1]
+        return '<a href="%s"><img src="%s" srcset="%s" sizes="(max-width: %spx) 100vw, %spx" width="%s" height="%s" loading="lazy" alt="Image (Asset %s/%s)" /></a>' % (
+            self.assetHref(note, filename),
+            self.assetHref(note, self.derivativeFilename(filename, largest)),
+            srcset,
+            largest[0],
+            largest[0],
+            info['width'],
+            info['height'],
+            i,
+            numAssets,
+        )
+
+    @staticmethod
+    def derivativeFilename(filename, variant):
+        """e.g. `<guid>-0.png' -> `<guid>-0-960w.webp'."""
+        return '%s-%s' % (filename.rsplit('.', 1)[0], variant[2])
+
+    def generateIndices(self, full=False):
         """Indices only."""
         if os.environ.get('ONLY_NODE_ID'):
             raise Exception('ONLY_NODE_ID env var not compatible with generate-indices')
-        notes = self.getNotes(indicesOnly=True)
+        if not os.path.exists(settings.OUTPUT_PATH + '/tag'):
+            os.makedirs(settings.OUTPUT_PATH + '/tag')
+        self.loadManifest(full)
+        notes = self.getNoteSummaries()
         self.makeTags(notes)
-
-    def generate(self):
-        """Read and render Note data."""
+        self.makeSearchIndex(notes, full)
+        self.saveManifest()
+        self.writer.finish(removeStale=False)
+
+    def generate(self, full=False, jobs=1):
+        """
+        Read and render Note data.
+
+        @param full bool When True, ignore the build manifest and re-render everything.
+        @param jobs int Number of worker processes to render node pages with.
+        """
+        self.prepareOutput()
+        self.loadManifest(full)
+        summaries = self.getNoteSummaries()
+        self.makeChangedNotes(summaries, jobs)
+        self.finish(summaries, full)
+
+    def prepareOutput(self):
         if not os.path.exists(settings.OUTPUT_PATH + '/api'):
             os.makedirs(settings.OUTPUT_PATH + '/api')
         if not os.path.exists(settings.OUTPUT_PATH + '/node'):
@@ -216,126 +371,299 @@ class HtmlGenerator(object):
         if not os.path.exists(settings.OUTPUT_PATH + '/tag'):
             os.makedirs(settings.OUTPUT_PATH + '/tag')
 
-        listing = []
-        dataFiles = glob.iglob('{0}/*.json'.format(settings.DATA_PATH))
-
-        notes = self.getNotes()
-
+    def makeChangedNotes(self, summaries, jobs=1, executor=None, deriveExecutor=None):
+        """
+        Render the node pages of notes whose inputs changed since they were
+        last rendered.  Called more than once per build when node pages are
+        rendered while notes are still being collected (see `lib.pipeline').
+
+        @param summaries list of NoteSummary
+        @param executor Optional pool from `renderPool' to render on when jobs > 1.
+        @param deriveExecutor Optional pool to make the image derivatives of
+            these notes' resources on (see `derivePool'), otherwise they're
+            made on a pool of their own.
+        @return int Number of notes rendered.
+        """
         onlyNodeId = os.environ.get('ONLY_NODE_ID')
-        for note in notes:
-            if onlyNodeId and onlyNodeId not in note.path:
+        templateHash = self.templateHash('node.html')
+        changed = []
+        for summary in summaries:
+            if onlyNodeId and onlyNodeId not in summary.id:
                 continue
-            shutil.copyfile(note.path, note.destinationFileName)
-
-        self.makeIndex(notes)
-
-        list(map(self.makeNote, notes))
-
-        self.makeTags(notes)
-
-        #serializedDataFiles = glob.iglob('{0}/*.pickle'.format(settings.DATA_PATH))
-        #for fileName in serializedDataFiles:
-        #    renderNote(fileName)
-
-    def getNotes(self, indicesOnly=False):
-        listing = []
-        dataFiles = glob.iglob('{0}/*.json'.format(settings.DATA_PATH))
-
-        # environment-variable based override for development/testing purposes.
-        for path in dataFiles:
-            with open(path, 'r') as fh:
-                data = simplejson.load(fh)
-
-            with open(jsonFilenameToPickle(path), 'rb') as fh:
-                obj = pickle.load(fh, encoding='latin1')
-
-            note = Note(data, obj, path, indicesOnly)
-            listing.append(note)
-
-        notes = sorted(
-            filter(
-                lambda note: note.deleted is not True,
-                listing,
-            ),
-            key=lambda note: note.createdTs,
-            reverse=True,
-        )
+            entry = BuildManifest.noteEntry(summary, templateHash)
+            targetFiles = (self.layout.nodePath(summary.id), self.layout.apiPath(summary.id))
+            if not self.manifest.noteChanged(summary, entry, targetFiles):
+                if summary.id in self.renderedIds:
+                    # Already rendered earlier in this build.
+                    continue
+                self.manifest.skipped += 1
+                metrics.incr('pages_skipped')
+                self.writer.keepOwned(summary.id)
+                continue
+            changed.append((summary, entry))
+
+        if self.derivatives is not None and changed:
+            self.derivatives.deriveAll(self.resourceHashes(summary for summary, _ in changed), executor=deriveExecutor)
+
+        if jobs > 1 and len(changed) > 1:
+            self.makeNotesInParallel([summary for summary, _ in changed], jobs, executor)
+        else:
+            for summary, _ in changed:
+                self.makeNote(self.loadNote(summary.created))
+        for summary, entry in changed:
+            self.manifest.recordNote(summary, entry)
+            self.renderedIds.add(summary.id)
+        return len(changed)
+
+    def finish(self, summaries, full=False):
+        """Once every node page is written: the listing, tag and search pages, then the build state."""
+        onlyNodeId = os.environ.get('ONLY_NODE_ID')
+        self.makeIndex(summaries)
+        self.makeTags(summaries)
+        self.makeSearchIndex(summaries, full)
+        if self.layout.sharded and self.layout.redirects == 'map':
+            self.writer.write(REDIRECT_MAP_PATH, self.layout.redirectMap(summary.id for summary in summaries))
 
-        return notes
+        if not onlyNodeId:
+            self.manifest.prune(summaries)
+        self.saveManifest()
+        self.writer.finish(removeStale=not onlyNodeId)
 
     @staticmethod
-    def arrangeNotesByTag(notes):
-        byTag = {}
-
-        for note in notes:
-            if hasattr(note, 'tags'):
-                for tag in note.tags:
-                    tag['name'] = unidecode.unidecode(safeUnicode(tag['name'].lower()))
-                    if tag['name'] not in byTag:
-                        byTag[tag['name']] = tag
-                        byTag[tag['name']]['notes'] = []
-                    byTag[tag['name']]['notes'].append(note)
-
-        for tagName in byTag:
-            byTag[tagName]['notes'] = sorted(byTag[tagName]['notes'], key=lambda note: note.createdTs, reverse=True)
-
-        return byTag
+    def renderPool(jobs):
+        """
+        @return ProcessPoolExecutor of node page workers, for `makeNotesInParallel'
+            to reuse across batches.  The workers are started right away, before
+            the caller goes on to start any threads of its own.
+        """
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=_initRenderWorker)
+        executor.submit(os.getpid).result()
+        return executor
+
+    def derivePool(self, renderPool=None):
+        """
+        @return Pool for `makeChangedNotes' to make image derivatives on (the
+            render pool, if there is one), or None when they're disabled.
+            Like `renderPool', it has to be made before any other threads.
+        """
+        if self.derivatives is None:
+            return None
+        return renderPool or self.derivatives.pool()
 
-    def notesByTag(self, notes, order='asc'):
-        """@return list of tags, each tag includes notes."""
-        byTag = self.arrangeNotesByTag(notes)
-
-        values = sorted(list(byTag.values()), key=lambda tag: tag['name'], reverse=order == 'desc')
-
-        return values
+    @staticmethod
+    def resourceHashes(summaries):
+        """@return list of the body hashes of these notes' resources, as listed in the note index."""
+        return sorted(set(h for summary in summaries for h in summary.resourceHashes))
+
+    def makeNotesInParallel(self, notes, jobs, executor=None):
+        """
+        Render node pages and dump their assets across a pool of worker
+        processes.  Each worker loads its note from disk rather than having
+        the (potentially huge) Note objects pickled over to it.
+
+        @param notes list of NoteSummary
+        @param executor Optional pool from `renderPool', otherwise one is started for the call.
+        """
+        if executor is None:
+            with self.renderPool(jobs) as executor:
+                return self.makeNotesInParallel(notes, jobs, executor)
+        logger.info('rendering %s notes with %s worker processes', len(notes), jobs)
+
+        timings = {}
+        # Only a few notes per worker are in flight at once, so neither the
+        # queued work nor the finished results grow with the archive.
+        queue = iter(notes)
+        futures = collections.deque()
+        for note in itertools.islice(queue, jobs * RENDER_QUEUE_DEPTH):
+            futures.append((note, executor.submit(_renderNoteWorker, note.created)))
+        while futures:
+            note, future = futures.popleft()
+            try:
+                pid, elapsed, writes, workerMetrics = future.result()
+            except Exception:
+                logger.error('rendering failed for note=%s', note.id)
+                for _, pending in futures:
+                    pending.cancel()
+                raise
+            for nextNote in itertools.islice(queue, 1):
+                futures.append((nextNote, executor.submit(_renderNoteWorker, nextNote.created)))
+            self.writer.merge(writes)
+            metrics.merge(workerMetrics)
+            count, total = timings.get(pid, (0, 0.0))
+            timings[pid] = (count + 1, total + elapsed)
+
+        for pid, (count, total) in sorted(timings.items()):
+            logger.info('worker pid=%s rendered %s notes in %.2fs (%.1fms/note)', pid, count, total, 1000.0 * total / count)
+        if self.manifest is not None:
+            self.manifest.rendered += len(notes)
+
+    def loadManifest(self, full):
+        self.manifest = BuildManifest()
+        # Ids of notes rendered so far in this build.
+        self.renderedIds = set()
+        self.searchIndex = None
+        if full:
+            logger.info('full rebuild requested, ignoring build manifest')
+        else:
+            self.manifest.load()
+
+    def saveManifest(self):
+        self.manifest.save()
+        logger.info('rendered %s pages, skipped %s unchanged', self.manifest.rendered, self.manifest.skipped)
+
+    def templateHash(self, template):
+        """Digest of a template's source along with the base template it extends."""
+        if self.writer.precompress:
+            # So turning precompression on re-renders pages which lack compressed siblings.
+            return digest(self.templates[template], self.templates['base.html'], 'precompress', self.derivativesSignature(), self.layout.signature())
+        return digest(self.templates[template], self.templates['base.html'], self.derivativesSignature(), self.layout.signature())
+
+    def derivativesSignature(self):
+        """So toggling or reconfiguring image derivatives re-renders pages."""
+        if self.derivatives is None:
+            return None
+        return ['derivatives', self.derivatives.widths, self.derivatives.quality]
+
+    def getNoteSummaries(self, createds=None):
+        """
+        The first, lightweight pass of a build: the sort keys, titles and tags
+        of every note, straight from the note index and without touching any
+        per-note files.  Notes are then loaded, rendered and released one at
+        a time.
+
+        @param createds list Only these notes (defaults to every note being published).
+        @return list of NoteSummary, newest-created first.
+        """
+        # Notes share one dict per distinct tag rather than each holding its own copies.
+        sharedTags = {}
+        summaries = []
+        for row in getNoteIndex().notes(self.notebookGuids, createds):
+            if row['deleted'] is True:
+                continue
+            row['tags'] = [sharedTags.setdefault(tuple(sorted(tag.items())), tag) for tag in row['tags']]
+            summaries.append(NoteSummary(row))
+        return summaries
 
-    def notesByTagFrequency(self, notes, order='asc'):
-        """@return list of tags, each tag includes notes."""
-        byTag = self.arrangeNotesByTag(notes)
+    @staticmethod
+    def loadNote(created):
+        """Load a Note from the segment store, falling back to its legacy JSON data file (and, on demand, pickle)."""
+        path = '{0}/{1}.json'.format(settings.DATA_PATH, created)
+        stored = getSegmentStore().get(created)
+        if stored is not None:
+            data, obj, rawContent = stored
+            return Note(data, path, obj=obj, rawContent=rawContent)
 
-        values = sorted(list(byTag.values()), key=lambda tag: tag['name'])
-        values = sorted(values, key=lambda tag: len(byTag[tag['name']]['notes']), reverse=order == 'desc')
+        with open(path, 'r') as fh:
+            data = simplejson.load(fh)
 
-        return values
+        return Note(data, path)
 
     def makeTags(self, notes):
-        """Create tags index."""
-        tagsAsc = self.notesByTag(notes)
+        """Create tag pages and the tag indices, all from one TagIndex."""
+        tagIndex = TagIndex(notes)
 
-        for tag in tagsAsc:
-            self.render('tag.html', 'tag/{0}.html'.format(tag['name']), **{'tag': tag})
+        templateHash = self.templateHash('tag.html')
+        for tag in tagIndex.nameAsc:
+            for page in self.paginator.pages(tag.notes, 'tag/{0}.html'.format(tag.name), 'tag/{0}'.format(tag.name)):
+                signature = digest(templateHash, page.newer, page.older, [(note.id, note.title) for note in page.notes])
+                self.renderIfChanged('tag.html', page.path, signature, **{'tag': tag, 'page': page})
 
         tagIndices = {
-            'tag/index.html': tagsAsc,
-            'tag/by-tag-desc.html': self.notesByTag(notes, order='desc'),
-            'tag/by-frequency-asc.html': self.notesByTagFrequency(notes),
-            'tag/by-frequency-desc.html': self.notesByTagFrequency(notes, order='desc'),
+            'tag/index.html': tagIndex.nameAsc,
+            'tag/by-tag-desc.html': tagIndex.nameDesc,
+            'tag/by-frequency-asc.html': tagIndex.frequencyAsc,
+            'tag/by-frequency-desc.html': tagIndex.frequencyDesc,
         }
 
+        templateHash = self.templateHash('tagIndex.html')
         for filePath, tags in list(tagIndices.items()):
-            self.render('tagIndex.html', filePath, **{'tags': tags, 'filePath': filePath})
+            signature = digest(templateHash, [(tag.name, len(tag.notes)) for tag in tags])
+            self.renderIfChanged('tagIndex.html', filePath, signature, **{'tags': tags, 'filePath': filePath})
+
+    def openSearchIndex(self, full=False):
+        """@return SearchIndex for this build, discarding the stored postings on its first use in a full build."""
+        if self.searchIndex is None:
+            self.searchIndex = SearchIndex(self.writer, layout=self.layout)
+            if full:
+                self.searchIndex.reset()
+        return self.searchIndex
+
+    def indexNotes(self, notes, full=False):
+        """Bring the search postings of some notes up to date ahead of `makeSearchIndex'."""
+        self.openSearchIndex(full).update(notes, lambda summary: self.loadNote(summary.created).content, version=getScrubber().version)
+
+    def makeSearchIndex(self, notes, full=False):
+        """Update the sharded search index along with the search page which queries it."""
+        searchIndex = self.openSearchIndex(full)
+        searchIndex.build(notes, lambda summary: self.loadNote(summary.created).content, version=getScrubber().version)
+        self.renderIfChanged('search.html', 'search.html', digest(self.templateHash('search.html'), PREFIX_LENGTH, searchIndex.docShards), **{'prefixLength': PREFIX_LENGTH, 'docShards': searchIndex.docShards, 'sharded': self.layout.sharded})
 
     def makeNote(self, note):
-        """Render and write out note."""
-        self.render('node.html', 'node/{0}.html'.format(note.id), **{'note': note})
+        """Render and write out note, along with a copy of its JSON data for the API."""
+        self.writer.write(self.layout.apiPath(note.id), note.apiJson(), owner=note.id)
+        nodePath = self.layout.nodePath(note.id)
+        self.render('node.html', nodePath, **{'note': note, 'root': rootFor(nodePath)})
+        stubPath = self.layout.stubPath(note.id)
+        if stubPath is not None:
+            # Keeps the note's flat URL working.
+            self.writer.write(stubPath, self.layout.stub(note.id), owner=note.id)
+        metrics.incr('notes_rendered')
 
     def makeIndex(self, notes):
-        """Create and write out static index."""
-        self.render('noteIndex.html', 'index.html', **{'notes': notes})
+        """Create and write out the static index, paginated per PAGINATE_BY."""
+        templateHash = self.templateHash('noteIndex.html')
+        for page in self.paginator.pages(notes, 'index.html', 'page'):
+            signature = digest(templateHash, page.newer, page.older, [(note.id, note.created, note.title) for note in page.notes])
+            self.renderIfChanged('noteIndex.html', page.path, signature, **{'notes': page.notes, 'page': page})
+
+    def renderIfChanged(self, template, targetFile, signature, **kw):
+        """Render unless the manifest shows the page was already rendered from identical inputs."""
+        if not self.manifest.pageChanged(targetFile, signature):
+            self.manifest.skipped += 1
+            metrics.incr('pages_skipped')
+            self.writer.keep(targetFile)
+            return
+        self.render(template, targetFile, **kw)
+        self.manifest.recordPage(targetFile, signature)
 
     def render(self, template, targetFile, **kw):
         """Render a template and dump corresponding assets."""
         t = self.env.get_template(template)
         if 'note' in kw:
             self.dumpAssets(kw['note'])
-        rendered = t.render(**kw)
-        with open('{0}/{1}'.format(settings.OUTPUT_PATH, targetFile), 'wb') as fh:
-            fh.write(rendered.encode('utf-8'))
+            # Scrub up front so it is timed as its own phase rather than as part of rendering.
+            kw['note'].content
+        with metrics.timer('phase', phase='render'):
+            rendered = t.render(**kw)
+        metrics.incr('pages_rendered')
+        self.writer.write(targetFile, rendered, owner=kw['note'].id if 'note' in kw else None)
+        if self.manifest is not None:
+            self.manifest.rendered += 1
 
     def dumpAssets(self, note):
-        assetsPath = settings.OUTPUT_PATH + '/assets'
-        if not os.path.exists(assetsPath):
-            os.makedirs(assetsPath)
+        resourceStore = ResourceStore()
         for resource, filename in note.resourceFilenameTuples():
-            with open('%s/%s' % (assetsPath, filename), 'w' if type(resource.data.body) is str else 'wb') as fh:
-                fh.write(resource.data.body)
+            relPath = self.layout.assetPath(filename)
+            info = self.derivatives.info(resource.data.bodyHash) if self.derivatives is not None else None
+            for variant in info['variants'] if info else []:
+                derivativePath = self.layout.assetPath(self.derivativeFilename(filename, variant))
+                self.writer.link(derivativePath, self.derivatives.variantPath(resource.data.bodyHash, variant[2]), variant[3], owner=note.id)
+            if resource.data.body is None:
+                self.writer.link(relPath, resourceStore.path(resource.data.bodyHash), hexHash(resource.data.bodyHash), owner=note.id)
+                continue
+            self.writer.write(relPath, resource.data.body, owner=note.id)
+
+# Per-process generator used by `HtmlGenerator.makeNotesInParallel' workers.
+_workerGenerator = None
+
+def _initRenderWorker():
+    global _workerGenerator
+    # Forked workers inherit whatever the parent recorded so far; only report their own.
+    metrics.drain()
+    _workerGenerator = HtmlGenerator()
+
+def _renderNoteWorker(created):
+    """@return tuple of (worker pid, seconds spent loading and rendering the note, writes to merge, metrics to merge)."""
+    start = time.time()
+    _workerGenerator.makeNote(HtmlGenerator.loadNote(created))
+    return os.getpid(), time.time() - start, _workerGenerator.writer.drain(), metrics.drain()
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+"""
+Where node pages, API files and assets go under OUTPUT_PATH.  Besides the
+original flat `node/', `api/' and `assets/' directories, very large archives
+can shard them so no directory holds more than a few thousand files:
+
+    flat    node/<id>.html            api/<id>.json            assets/<guid>-0.png
+    date    node/2024/06/<id>.html    api/2024/06/<id>.json    assets/ab/cd/<guid>-0.png
+    hash    node/3f/a2/<id>.html      api/3f/a2/<id>.json      assets/ab/cd/<guid>-0.png
+
+Assets are always sharded by the first characters of their file name (the
+owning note's guid), so a note's resources and image derivatives stay
+together.
+"""
+
+import datetime
+import hashlib
+import os
+
+from .logger import logger
+from .pagination import relativeHref
+
+import settings
+
+LAYOUTS = ('flat', 'date', 'hash')
+# How the flat URLs of a sharded layout keep working: None, `map' (a
+# `redirects.map' file of old and new paths for the web server) or `stubs'
+# (a tiny page at each old node URL redirecting to the new one).
+REDIRECTS = (None, 'map', 'stubs')
+REDIRECT_MAP_PATH = 'redirects.map'
+# Siblings written alongside outputs by `OutputWriter' when precompressing.
+COMPRESSED_SUFFIXES = ('.gz', '.br')
+
+STUB_TEMPLATE = '''<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>Moved</title>
+<link rel="canonical" href="{0}">
+<meta http-equiv="refresh" content="0; url={0}">
+</head>
+<body><a href="{0}">This note has moved.</a></body>
+</html>
+'''
+
+def hashShard(name):
+    h = hashlib.md5(name.encode('utf-8')).hexdigest()
+    return '{0}/{1}'.format(h[0:2], h[2:4])
+
+class OutputLayout(object):
+    """Output paths, relative to OUTPUT_PATH, per OUTPUT_LAYOUT."""
+
+    def __init__(self, name=None, redirects=None):
+        self.name = name or getattr(settings, 'OUTPUT_LAYOUT', None) or 'flat'
+        self.redirects = redirects or getattr(settings, 'OUTPUT_LAYOUT_REDIRECTS', None)
+        if self.name not in LAYOUTS:
+            raise ValueError('unsupported output layout "{0}", expected one of: {1}'.format(self.name, ', '.join(LAYOUTS)))
+        if self.redirects not in REDIRECTS:
+            raise ValueError('unsupported output layout redirects "{0}", expected one of: map, stubs'.format(self.redirects))
+
+    @property
+    def sharded(self):
+        return self.name != 'flat'
+
+    def signature(self):
+        """So switching layouts re-renders every page linking to a note."""
+        if not self.sharded:
+            return None
+        return ['layout', self.name, self.redirects]
+
+    def noteShard(self, noteId):
+        if self.name == 'date':
+            try:
+                createdTs = datetime.datetime.fromtimestamp(int(noteId) / 1000.0, datetime.timezone.utc)
+            except ValueError:
+                # Not a `created' stamp.
+                return hashShard(noteId)
+            return createdTs.strftime('%Y/%m')
+        return hashShard(noteId)
+
+    def notePath(self, directory, fileName, noteId):
+        if not self.sharded:
+            return '{0}/{1}'.format(directory, fileName)
+        return '{0}/{1}/{2}'.format(directory, self.noteShard(noteId), fileName)
+
+    def nodePath(self, noteId):
+        """e.g. `node/2024/06/1718000000000.html'."""
+        return self.notePath('node', '{0}.html'.format(noteId), noteId)
+
+    def apiPath(self, noteId):
+        return self.notePath('api', '{0}.json'.format(noteId), noteId)
+
+    def assetPath(self, fileName):
+        """e.g. `assets/ab/cd/abcd1234-...-0.png'."""
+        if not self.sharded:
+            return 'assets/{0}'.format(fileName)
+        return 'assets/{0}/{1}/{2}'.format(fileName[0:2], fileName[2:4], fileName)
+
+    def relocate(self, relPath):
+        """@return str Where this layout puts a node page, API file or asset (or its compressed sibling) found at relPath."""
+        base, suffix = relPath, ''
+        if relPath.endswith(COMPRESSED_SUFFIXES):
+            base, suffix = relPath[:-3], relPath[-3:]
+        top = base.split('/', 1)[0]
+        fileName = os.path.basename(base)
+        if top == 'node' and fileName.endswith('.html'):
+            return self.nodePath(fileName[:-5]) + suffix
+        if top == 'api' and fileName.endswith('.json'):
+            return self.apiPath(fileName[:-5]) + suffix
+        if top == 'assets':
+            return self.assetPath(fileName) + suffix
+        return relPath
+
+    def stubPath(self, noteId):
+        """@return str The flat URL of a note's node page, when stubs are to be written there."""
+        if not self.sharded or self.redirects != 'stubs':
+            return None
+        return 'node/{0}.html'.format(noteId)
+
+    def stub(self, noteId):
+        """@return str Page for a note's flat URL, redirecting to its node page."""
+        return STUB_TEMPLATE.format(relativeHref(self.stubPath(noteId), self.nodePath(noteId)))
+
+    def redirectMap(self, noteIds):
+        """
+        @return str `old new' path pairs, one per line, for the flat URLs of
+            node pages and API files.  Assets move by a fixed rule the web
+            server can apply itself: `assets/abcd...' -> `assets/ab/cd/abcd...'.
+        """
+        lines = []
+        for noteId in noteIds:
+            lines.append('node/{0}.html {1}\n'.format(noteId, self.nodePath(noteId)))
+            lines.append('api/{0}.json {1}\n'.format(noteId, self.apiPath(noteId)))
+        return ''.join(lines)
+
+    def migrate(self, writer):
+        """
+        Move the node pages, API files and assets of an existing output tree
+        to where this layout puts them, carrying their output state along so
+        the next build doesn't write them all over again.  Node pages link
+        relative to where they are, so that build still re-renders them.
+
+        @param writer OutputWriter for the tree, with its state loaded.
+        @return int Number of files moved.
+        """
+        relPaths = []
+        for top in ('node', 'api', 'assets'):
+            for directory, _, fileNames in os.walk('{0}/{1}'.format(writer.root, top)):
+                relPaths.extend(os.path.relpath(os.path.join(directory, fileName), writer.root) for fileName in fileNames if not fileName.endswith('.tmp'))
+
+        state = dict(writer.previous)
+        moved = 0
+        for relPath in relPaths:
+            target = self.relocate(relPath)
+            targetPath = '{0}/{1}'.format(writer.root, target)
+            if target == relPath or os.path.exists(targetPath):
+                continue
+            if not os.path.exists(os.path.dirname(targetPath)):
+                os.makedirs(os.path.dirname(targetPath), exist_ok=True)
+            os.replace('{0}/{1}'.format(writer.root, relPath), targetPath)
+            writer.removeEmptyParents(relPath)
+            if relPath in state:
+                state[target] = state.pop(relPath)
+            moved += 1
+
+        writer.setPrevious(state)
+        writer.saveState()
+        logger.info('moved %s of %s output files into the %s layout', moved, len(relPaths), self.name)
+        return moved
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import os
+
+import settings
 
 logger = logging.getLogger(__name__)
 handler = logging.StreamHandler()
@@ -8,5 +11,5 @@ formatter = logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message
 
 handler.setFormatter(formatter)
 logger.addHandler(handler)
-logger.setLevel(logging.DEBUG)
-
+# LOG_LEVEL env var, then setting; `app.py --log-level' overrides both.
+logger.setLevel(os.environ.get('LOG_LEVEL') or getattr(settings, 'LOG_LEVEL', 'INFO'))
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+"""Build manifest used to skip re-rendering unchanged output."""
+
+import hashlib
+import os
+import simplejson
+
+from .logger import logger
+from .util import buildStatePath
+
+import settings
+
+MANIFEST_FILENAME = '.buildManifest.json'
+
+def digest(*parts):
+    """Stable sha1 hex digest of arbitrary JSON-serializable parts."""
+    return hashlib.sha1(simplejson.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+class BuildManifest(object):
+    """
+    Records, per note id and per output page, the inputs the output was last
+    rendered from.  Anything whose inputs are unchanged and whose output still
+    exists on disk is skipped.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or buildStatePath(MANIFEST_FILENAME)
+        self.notes = {}
+        self.pages = {}
+        self.rendered = 0
+        self.skipped = 0
+
+    def load(self):
+        """Load the previous build's manifest, if any."""
+        try:
+            with open(self.path, 'r') as fh:
+                data = simplejson.load(fh)
+            self.notes = data.get('notes', {})
+            self.pages = data.get('pages', {})
+        except (IOError, OSError):
+            logger.info('no pre-existing build manifest found, doing a full build')
+        except simplejson.errors.JSONDecodeError:
+            logger.exception('build manifest %s is corrupted, doing a full build', self.path)
+
+    def save(self):
+        """Atomically persist the manifest."""
+        tmpPath = '{0}.tmp'.format(self.path)
+        with open(tmpPath, 'w') as fh:
+            simplejson.dump({'notes': self.notes, 'pages': self.pages}, fh)
+        os.rename(tmpPath, self.path)
+
+    @staticmethod
+    def noteEntry(note, templateHash):
+        """@return dict describing every input a note's node page depends on."""
+        return {
+            'updated': note.updated,
+            'contentHash': note.contentHash,
+            'tags': sorted(('%s' % (tag['name'],)) for tag in note.tags),
+            'templates': templateHash,
+        }
+
+    @staticmethod
+    def outputExists(targetFile):
+        return os.path.exists('{0}/{1}'.format(settings.OUTPUT_PATH, targetFile))
+
+    def noteChanged(self, note, entry, targetFiles):
+        """@return True when the note's entry differs or any of its outputs are missing."""
+        if self.notes.get(note.id) != entry:
+            return True
+        return not all(map(self.outputExists, targetFiles))
+
+    def recordNote(self, note, entry):
+        self.notes[note.id] = entry
+
+    def pageChanged(self, targetFile, signature):
+        return self.pages.get(targetFile) != signature or not self.outputExists(targetFile)
+
+    def recordPage(self, targetFile, signature):
+        self.pages[targetFile] = signature
+
+    def prune(self, notes):
+        """Forget notes which no longer exist (or have been deleted)."""
+        ids = set(note.id for note in notes)
+        for noteId in list(self.notes.keys()):
+            if noteId not in ids:
+                del self.notes[noteId]
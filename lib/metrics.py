@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+"""
+Run metrics: counters and timers, labelled like Prometheus series, reported
+at the end of each `app.py' action as JSON and as a node_exporter textfile.
+
+    from .metrics import metrics
+
+    metrics.incr('notes_fetched')
+    with metrics.timer('phase', phase='render'):
+        ...
+"""
+
+import contextlib
+import os
+import resource
+import simplejson
+import sys
+import threading
+import time
+
+import settings
+
+PREFIX = 'evernote_publisher'
+
+DESCRIPTIONS = {
+    'runs': 'Runs of the action, by outcome (ok or error).',
+    'api_calls': 'Evernote API calls, by method.',
+    'api_errors': 'Evernote API calls which raised, by method.',
+    'api_rate_limited': 'Evernote API calls rejected with RATE_LIMIT_REACHED, by method.',
+    'api_call': 'Time spent in Evernote API calls, by method.',
+    'notes_fetched': 'Notes downloaded from Evernote.',
+    'notes_skipped': 'Notes already up to date locally.',
+    'notes_rendered': 'Note pages rendered.',
+    'pages_rendered': 'Pages rendered, including node pages.',
+    'pages_skipped': 'Pages and notes skipped as unchanged since the last build.',
+    'bytes_downloaded': 'Note content and resource bytes downloaded.',
+    'bytes_written': 'Bytes written under OUTPUT_PATH.',
+    'files_written': 'Files written under OUTPUT_PATH.',
+    'files_unchanged': 'Writes skipped because identical content was already on disk.',
+    'image_derivatives': 'Resized image variants made from resources.',
+    'phase': 'Time spent per phase (derive, scrub, translate_assets, render, write); render includes translate_assets.',
+}
+
+def labelKey(labels):
+    return tuple(sorted(labels.items()))
+
+class Metrics(object):
+    """Thread-safe registry of counters and timers for the current process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.startedAt = time.time()
+        # name -> {labelKey: value}
+        self.counters = {}
+        # name -> {labelKey: [count, totalSeconds, maxSeconds]}
+        self.timers = {}
+
+    def incr(self, name, value=1, **labels):
+        key = labelKey(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = labelKey(labels)
+        with self.lock:
+            series = self.timers.setdefault(name, {})
+            stats = series.get(key)
+            if stats is None:
+                stats = series[key] = [0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def drain(self):
+        """@return picklable dict of everything recorded so far (e.g. by a worker process), then reset."""
+        with self.lock:
+            delta = {'counters': self.counters, 'timers': self.timers}
+            self.counters, self.timers = {}, {}
+        return delta
+
+    def merge(self, delta):
+        for name, series in delta['counters'].items():
+            for key, value in series.items():
+                self.incr(name, value, **dict(key))
+        with self.lock:
+            for name, series in delta['timers'].items():
+                for key, (count, total, longest) in series.items():
+                    stats = self.timers.setdefault(name, {}).setdefault(key, [0, 0.0, 0.0])
+                    stats[0] += count
+                    stats[1] += total
+                    stats[2] = max(stats[2], longest)
+
+    @staticmethod
+    def peakRssBytes():
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        # ru_maxrss is in KiB on Linux but bytes on macOS.
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return max(usage, children) * scale
+
+    def snapshot(self, action=None):
+        """@return dict suitable for JSON."""
+        with self.lock:
+            counters = dict((name, [dict(key, value=value) for key, value in sorted(series.items())]) for name, series in self.counters.items())
+            timers = dict((name, [dict(key, count=count, seconds=total, maxSeconds=longest) for key, (count, total, longest) in sorted(series.items())]) for name, series in self.timers.items())
+        return {
+            'action': action,
+            'startedAt': self.startedAt,
+            'durationSeconds': time.time() - self.startedAt,
+            'peakRssBytes': self.peakRssBytes(),
+            'counters': counters,
+            'timers': timers,
+        }
+
+    def prometheus(self, action=None):
+        """@return str Prometheus text exposition format, for node_exporter's textfile collector."""
+        snapshot = self.snapshot(action)
+        base = {'action': action} if action else {}
+        lines = []
+
+        def sample(name, labels, value):
+            labels = dict(base, **labels)
+            rendered = ','.join('{0}="{1}"'.format(key, str(labels[key]).replace('\\', '\\\\').replace('"', '\\"')) for key in sorted(labels))
+            lines.append('{0}{1} {2}'.format(name, '{' + rendered + '}' if rendered else '', value))
+
+        def header(name, kind, description):
+            lines.append('# HELP {0} {1}'.format(name, description))
+            lines.append('# TYPE {0} {1}'.format(name, kind))
+
+        for name in sorted(snapshot['counters']):
+            metric = '{0}_{1}_total'.format(PREFIX, name)
+            header(metric, 'counter', DESCRIPTIONS.get(name, name))
+            for entry in snapshot['counters'][name]:
+                entry = dict(entry)
+                sample(metric, entry, entry.pop('value'))
+
+        for name in sorted(snapshot['timers']):
+            description = DESCRIPTIONS.get(name, name)
+            for suffix, field, kind in (('seconds_total', 'seconds', 'counter'), ('count_total', 'count', 'counter'), ('max_seconds', 'maxSeconds', 'gauge')):
+                metric = '{0}_{1}_{2}'.format(PREFIX, name, suffix)
+                header(metric, kind, description)
+                for entry in snapshot['timers'][name]:
+                    labels = dict((key, value) for key, value in entry.items() if key not in ('count', 'seconds', 'maxSeconds'))
+                    sample(metric, labels, entry[field])
+
+        for name, kind, description, value in (
+            ('peak_rss_bytes', 'gauge', 'Peak resident set size of the run.', snapshot['peakRssBytes']),
+            ('run_duration_seconds', 'gauge', 'Wall time of the run.', snapshot['durationSeconds']),
+            ('last_run_timestamp_seconds', 'gauge', 'When the run finished.', time.time()),
+        ):
+            metric = '{0}_{1}'.format(PREFIX, name)
+            header(metric, kind, description)
+            sample(metric, {}, value)
+
+        return '\n'.join(lines) + '\n'
+
+    def emit(self, action):
+        """
+        Write this run's metrics to METRICS_DIR/<action>.json and
+        METRICS_TEXTFILE_DIR/evernote_publisher_<action>.prom, both
+        defaulting to DATA_PATH/metrics.
+
+        @return str Path of the JSON file.
+        """
+        name = action.replace('-', '_')
+        directory = getattr(settings, 'METRICS_DIR', None) or '{0}/metrics'.format(settings.DATA_PATH)
+        jsonPath = '{0}/{1}.json'.format(directory, name)
+        textfilePath = '{0}/{1}_{2}.prom'.format(getattr(settings, 'METRICS_TEXTFILE_DIR', None) or directory, PREFIX, name)
+        for path, data in ((jsonPath, simplejson.dumps(self.snapshot(action), indent=2)), (textfilePath, self.prometheus(action))):
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmpPath = '{0}.{1}.tmp'.format(path, os.getpid())
+            with open(tmpPath, 'w') as fh:
+                fh.write(data)
+            # node_exporter must never see a half-written textfile.
+            os.replace(tmpPath, path)
+        return jsonPath
+
+# Shared per-process registry.
+metrics = Metrics()
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+"""SQLite catalogue of collected notes."""
+
+import collections
+import glob
+import os
+import simplejson
+import sqlite3
+import threading
+
+from .logger import logger
+from .resources import hexHash
+from .segments import getSegmentStore
+
+import settings
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+INDEX_FILENAME = 'index.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS notes (
+    guid        TEXT PRIMARY KEY,
+    created     INTEGER NOT NULL UNIQUE,
+    updated     INTEGER,
+    deleted     INTEGER,
+    title       TEXT,
+    sourceUrl   TEXT,
+    tagGuids    TEXT,
+    tags        TEXT,
+    contentHash TEXT,
+    notebookGuid TEXT,
+    resourceHashes TEXT
+)
+'''
+
+NOTEBOOKS_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS notebooks (
+    guid        TEXT PRIMARY KEY,
+    name        TEXT
+)
+'''
+
+Notebook = collections.namedtuple('Notebook', ('guid', 'name'))
+
+def resourceHashesOf(note):
+    """@return list of the hex body hashes of an Evernote Note's resources."""
+    return [hexHash(resource.data.bodyHash) for resource in note.resources or [] if resource.data is not None and resource.data.bodyHash is not None]
+
+class NoteIndex(object):
+    """
+    Metadata for every note in `DATA_PATH', so change detection, counts and
+    listings don't need to open the per-note JSON and pickle files.  Notes
+    are namespaced by the notebook they were collected from.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or '{0}/{1}'.format(settings.DATA_PATH, INDEX_FILENAME)
+        self.pid = os.getpid()
+        # The collector shares one index between its notebook threads, serializing access itself.
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute(SCHEMA)
+        self.conn.execute(NOTEBOOKS_SCHEMA)
+        stale = False
+        columns = [row['name'] for row in self.conn.execute('PRAGMA table_info(notes)')]
+        # Indexed before notes were namespaced by notebook, or before their resources were listed.
+        for column in ('notebookGuid', 'resourceHashes'):
+            if column not in columns:
+                self.conn.execute('ALTER TABLE notes ADD COLUMN {0} TEXT'.format(column))
+                stale = True
+        if (stale or self.count(includeDeleted=True) == 0) and (getSegmentStore().createds() or glob.glob('{0}/[0-9]*.json'.format(settings.DATA_PATH))):
+            self.rebuild()
+
+    def transaction(self):
+        """Context manager which commits on success and rolls back on error."""
+        return self.conn
+
+    def upsert(self, guid, created, updated, deleted, title, sourceUrl, tagGuids, tags, contentHash, notebookGuid, resourceHashes=None):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO notes (guid, created, updated, deleted, title, sourceUrl, tagGuids, tags, contentHash, notebookGuid, resourceHashes) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (guid, created, updated, deleted, title, sourceUrl, simplejson.dumps(tagGuids or []), simplejson.dumps(tags or []), contentHash, notebookGuid, simplejson.dumps(resourceHashes or [])),
+        )
+
+    def upsertData(self, data, obj):
+        """Index a note from its data dict and Thrift Note."""
+        self.upsert(
+            data['guid'],
+            data['created'],
+            data['updated'],
+            data['deleted'],
+            data['title'],
+            obj.attributes.sourceURL if obj.attributes else None,
+            data.get('tagGuids'),
+            data.get('tags'),
+            data.get('b64ContentHash'),
+            obj.notebookGuid,
+            resourceHashesOf(obj),
+        )
+
+    def remove(self, guid):
+        """@return bool Whether the note was indexed."""
+        return self.conn.execute('DELETE FROM notes WHERE guid = ?', (guid,)).rowcount > 0
+
+    def notebookGuidOf(self, guid):
+        """@return str Guid of the notebook the note was collected from, or None if it isn't indexed."""
+        row = self.conn.execute('SELECT notebookGuid FROM notes WHERE guid = ?', (guid,)).fetchone()
+        return row['notebookGuid'] if row is not None else None
+
+    def stampFor(self, created):
+        """@return tuple of the `updated' stamp and notebook guid of the note with the given `created' stamp, or None if it isn't indexed."""
+        row = self.conn.execute('SELECT updated, notebookGuid FROM notes WHERE created = ?', (created,)).fetchone()
+        return (row['updated'], row['notebookGuid']) if row is not None else None
+
+    def createdByGuid(self):
+        """@return dict of note guid -> created stamp."""
+        return dict(self.conn.execute('SELECT guid, created FROM notes').fetchall())
+
+    def count(self, includeDeleted=False, notebookGuid=None):
+        conditions = ([] if includeDeleted else ['deleted IS NULL']) + ([] if notebookGuid is None else ['notebookGuid = ?'])
+        query = 'SELECT COUNT(*) FROM notes' + (' WHERE ' + ' AND '.join(conditions) if conditions else '')
+        return self.conn.execute(query, () if notebookGuid is None else (notebookGuid,)).fetchone()[0]
+
+    def notes(self, notebookGuids=None, createds=None):
+        """
+        @param notebookGuids list Only notes from these notebooks (defaults to every notebook).
+        @param createds list Only the notes with these `created' stamps (defaults to every note).
+        @return iterator of rows (as dicts, with tag lists decoded) ordered newest-created first.
+        """
+        conditions, params = [], []
+        for column, values in (('notebookGuid', notebookGuids), ('created', createds)):
+            if values is not None:
+                values = list(values)
+                conditions.append('{0} IN ({1})'.format(column, ', '.join('?' * len(values))))
+                params.extend(values)
+        query = 'SELECT * FROM notes' + (' WHERE ' + ' AND '.join(conditions) if conditions else '') + ' ORDER BY created DESC'
+        for row in self.conn.execute(query, params):
+            row = dict(row)
+            row['tagGuids'] = simplejson.loads(row['tagGuids'])
+            row['tags'] = simplejson.loads(row['tags'])
+            row['resourceHashes'] = simplejson.loads(row['resourceHashes'] or '[]')
+            yield row
+
+    def upsertNotebook(self, guid, name):
+        self.conn.execute('INSERT OR REPLACE INTO notebooks (guid, name) VALUES (?, ?)', (guid, name))
+
+    def notebooks(self):
+        """@return list of Notebook (guid, name) for every notebook notes were collected from."""
+        return [Notebook(row['guid'], row['name']) for row in self.conn.execute('SELECT guid, name FROM notebooks ORDER BY name')]
+
+    def rebuild(self):
+        """(Re)populate the index from the segment store and any legacy JSON and pickle data files."""
+        logger.info('building note index from data files in %s', settings.DATA_PATH)
+        storage = getSegmentStore()
+        with self.conn:
+            self.conn.execute('DELETE FROM notes')
+            for created in storage.createds():
+                data, obj, _ = storage.get(created)
+                self.upsertData(data, obj)
+            for path in glob.iglob('{0}/[0-9]*.json'.format(settings.DATA_PATH)):
+                picklePath = path[0:-len('.json')] + '.pickle'
+                try:
+                    with open(path, 'r') as fh:
+                        data = simplejson.load(fh)
+                    with open(picklePath, 'rb') as fh:
+                        obj = pickle.load(fh, encoding='latin1')
+                except Exception:
+                    logger.exception('skipping unreadable note data %s', path)
+                    continue
+                self.upsertData(data, obj)
+        logger.info('indexed %s notes', self.count(includeDeleted=True))
+
+# Per-thread instances, see `getNoteIndex'.
+_local = threading.local()
+
+def getNoteIndex():
+    """
+    @return NoteIndex shared by the calling thread (a forked worker, or
+        another thread such as `lib.pipeline''s renderer, gets its own), so
+        its connection is opened once rather than on every use.
+    """
+    index = getattr(_local, 'index', None)
+    if index is None or index.pid != os.getpid():
+        index = _local.index = NoteIndex()
+    return index
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+"""Splits note listings into pages whose URLs stay put as new notes arrive."""
+
+import posixpath
+
+import settings
+
+# None (one page per listing), 'size', 'month' or 'year'.
+PAGINATE_BY = getattr(settings, 'PAGINATE_BY', None)
+PAGE_SIZE = getattr(settings, 'PAGE_SIZE', 500)
+
+PERIOD_FORMATS = {
+    'month': '%Y-%m',
+    'year': '%Y',
+}
+
+class Page(object):
+    """
+    One page of a listing.  `newer' and `older' are hrefs relative to the page
+    itself (or None at either end), and `root' is the relative prefix back up
+    to OUTPUT_PATH.
+    """
+
+    __slots__ = ('key', 'path', 'root', 'notes', 'newer', 'older')
+
+    def __init__(self, key, path, notes):
+        self.key = key
+        self.path = path
+        self.root = rootFor(path)
+        self.notes = notes
+        self.newer = None
+        self.older = None
+
+def rootFor(path):
+    depth = path.count('/')
+    return '../' * depth
+
+def relativeHref(fromPath, toPath):
+    return posixpath.relpath(toPath, posixpath.dirname(fromPath) or '.')
+
+class Paginator(object):
+    """
+    Pages are numbered (or, for `month'/`year', named) from the oldest note,
+    so an archive page's URL and content never change once written.  The
+    newest notes live on the listing's front page:
+
+        - by size, archive page N holds the N'th oldest PAGE_SIZE notes, and the
+          front page holds the remaining PAGE_SIZE to 2 * PAGE_SIZE - 1 newest.
+        - by month or year, the front page holds the newest period.
+
+    Adding a note therefore only rewrites the front page, plus, when a new
+    archive page splits off, that page and the one before it.
+    """
+
+    def __init__(self, by=None, pageSize=None):
+        self.by = by if by is not None else PAGINATE_BY
+        self.pageSize = pageSize or PAGE_SIZE
+        if self.by not in (None, 'size') and self.by not in PERIOD_FORMATS:
+            raise ValueError('unsupported pagination "{0}", expected one of: size, month, year'.format(self.by))
+
+    def groups(self, notes):
+        """
+        @param notes list of notes, newest-created first.
+
+        @return list of (key, notes) tuples, newest first.  The front page's key is None.
+        """
+        if self.by is None or len(notes) <= self.pageSize:
+            return [(None, notes)]
+
+        if self.by == 'size':
+            numArchived = max(0, len(notes) // self.pageSize - 1)
+            frontSize = len(notes) - numArchived * self.pageSize
+            groups = [(None, notes[0:frontSize])]
+            for key in range(numArchived, 0, -1):
+                end = len(notes) - (key - 1) * self.pageSize
+                groups.append(('{0}'.format(key), notes[end - self.pageSize:end]))
+            return groups
+
+        byPeriod = []
+        for note in notes:
+            key = note.createdTs.strftime(PERIOD_FORMATS[self.by])
+            if not byPeriod or byPeriod[-1][0] != key:
+                byPeriod.append((key, []))
+            byPeriod[-1][1].append(note)
+        return [(None, byPeriod[0][1])] + byPeriod[1:]
+
+    def pages(self, notes, frontPath, archiveDir):
+        """
+        @param frontPath str e.g. `index.html'.
+        @param archiveDir str Directory archive pages are written to, as `<archiveDir>/<key>.html'.
+
+        @return list of Page, newest first, linked to their neighbours.
+        """
+        pages = []
+        for key, group in self.groups(notes):
+            path = frontPath if key is None else '{0}/{1}.html'.format(archiveDir, key)
+            pages.append(Page(key, path, group))
+
+        for newer, older in zip(pages, pages[1:]):
+            newer.older = relativeHref(newer.path, older.path)
+            older.newer = relativeHref(older.path, newer.path)
+        return pages
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+"""
+`app.py refresh' as a pipeline: node pages are rendered on a thread of their
+own as soon as the collector has stored each batch of notes (and their
+search postings updated), while later batches are still downloading.  The
+listing, tag and search pages are finalized once, at the end.
+"""
+
+import queue
+import threading
+import time
+
+from .logger import logger
+
+class RefreshPipeline(object):
+    """Collect with a Collector and render with an HtmlGenerator, overlapping the two."""
+
+    def __init__(self, collector, generator, jobs=1):
+        self.collector = collector
+        self.generator = generator
+        self.jobs = jobs
+        # Batches of `created' stamps, then None once collection is over.
+        self.queue = queue.Queue()
+        self.error = None
+        self.numRendered = 0
+        self.full = False
+
+    def run(self, full=False, sync=False):
+        """
+        @param full bool When True, ignore the build manifest and re-render everything.
+        @param sync bool Collect incrementally (see `Collector.sync').
+        @return int Number of node pages rendered.
+        """
+        self.full = full
+        self.generator.prepareOutput()
+        self.generator.loadManifest(full)
+        # Worker processes have to be forked before any collector threads exist.
+        executor = self.generator.renderPool(self.jobs) if self.jobs > 1 else None
+        deriveExecutor = self.generator.derivePool(executor)
+        try:
+            renderer = threading.Thread(target=self.render, args=(executor, deriveExecutor), name='renderer')
+            renderer.start()
+            self.collector.onStored = self.queue.put
+            start = time.time()
+            try:
+                if sync:
+                    self.collector.sync()
+                else:
+                    self.collector.run()
+                logger.info('collection finished after %.2fs, %s notes rendered so far', time.time() - start, self.numRendered)
+            finally:
+                self.collector.onStored = None
+                self.queue.put(None)
+                renderer.join()
+            if self.error is not None:
+                raise self.error
+
+            # Whatever else changed (e.g. templates), then every page listing notes.
+            summaries = self.generator.getNoteSummaries()
+            self.numRendered += self.generator.makeChangedNotes(summaries, self.jobs, executor, deriveExecutor)
+            self.generator.finish(summaries, full)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            if deriveExecutor is not None and deriveExecutor is not executor:
+                deriveExecutor.shutdown()
+        logger.info('refresh finished after %.2fs', time.time() - start)
+        return self.numRendered
+
+    def render(self, executor, deriveExecutor):
+        """Renderer thread: render each batch of stored notes until collection is over."""
+        while True:
+            createds = self.queue.get()
+            if createds is None:
+                return
+            if self.error is not None:
+                # Collection carries on regardless; the error is raised once it's over.
+                continue
+            try:
+                summaries = self.generator.getNoteSummaries(createds)
+                self.numRendered += self.generator.makeChangedNotes(summaries, self.jobs, executor, deriveExecutor)
+                self.generator.indexNotes(summaries, self.full)
+            except Exception as e:
+                logger.exception('rendering collected notes failed')
+                self.error = e
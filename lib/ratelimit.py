@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+"""Shared, rate-limit-aware backoff for Evernote API calls."""
+
+import threading
+import time
+
+import evernote.edam.error.ttypes
+
+from .logger import logger
+from .metrics import metrics
+
+def methodName(fn):
+    """@return str Name of the API method `fn' calls, for metrics labels."""
+    # evernote.api.client.Store hands out closures over the method name.
+    if getattr(fn, '__closure__', None):
+        closure = dict(zip(fn.__code__.co_freevars, (cell.cell_contents for cell in fn.__closure__)))
+        if isinstance(closure.get('name'), str):
+            return closure['name']
+    return getattr(fn, '__name__', 'unknown')
+
+class RateLimiter(object):
+    """
+    When any caller hits Evernote's rate limit, every caller sharing this
+    instance waits out the `rateLimitDuration' the service asked for before
+    retrying.
+    """
+
+    def __init__(self, maxRetries=5):
+        self.maxRetries = maxRetries
+        self.lock = threading.Lock()
+        self.resumeAt = 0.0
+
+    def wait(self):
+        """Block until any active backoff window has passed."""
+        while True:
+            with self.lock:
+                delay = self.resumeAt - time.time()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def backoff(self, seconds):
+        """Push the shared resume time out by `seconds' from now."""
+        with self.lock:
+            self.resumeAt = max(self.resumeAt, time.time() + seconds)
+
+    def call(self, fn, *args):
+        """Invoke fn(*args), waiting out and retrying on rate-limit errors."""
+        attempt = 0
+        method = methodName(fn)
+        while True:
+            self.wait()
+            metrics.incr('api_calls', method=method)
+            start = time.perf_counter()
+            try:
+                return fn(*args)
+            except evernote.edam.error.ttypes.EDAMSystemException as e:
+                if e.errorCode != evernote.edam.error.ttypes.EDAMErrorCode.RATE_LIMIT_REACHED or attempt >= self.maxRetries:
+                    metrics.incr('api_errors', method=method)
+                    raise
+                metrics.incr('api_rate_limited', method=method)
+                attempt += 1
+                duration = e.rateLimitDuration or 60
+                logger.warn('rate limit reached, backing off for %ss (attempt %s/%s)', duration, attempt, self.maxRetries)
+                self.backoff(duration)
+            except Exception:
+                metrics.incr('api_errors', method=method)
+                raise
+            finally:
+                metrics.observe('api_call', time.perf_counter() - start, method=method)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+"""Content-addressed store for note resource bodies (images, PDFs, etc)."""
+
+import binascii
+import glob
+import os
+import shutil
+import threading
+
+from .logger import logger
+
+import settings
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+RESOURCES_DIRNAME = 'resources'
+
+def hexHash(bodyHash):
+    """Evernote resource body hashes are raw md5 bytes; normalize to hex."""
+    if isinstance(bodyHash, bytes):
+        return binascii.hexlify(bodyHash).decode('ascii')
+    return bodyHash
+
+class ResourceStore(object):
+    """
+    Resource bodies stored once each under `DATA_PATH/resources/ab/cd/<md5>',
+    no matter how many notes reference them.
+    """
+
+    def __init__(self, root=None):
+        self.root = root or '{0}/{1}'.format(settings.DATA_PATH, RESOURCES_DIRNAME)
+
+    def path(self, bodyHash):
+        h = hexHash(bodyHash)
+        return '{0}/{1}/{2}/{3}'.format(self.root, h[0:2], h[2:4], h)
+
+    def has(self, bodyHash):
+        return os.path.exists(self.path(bodyHash))
+
+    def get(self, bodyHash):
+        with open(self.path(bodyHash), 'rb') as fh:
+            return fh.read()
+
+    def put(self, bodyHash, body):
+        """Atomically store a resource body (no-op when already present)."""
+        path = self.path(bodyHash)
+        if os.path.exists(path):
+            return
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmpPath = '{0}.{1}-{2}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(tmpPath, 'wb') as fh:
+            fh.write(body.encode('utf-8') if isinstance(body, str) else body)
+        os.rename(tmpPath, path)
+
+    def link(self, bodyHash, destination):
+        """Hard-link a stored body to `destination', falling back to a copy across file systems."""
+        source = self.path(bodyHash)
+        if os.path.exists(destination):
+            if os.path.samefile(source, destination):
+                return
+            os.remove(destination)
+        try:
+            os.link(source, destination)
+        except OSError:
+            shutil.copyfile(source, destination)
+
+    def absorb(self, note):
+        """
+        Move any inline resource bodies of a note into the store.
+
+        @return bool True if the note was modified.
+        """
+        modified = False
+        for resource in note.resources or []:
+            if resource.data is None or resource.data.body is None:
+                continue
+            self.put(resource.data.bodyHash, resource.data.body)
+            resource.data.body = None
+            modified = True
+        return modified
+
+    def migratePickles(self):
+        """Move resource bodies out of every legacy `<created>.pickle' and into the store."""
+        numMigrated = 0
+        for path in glob.iglob('{0}/[0-9]*.pickle'.format(settings.DATA_PATH)):
+            with open(path, 'rb') as fh:
+                note = pickle.load(fh, encoding='latin1')
+            if not self.absorb(note):
+                continue
+            with open(path + '.tmp', 'wb') as fh:
+                pickle.dump(note, fh)
+            os.rename(path + '.tmp', path)
+            numMigrated += 1
+        logger.info('moved resources of %s notes into %s', numMigrated, self.root)
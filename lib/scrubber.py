@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+"""Scrubber for the broken inline CSS Evernote's web clipper leaves behind."""
+
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+
+from .logger import logger
+
+import settings
+
+RULES_FILENAME = getattr(settings, 'CSS_SCRUB_RULES_PATH', os.path.join(os.path.dirname(__file__), 'cssScrubRules.txt'))
+CACHE_DIRNAME = '.scrubCacheByNote'
+# Keyed by content hash, so never pruned.
+LEGACY_CACHE_DIRNAME = '.scrubCache'
+
+styleAttributeExpr = re.compile(r'([ \t\r\n]style[ \t\r\n]*=[ \t\r\n]*")([^"]*)(")', re.I)
+
+def loadRules(path):
+    """@return list of rule expressions from a rules file, skipping blank lines and `#' comments."""
+    with open(path, 'r') as fh:
+        lines = [line.strip() for line in fh]
+    return [line for line in lines if line and not line.startswith('#')]
+
+class CssScrubber(object):
+    """
+    Finds each `style="..."' attribute once and strips every declaration
+    fragment matching the ruleset from its value.  Results are cached on disk,
+    one file per note holding its latest content, checked against the hash of
+    that content plus the ruleset version.
+    """
+
+    def __init__(self, rulesPath=None, cachePath=None):
+        rules = loadRules(rulesPath or RULES_FILENAME)
+        self.version = hashlib.sha1('\n'.join(rules).encode('utf-8')).hexdigest()[0:12]
+        self.expr = re.compile(r'|'.join('(?:%s)' % (rule,) for rule in rules), re.I)
+        self.cachePath = cachePath or cacheRoot()
+        removeLegacyCache()
+        logger.debug('loaded %s css scrub rules (version=%s)', len(rules), self.version)
+
+    def scrubStyle(self, match):
+        value = match.group(2)
+        # Removing one fragment can join the remainder into another match.
+        last = None
+        while last != value:
+            last = value
+            value = self.expr.sub('', value)
+        return match.group(1) + value + match.group(3)
+
+    def scrub(self, content):
+        return styleAttributeExpr.sub(self.scrubStyle, content)
+
+    def scrubCached(self, content, guid):
+        """
+        Scrub a note's content, reusing the result from a previous build when
+        the content and ruleset are unchanged.
+
+        @param guid str The note's guid, which its cache entry is kept under.
+        """
+        key = hashlib.sha1((self.version + content).encode('utf-8')).hexdigest()
+        path = cachePathOf(guid, self.cachePath)
+        try:
+            with open(path, 'rb') as fh:
+                data = fh.read()
+            if data[0:len(key) + 1] == (key + '\n').encode('ascii'):
+                return data[len(key) + 1:].decode('utf-8')
+        except (IOError, OSError):
+            pass
+
+        scrubbed = self.scrub(content)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmpPath = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write((key + '\n' + scrubbed).encode('utf-8'))
+        os.replace(tmpPath, path)
+        return scrubbed
+
+def cacheRoot():
+    return '{0}/{1}'.format(settings.DATA_PATH, CACHE_DIRNAME)
+
+def cachePathOf(guid, cachePath=None):
+    return '{0}/{1}/{2}'.format(cachePath or cacheRoot(), guid[0:2], guid)
+
+def removeCached(guid):
+    """Remove a note's cached scrubbed content, once the note itself is gone."""
+    try:
+        os.remove(cachePathOf(guid))
+    except (IOError, OSError):
+        pass
+
+def removeLegacyCache():
+    path = '{0}/{1}'.format(settings.DATA_PATH, LEGACY_CACHE_DIRNAME)
+    if os.path.exists(path):
+        logger.info('removing %s', path)
+        shutil.rmtree(path, True)
+
+# Shared per-process instance, see `getScrubber'.
+_scrubber = None
+
+def getScrubber():
+    global _scrubber
+    if _scrubber is None:
+        _scrubber = CssScrubber()
+    return _scrubber
@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+
+"""
+Build-time full-text search index, published as prefix-sharded JSON for the
+static search page:
+
+    search/terms/<ab>.json      {"<term>": [[<note id>, weight], ...], ...}
+    search/docs/<xy>.json       {"<note id>": [title, created(, node page path)], ...}
+    search/translit/<xyz>.json  [<replacement of U+xyz00>, ..., <of U+xyzff>]
+
+where `ab' is the first SEARCH_PREFIX_LENGTH characters of every term in the
+shard and `xy' the `docShardOf' the note ids in it, there being more doc
+shards the more notes there are.  Node page paths are only included for a
+sharded OUTPUT_LAYOUT.  The `translit' tables are unidecode's own, so the
+page folds queries exactly like `tokenize', and only published for the
+characters found in notes (plus Latin-1).  A query only fetches the shards
+for its own terms and results, and the tables for any non-ASCII characters
+in it.
+"""
+
+import html
+import importlib
+import importlib.metadata
+import pkgutil
+import re
+import simplejson
+import sqlite3
+import time
+
+import unidecode
+
+from .logger import logger
+from .manifest import digest
+from .tagindex import normalizeTagName
+from .util import buildStatePath
+
+import settings
+
+STATE_FILENAME = 'search.sqlite'
+PREFIX_LENGTH = getattr(settings, 'SEARCH_PREFIX_LENGTH', 2)
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 32
+# Note titles and dates for results are published in a power of two of
+# shards of about this many notes, up to DOC_SHARDS of them.
+DOCS_PER_SHARD = 128
+DOC_SHARDS = 256
+# Latin-1, whose table is always published so accented queries find unaccented notes.
+LATIN1_SECTION = '000'
+# Bumped when what's stored per note changes, so every note gets re-indexed.
+INDEX_VERSION = 2
+
+# Weight of each occurrence of a term, per field.
+FIELD_WEIGHTS = {
+    'title': 8,
+    'tags': 4,
+    'domain': 4,
+    'body': 1,
+}
+# Keeps a term repeated throughout one long clip from drowning out everything else.
+MAX_BODY_WEIGHT = 16
+
+STOPWORDS = frozenset('''
+    an and are as at be but by for from has have he her his if in into is it its
+    not of on or she that the their them then there these they this to was we
+    were which will with you your
+'''.split())
+
+tagExpr = re.compile(r'<[^>]*>')
+termExpr = re.compile(r'[a-z0-9]+')
+
+def textOf(markup):
+    """@return str Visible text of an html fragment."""
+    return html.unescape(tagExpr.sub(' ', markup))
+
+def tokenize(text):
+    """@return list of search terms, in order, including repeats."""
+    folded = unidecode.unidecode(text).lower()
+    return [term for term in termExpr.findall(folded) if MIN_TERM_LENGTH <= len(term) <= MAX_TERM_LENGTH and term not in STOPWORDS]
+
+def weighTerms(title, tagNames, domain, body):
+    """@return dict of term -> integer weight for one note."""
+    weights = {}
+    for field, text in (('title', title), ('tags', ' '.join(tagNames)), ('domain', domain)):
+        for term in tokenize(text or ''):
+            weights[term] = weights.get(term, 0) + FIELD_WEIGHTS[field]
+    bodyCounts = {}
+    for term in tokenize(body or ''):
+        bodyCounts[term] = bodyCounts.get(term, 0) + 1
+    for term, count in bodyCounts.items():
+        weights[term] = weights.get(term, 0) + min(count, MAX_BODY_WEIGHT) * FIELD_WEIGHTS['body']
+    return weights
+
+def shardOf(term):
+    return term[0:PREFIX_LENGTH]
+
+def docShardCount(numNotes):
+    """@return int Number of doc shards for this many notes."""
+    count = 1
+    while count < DOC_SHARDS and count * DOCS_PER_SHARD < numNotes:
+        count *= 2
+    return count
+
+def docShardOf(noteId, count):
+    """32-bit FNV-1a of the note id (as the search page computes it), in hex, modulo the number of doc shards."""
+    h = 0x811c9dc5
+    for byte in noteId.encode('utf-8'):
+        h = ((h ^ byte) * 0x01000193) & 0xffffffff
+    return '%02x' % (h % count,)
+
+def sectionsOf(*texts):
+    """@return set of str The hex sections (code point >> 8) of the non-ASCII characters in texts, as the search page looks them up."""
+    sections = set()
+    for text in texts:
+        sections.update('%03x' % (ord(c) >> 8,) for c in set(text or '') if 0x80 <= ord(c) <= 0xeffff)
+    return sections
+
+def transliterationSections():
+    """@return list of str The hex sections (code point >> 8) unidecode has a table for."""
+    return sorted(module.name[1:] for module in pkgutil.iter_modules(unidecode.__path__) if re.match(r'^x[0-9a-f]{3}$', module.name))
+
+def transliterationTable(section):
+    """@return list of 256 str unidecode's replacements for the code points in a section ('' where it has none)."""
+    data = importlib.import_module('unidecode.x{0}'.format(section)).data
+    return [replacement or '' for replacement in data[0:256]] + [''] * (256 - len(data))
+
+def unidecodeVersion():
+    try:
+        return importlib.metadata.version('unidecode')
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+SCHEMA = (
+    '''
+    CREATE TABLE IF NOT EXISTS notes (
+        id      TEXT PRIMARY KEY,
+        key     TEXT NOT NULL,
+        title   TEXT,
+        created INTEGER
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS postings (
+        prefix  TEXT NOT NULL,
+        term    TEXT NOT NULL,
+        noteId  TEXT NOT NULL,
+        weight  INTEGER NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS postingsByPrefix ON postings (prefix)',
+    'CREATE INDEX IF NOT EXISTS postingsByNote ON postings (noteId)',
+    # Which transliteration tables each note's characters are in.
+    '''
+    CREATE TABLE IF NOT EXISTS sections (
+        noteId  TEXT NOT NULL,
+        section TEXT NOT NULL
+    )
+    ''',
+    'CREATE INDEX IF NOT EXISTS sectionsByNote ON sections (noteId)',
+    # What the published doc shards and transliteration tables were last written from.
+    '''
+    CREATE TABLE IF NOT EXISTS meta (
+        key     TEXT PRIMARY KEY,
+        value   TEXT
+    )
+    ''',
+)
+
+class SearchIndex(object):
+    """
+    The postings behind the published shards are kept in a SQLite database in
+    DATA_PATH, so a build only re-tokenizes notes whose inputs changed and
+    only re-serializes the shards those notes had or now have terms in.
+    """
+
+    def __init__(self, writer, path=None, layout=None):
+        """@param layout OutputLayout Where node pages are, for linking to them from a sharded layout's results."""
+        self.writer = writer
+        self.layout = layout
+        self.path = path or buildStatePath(STATE_FILENAME)
+        # May be handed from the refresh pipeline's renderer thread to the main thread.
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        for statement in SCHEMA:
+            self.conn.execute(statement)
+        # Term shards touched, notes whose doc entries changed and notes re-indexed, since the last `build'.
+        self.dirty = set()
+        self.dirtyDocs = set()
+        self.reindexed = 0
+        # Of the last `build', for the search page.
+        self.docShards = None
+
+    @staticmethod
+    def noteKey(note, version=''):
+        """Digest of everything a note's index entry is derived from."""
+        return digest(INDEX_VERSION, version, note.updated, note.contentHash, note.title, sorted('%s' % (tag['name'],) for tag in note.tags))
+
+    def shardsOf(self, noteId):
+        return set(row[0] for row in self.conn.execute('SELECT DISTINCT prefix FROM postings WHERE noteId = ?', (noteId,)))
+
+    def getMeta(self, key):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def setMeta(self, key, value):
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def remove(self, noteId):
+        self.dirtyDocs.add(noteId)
+        self.conn.execute('DELETE FROM postings WHERE noteId = ?', (noteId,))
+        self.conn.execute('DELETE FROM sections WHERE noteId = ?', (noteId,))
+        self.conn.execute('DELETE FROM notes WHERE id = ?', (noteId,))
+
+    def reset(self):
+        """Discard the stored postings, so every note gets re-indexed."""
+        with self.conn:
+            self.conn.execute('DELETE FROM postings')
+            self.conn.execute('DELETE FROM sections')
+            self.conn.execute('DELETE FROM notes')
+            # So doc shards of notes which are gone by now get rewritten too.
+            self.conn.execute("DELETE FROM meta WHERE key = 'docs'")
+
+    def update(self, notes, loadBody, version=''):
+        """
+        Re-index those of `notes' whose inputs changed, remembering the shards
+        they touched for `build' to write out.  Lets notes be indexed as they
+        arrive (see `lib.pipeline') rather than all at the end.
+
+        @return int Number of notes re-indexed.
+        """
+        reindexed = 0
+        with self.conn:
+            for note in notes:
+                key = self.noteKey(note, version)
+                row = self.conn.execute('SELECT key FROM notes WHERE id = ?', (note.id,)).fetchone()
+                if row is not None and row[0] == key:
+                    continue
+                if row is not None:
+                    self.dirty.update(self.shardsOf(note.id))
+                    self.remove(note.id)
+                tagNames = [normalizeTagName(tag['name']) for tag in note.tags]
+                body = textOf(loadBody(note))
+                terms = weighTerms(note.title, tagNames, note.sourceDomain, body)
+                self.conn.execute('INSERT INTO notes (id, key, title, created) VALUES (?, ?, ?, ?)', (note.id, key, note.title, note.created))
+                self.conn.executemany(
+                    'INSERT INTO postings (prefix, term, noteId, weight) VALUES (?, ?, ?, ?)',
+                    ((shardOf(term), term, note.id, weight) for term, weight in terms.items()),
+                )
+                self.conn.executemany(
+                    'INSERT INTO sections (noteId, section) VALUES (?, ?)',
+                    ((note.id, section) for section in sectionsOf(note.title, ' '.join(tagNames), note.sourceDomain, body)),
+                )
+                self.dirty.update(shardOf(term) for term in terms)
+                self.dirtyDocs.add(note.id)
+                reindexed += 1
+        self.reindexed += reindexed
+        return reindexed
+
+    def build(self, notes, loadBody, version='', full=False):
+        """
+        Bring the index up to date with `notes' and write out changed shards.
+
+        @param notes list of notes (or NoteSummary), each with id, created, updated, contentHash, title, tags, sourceDomain.
+        @param loadBody function(note) -> str Body text, only called for notes needing (re-)indexing.
+        @param version str Changes to this (e.g. the CSS scrubber version) re-index every note.
+        @param full bool Discard the stored postings and re-index every note.
+        """
+        start = time.time()
+        if full:
+            self.reset()
+        self.update(notes, loadBody, version)
+
+        with self.conn:
+            seen = set(note.id for note in notes)
+            for (noteId,) in self.conn.execute('SELECT id FROM notes').fetchall():
+                if noteId not in seen:
+                    self.dirty.update(self.shardsOf(noteId))
+                    self.remove(noteId)
+        dirty, self.dirty = self.dirty, set()
+        dirtyDocs, self.dirtyDocs = self.dirtyDocs, set()
+        reindexed, self.reindexed = self.reindexed, 0
+
+        written = 0
+        prefixes = [row[0] for row in self.conn.execute('SELECT DISTINCT prefix FROM postings')]
+        for prefix in prefixes:
+            relPath = 'search/terms/{0}.json'.format(prefix)
+            if prefix in dirty or not self.writer.exists(relPath):
+                self.writer.write(relPath, self.serializeShard(prefix))
+                written += 1
+            else:
+                self.writer.keep(relPath)
+
+        numNotes, docsWritten = self.writeDocs(dirtyDocs)
+        tables, tablesWritten = self.writeTransliterations()
+
+        logger.info('search index: %s notes (%s re-indexed), %s shards (%s written), %s doc shards (%s written), %s transliteration tables (%s written) in %.2fs', numNotes, reindexed, len(prefixes), written, self.docShards, docsWritten, tables, tablesWritten, time.time() - start)
+
+    def writeDocs(self, dirtyDocs):
+        """
+        Write out the doc shards notes were added to, changed in or removed
+        from (all of them, should their number or the layout have changed
+        since).  Empty shards are left out, the search page never needing them.
+
+        @param dirtyDocs set of note ids.
+        @return tuple of (number of notes, number of doc shards written).
+        """
+        sharded = self.layout is not None and self.layout.sharded
+        numNotes = self.conn.execute('SELECT COUNT(*) FROM notes').fetchone()[0]
+        self.docShards = docShardCount(numNotes)
+        signature = digest(self.docShards, self.layout.signature() if sharded else None)
+        rewriteAll = self.getMeta('docs') != signature
+        dirtyShards = set(docShardOf(noteId, self.docShards) for noteId in dirtyDocs)
+        docs = {}
+        for noteId, title, created in self.conn.execute('SELECT id, title, created FROM notes'):
+            docs.setdefault(docShardOf(noteId, self.docShards), {})[noteId] = [title, created] + ([self.layout.nodePath(noteId)] if sharded else [])
+
+        written = 0
+        for shard, shardDocs in sorted(docs.items()):
+            relPath = 'search/docs/{0}.json'.format(shard)
+            if rewriteAll or shard in dirtyShards or not self.writer.exists(relPath):
+                self.writer.write(relPath, simplejson.dumps(shardDocs, sort_keys=True, separators=(',', ':')))
+                written += 1
+            else:
+                self.writer.keep(relPath)
+        self.setMeta('docs', signature)
+        return numNotes, written
+
+    def writeTransliterations(self):
+        """
+        Publish unidecode's tables of the characters found in notes for the
+        search page, rewriting those already published only for a different
+        version of it.
+
+        @return tuple of (number of tables, number written).
+        """
+        used = set(row[0] for row in self.conn.execute('SELECT DISTINCT section FROM sections'))
+        sections = sorted((used | set([LATIN1_SECTION])) & set(transliterationSections()))
+        signature = digest(unidecodeVersion())
+        rewriteAll = self.getMeta('translit') != signature
+        written = 0
+        for section in sections:
+            relPath = 'search/translit/{0}.json'.format(section)
+            if rewriteAll or not self.writer.exists(relPath):
+                self.writer.write(relPath, simplejson.dumps(transliterationTable(section), separators=(',', ':')))
+                written += 1
+            else:
+                self.writer.keep(relPath)
+        self.setMeta('translit', signature)
+        return len(sections), written
+
+    def serializeShard(self, prefix):
+        """@return str Shard JSON, each term's postings ordered by weight and then newest note first."""
+        postings = {}
+        rows = self.conn.execute('SELECT term, noteId, weight FROM postings WHERE prefix = ? ORDER BY term, weight DESC, noteId DESC', (prefix,))
+        for term, noteId, weight in rows:
+            postings.setdefault(term, []).append([noteId, weight])
+        return simplejson.dumps(postings, sort_keys=True, separators=(',', ':'))
+
+def query(text, loadShard):
+    """
+    Evaluate a query the same way the search page does: every term must
+    match, and results are ranked by summed weight, then newest note first.
+
+    @param loadShard function(prefix) -> dict of term -> postings, or None when the shard doesn't exist.
+
+    @return list of (note id, score) tuples.
+    """
+    terms = sorted(set(tokenize(text)))
+    if not terms:
+        return []
+    shards = {}
+    scores = None
+    for term in terms:
+        prefix = shardOf(term)
+        if prefix not in shards:
+            shards[prefix] = loadShard(prefix) or {}
+        postings = dict((noteId, weight) for noteId, weight in shards[prefix].get(term, []))
+        if scores is None:
+            scores = postings
+        else:
+            scores = dict((noteId, score + postings[noteId]) for noteId, score in scores.items() if noteId in postings)
+    ranked = sorted(scores.items(), key=lambda item: item[0], reverse=True)
+    return sorted(ranked, key=lambda item: item[1], reverse=True)
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compact, single-copy note storage: append-only segment files under
+`DATA_PATH/notes', with an offset index so one note can be read (through
+mmap) without parsing any others.
+
+Each record is a fixed header followed by a zlib-compressed payload:
+
+    magic 'ENS1' | flags (1 byte) | created (int64) | payload length (uint32) | crc32 of payload (uint32)
+
+    payload = zlib(uint32 len(meta) | meta JSON | uint32 len(note) | pickled Note | content utf-8)
+
+`meta' is the note's data dict (title, guid, stamps, tags, ...) without its
+content, `note' the Thrift Note without content or resource bodies (those
+live in the ResourceStore).  Rewriting a note appends a new record; removing
+one appends a tombstone.  The offset index can always be rebuilt by
+scanning the segments in order.
+"""
+
+import base64
+import contextlib
+import glob
+import mmap
+import os
+import simplejson
+import sqlite3
+import struct
+import threading
+import zlib
+
+from .logger import logger
+from .resources import ResourceStore
+
+import settings
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+SEGMENTS_DIRNAME = 'notes'
+OFFSETS_FILENAME = 'offsets.sqlite'
+# Start a new segment file once the current one reaches this many bytes.
+SEGMENT_SIZE = getattr(settings, 'SEGMENT_SIZE', 64 * 1024 * 1024)
+
+MAGIC = b'ENS1'
+HEADER = struct.Struct('>4sBqII')
+FLAG_TOMBSTONE = 1
+LENGTH = struct.Struct('>I')
+# Linux maps file pages in around each fault in blocks of (by default) this size.
+FAULT_AROUND_BYTES = 64 * 1024
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS offsets (
+    created INTEGER PRIMARY KEY,
+    segment INTEGER NOT NULL,
+    offset  INTEGER NOT NULL,
+    length  INTEGER NOT NULL
+)
+'''
+
+class CorruptRecord(Exception):
+    pass
+
+def encodeRecord(created, meta, note, content, flags=0):
+    """@return bytes A complete record (header and payload)."""
+    if flags & FLAG_TOMBSTONE:
+        payload = b''
+    else:
+        metaBytes = simplejson.dumps(meta).encode('utf-8')
+        noteBytes = pickle.dumps(note, protocol=pickle.HIGHEST_PROTOCOL)
+        payload = zlib.compress(b''.join((LENGTH.pack(len(metaBytes)), metaBytes, LENGTH.pack(len(noteBytes)), noteBytes, content.encode('utf-8'))))
+    return HEADER.pack(MAGIC, flags, created, len(payload), zlib.crc32(payload)) + payload
+
+def decodePayload(payload):
+    """@return tuple of (meta dict, Thrift Note, content str)."""
+    raw = zlib.decompress(payload)
+    metaLength = LENGTH.unpack_from(raw, 0)[0]
+    start = LENGTH.size
+    meta = simplejson.loads(raw[start:start + metaLength].decode('utf-8'))
+    start += metaLength
+    noteLength = LENGTH.unpack_from(raw, start)[0]
+    start += LENGTH.size
+    note = pickle.loads(raw[start:start + noteLength])
+    return meta, note, raw[start + noteLength:].decode('utf-8')
+
+def segmentName(number):
+    return 'segment-{0:06d}.dat'.format(number)
+
+def segmentNumber(path):
+    return int(os.path.basename(path)[len('segment-'):-len('.dat')])
+
+def apiJson(meta, content):
+    """@return str The legacy `<created>.json' data file for a stored note, byte for byte."""
+    data = dict(meta)
+    data['b64Content'] = base64.b64encode(content.encode('utf-8')).decode('ascii')
+    return simplejson.dumps(data)
+
+class SegmentStore(object):
+    """
+    Notes stored once each in append-only segment files.  Only one process
+    should write at a time (collect, watch); any number may read.
+    """
+
+    def __init__(self, root=None):
+        self.root = root or '{0}/{1}'.format(settings.DATA_PATH, SEGMENTS_DIRNAME)
+        self.pid = os.getpid()
+        if not os.path.exists(self.root):
+            os.makedirs(self.root, exist_ok=True)
+        # Used from the collector's notebook threads, which serialize access themselves.
+        self.conn = sqlite3.connect('{0}/{1}'.format(self.root, OFFSETS_FILENAME), check_same_thread=False)
+        self.conn.execute(SCHEMA)
+        # segment number -> (mmap, file object), opened on first read.
+        self.maps = {}
+        self.appendFh = None
+        self.appendSegment = None
+
+    def segmentPath(self, number):
+        return '{0}/{1}'.format(self.root, segmentName(number))
+
+    def segmentNumbers(self):
+        return sorted(segmentNumber(path) for path in glob.iglob('{0}/segment-*.dat'.format(self.root)))
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Group writes: on success, appended records are flushed to disk before
+        their offsets are committed.
+        """
+        try:
+            yield self
+        except BaseException:
+            self.conn.rollback()
+            raise
+        self.flush()
+        self.conn.commit()
+
+    def flush(self):
+        if self.appendFh is not None:
+            self.appendFh.flush()
+            os.fsync(self.appendFh.fileno())
+
+    def closeFiles(self):
+        self.flush()
+        if self.appendFh is not None:
+            self.appendFh.close()
+            self.appendFh = None
+        for mapped, fh in self.maps.values():
+            mapped.close()
+            fh.close()
+        self.maps = {}
+
+    def close(self):
+        self.closeFiles()
+        self.conn.close()
+
+    def appendTarget(self, numBytes):
+        """@return (segment number, file object) to append numBytes to, rolling over to a new segment when full."""
+        if self.appendFh is None:
+            numbers = self.segmentNumbers()
+            self.appendSegment = numbers[-1] if numbers else 1
+            self.appendFh = open(self.segmentPath(self.appendSegment), 'ab')
+        if self.appendFh.tell() > 0 and self.appendFh.tell() + numBytes > SEGMENT_SIZE:
+            self.flush()
+            self.appendFh.close()
+            self.appendSegment += 1
+            self.appendFh = open(self.segmentPath(self.appendSegment), 'ab')
+        return self.appendSegment, self.appendFh
+
+    def append(self, record):
+        segment, fh = self.appendTarget(len(record))
+        offset = fh.tell()
+        fh.write(record)
+        return segment, offset
+
+    def put(self, created, meta, note, content):
+        """
+        Store a note.
+
+        @param meta dict The note's data (see Collector.storeNote) without its content.
+        @param note Thrift Note; its content and resource bodies are not stored.
+        @param content str ENML content.
+        """
+        record = encodeRecord(created, meta, note, content)
+        segment, offset = self.append(record)
+        self.conn.execute('INSERT OR REPLACE INTO offsets (created, segment, offset, length) VALUES (?, ?, ?, ?)', (created, segment, offset, len(record)))
+
+    def remove(self, created):
+        if not self.has(created):
+            return
+        self.append(encodeRecord(created, None, None, None, flags=FLAG_TOMBSTONE))
+        self.conn.execute('DELETE FROM offsets WHERE created = ?', (created,))
+
+    def has(self, created):
+        return self.conn.execute('SELECT 1 FROM offsets WHERE created = ?', (created,)).fetchone() is not None
+
+    def createds(self):
+        return [row[0] for row in self.conn.execute('SELECT created FROM offsets ORDER BY created DESC')]
+
+    def mapped(self, segment, end):
+        """@return mmap of a segment covering at least `end' bytes."""
+        if segment in self.maps and len(self.maps[segment][0]) < end:
+            # The segment has grown since it was mapped.
+            mapped, fh = self.maps.pop(segment)
+            mapped.close()
+            fh.close()
+        if segment not in self.maps:
+            fh = open(self.segmentPath(segment), 'rb')
+            self.maps[segment] = (mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ), fh)
+        return self.maps[segment][0]
+
+    def get(self, created):
+        """@return tuple of (meta dict, Thrift Note, content str), or None when the note isn't stored."""
+        row = self.conn.execute('SELECT segment, offset, length FROM offsets WHERE created = ?', (created,)).fetchone()
+        if row is None:
+            return None
+        segment, offset, length = row
+        mapped = self.mapped(segment, offset + length)
+        magic, flags, recordCreated, payloadLength, crc = HEADER.unpack_from(mapped, offset)
+        payload = mapped[offset + HEADER.size:offset + HEADER.size + payloadLength]
+        if hasattr(mapped, 'madvise'):
+            # The record has been copied out, so let its pages (and those the
+            # kernel mapped in around them) go rather than count against this
+            # process's RSS for the rest of a build.
+            start = offset - offset % FAULT_AROUND_BYTES
+            end = min(offset + length + FAULT_AROUND_BYTES - (offset + length) % FAULT_AROUND_BYTES, len(mapped))
+            mapped.madvise(mmap.MADV_DONTNEED, start, end - start)
+        if magic != MAGIC or recordCreated != created or zlib.crc32(payload) != crc:
+            raise CorruptRecord('corrupt record for note {0} at {1}:{2}'.format(created, segmentName(segment), offset))
+        return decodePayload(payload)
+
+    def scan(self, segment):
+        """@return iterator of (offset, length, flags, created) over the intact records of a segment."""
+        size = os.path.getsize(self.segmentPath(segment))
+        if size == 0:
+            return
+        data = self.mapped(segment, size)
+        offset = 0
+        while offset + HEADER.size <= len(data):
+            magic, flags, created, payloadLength, crc = HEADER.unpack_from(data, offset)
+            end = offset + HEADER.size + payloadLength
+            if magic != MAGIC or end > len(data) or zlib.crc32(data[offset + HEADER.size:end]) != crc:
+                logger.warn('%s: ignoring unreadable data from offset %s on', segmentName(segment), offset)
+                return
+            yield offset, end - offset, flags, created
+            offset = end
+
+    def rebuildOffsets(self):
+        """Recreate the offset index by replaying every segment in order."""
+        with self.conn:
+            self.conn.execute('DELETE FROM offsets')
+            for segment in self.segmentNumbers():
+                for offset, length, flags, created in self.scan(segment):
+                    if flags & FLAG_TOMBSTONE:
+                        self.conn.execute('DELETE FROM offsets WHERE created = ?', (created,))
+                    else:
+                        self.conn.execute('INSERT OR REPLACE INTO offsets (created, segment, offset, length) VALUES (?, ?, ?, ?)', (created, segment, offset, length))
+        logger.info('indexed %s stored notes', len(self.createds()))
+
+    def compact(self):
+        """
+        Copy the live records into fresh segments and delete the old ones,
+        reclaiming space left by rewritten and removed notes.  Nothing else
+        may be reading or writing the store meanwhile.
+        """
+        old = self.segmentNumbers()
+        if not old:
+            return
+        before = sum(os.path.getsize(self.segmentPath(number)) for number in old)
+        self.closeFiles()
+        self.appendSegment = old[-1] + 1
+        self.appendFh = open(self.segmentPath(self.appendSegment), 'ab')
+        with self.transaction():
+            for created, segment, offset, length in self.conn.execute('SELECT created, segment, offset, length FROM offsets ORDER BY created').fetchall():
+                record = self.mapped(segment, offset + length)[offset:offset + length]
+                newSegment, newOffset = self.append(record)
+                self.conn.execute('UPDATE offsets SET segment = ?, offset = ? WHERE created = ?', (newSegment, newOffset, created))
+        self.closeFiles()
+        for number in old:
+            os.remove(self.segmentPath(number))
+        after = sum(os.path.getsize(self.segmentPath(number)) for number in self.segmentNumbers())
+        logger.info('compacted note segments from %.1f MiB to %.1f MiB', before / 1048576.0, after / 1048576.0)
+
+    def migrateLegacy(self):
+        """
+        Move every legacy `<created>.json' + `<created>.pickle' pair into the
+        store (resource bodies into the ResourceStore), removing the files.
+        """
+        resourceStore = ResourceStore()
+        migrated = []
+        with self.transaction():
+            for jsonPath in sorted(glob.glob('{0}/[0-9]*.json'.format(settings.DATA_PATH))):
+                picklePath = jsonPath[0:-len('.json')] + '.pickle'
+                try:
+                    with open(jsonPath, 'r') as fh:
+                        data = simplejson.load(fh)
+                    with open(picklePath, 'rb') as fh:
+                        note = pickle.load(fh, encoding='latin1')
+                except Exception:
+                    logger.exception('skipping unreadable note data %s', jsonPath)
+                    continue
+                content = base64.b64decode(data['b64Content']).decode('utf-8')
+                data['b64Content'] = None
+                resourceStore.absorb(note)
+                note.content = None
+                self.put(data['created'], data, note, content)
+                migrated.append(data['created'])
+        # Only remove the legacy files once their records are safely on disk.
+        for created in migrated:
+            for path in ('{0}/{1}.json'.format(settings.DATA_PATH, created), '{0}/{1}.pickle'.format(settings.DATA_PATH, created)):
+                if os.path.exists(path):
+                    os.remove(path)
+        logger.info('migrated %s notes into %s', len(migrated), self.root)
+
+# Per-thread instances, see `getSegmentStore'.
+_local = threading.local()
+
+def getSegmentStore():
+    """
+    @return SegmentStore shared by the calling thread (a forked worker, or
+        another thread such as `lib.pipeline''s renderer, gets its own).
+    """
+    store = getattr(_local, 'store', None)
+    if store is None or store.pid != os.getpid():
+        store = _local.store = SegmentStore()
+    return store
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+"""Persistent cache of the account's tags, kept current by update sequence number."""
+
+import os
+import simplejson
+import threading
+
+from .logger import logger
+
+import settings
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+TAG_CACHE_FILENAME = '.tagCache.json'
+# Where older versions pickled the cache (relative to the working directory).
+LEGACY_TAG_CACHE_PATHS = ('data/.tagCache.pickle',)
+
+TAG_FIELDS = ('updateSequenceNum', 'guid', 'name', 'parentGuid')
+
+def tagToDict(tag):
+    """Convert a Tag object (or dict) to the dict representation stored with notes."""
+    if isinstance(tag, dict):
+        return dict((key, tag.get(key)) for key in TAG_FIELDS)
+    return dict((key, getattr(tag, key)) for key in TAG_FIELDS)
+
+class TagCache(object):
+    """
+    Tag dicts by guid, along with the account update count (USN) they are
+    known to be current as of.  Only `save' writes to disk, atomically, so
+    callers decide when to checkpoint.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or getattr(settings, 'TAG_CACHE_PATH', '{0}/{1}'.format(settings.DATA_PATH, TAG_CACHE_FILENAME))
+        self.lock = threading.Lock()
+        self.tags = {}
+        # Every tag change up to this account USN is reflected in `tags'.
+        self.updateCount = 0
+        # Server time of the last refresh, compared against the account's `fullSyncBefore'.
+        self.syncTime = 0
+        self.dirty = False
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as fh:
+                data = simplejson.load(fh)
+            self.tags = data['tags']
+            self.updateCount = data['updateCount']
+            self.syncTime = data.get('syncTime', 0)
+            logger.info('loaded %s cached tags (current as of usn=%s)', len(self.tags), self.updateCount)
+            return
+        except (IOError, OSError):
+            pass
+        except (simplejson.errors.JSONDecodeError, KeyError):
+            logger.exception('tag cache %s is corrupted, starting over', self.path)
+            return
+        self.loadLegacy()
+
+    def loadLegacy(self):
+        """Seed from an old pickled cache; with no USN recorded it gets fully refreshed on first use."""
+        for path in LEGACY_TAG_CACHE_PATHS + ('{0}/.tagCache.pickle'.format(settings.DATA_PATH),):
+            try:
+                with open(path, 'rb') as fh:
+                    tags = pickle.loads(fh.read(), encoding='latin1')
+            except Exception:
+                continue
+            self.tags = dict((guid, tagToDict(tag)) for guid, tag in tags.items())
+            self.dirty = True
+            logger.info('imported %s tags from legacy cache %s', len(self.tags), path)
+            return
+        logger.info('no pre-existing tag cache found')
+
+    def save(self):
+        """Atomically persist the cache, if anything changed since it was last loaded or saved."""
+        with self.lock:
+            if not self.dirty:
+                return
+            data = simplejson.dumps({'updateCount': self.updateCount, 'syncTime': self.syncTime, 'tags': self.tags})
+            self.dirty = False
+        tmpPath = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(tmpPath, 'w') as fh:
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmpPath, self.path)
+        logger.debug('saved %s tags to %s', len(self.tags), self.path)
+
+    def get(self, guid):
+        return self.tags.get(guid)
+
+    def missing(self, guids):
+        """@return set of the given guids which aren't cached."""
+        return set(guid for guid in guids if guid not in self.tags)
+
+    def update(self, tags):
+        """Cache Tag objects (or dicts), ignoring any older than what is already cached."""
+        with self.lock:
+            for tag in tags:
+                tag = tagToDict(tag)
+                cached = self.tags.get(tag['guid'])
+                if cached is not None and (cached['updateSequenceNum'] or 0) > (tag['updateSequenceNum'] or 0):
+                    continue
+                if cached != tag:
+                    self.tags[tag['guid']] = tag
+                    self.dirty = True
+
+    def remove(self, guids):
+        with self.lock:
+            for guid in guids:
+                if self.tags.pop(guid, None) is not None:
+                    self.dirty = True
+
+    def advance(self, updateCount, syncTime=None):
+        """Record that every tag change up to `updateCount' has been applied."""
+        with self.lock:
+            if updateCount > self.updateCount:
+                self.updateCount = updateCount
+                self.dirty = True
+            if syncTime is not None and syncTime > self.syncTime:
+                self.syncTime = syncTime
+                self.dirty = True
+
+    def isCurrent(self, syncState):
+        """@return True when no tag can have changed since the cache was last refreshed."""
+        return self.updateCount == syncState.updateCount and (syncState.fullSyncBefore or 0) <= self.syncTime
+
+    def needsFullRefresh(self, syncState):
+        """@return True when the cache can't be brought up to date incrementally."""
+        return self.updateCount == 0 or (syncState.fullSyncBefore or 0) > self.syncTime
+
+    def reset(self):
+        with self.lock:
+            self.tags = {}
+            self.updateCount = 0
+            self.syncTime = 0
+            self.dirty = True
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+"""Tag -> notes index shared by the tag pages and tag index pages."""
+
+import unidecode
+
+from .util import safeUnicode
+
+def normalizeTagName(name):
+    """@return str The lower-cased, ascii-folded name tag pages are published under."""
+    return unidecode.unidecode(safeUnicode(name.lower()))
+
+class Tag(object):
+    """A (normalized) tag name along with its notes, newest-created first."""
+
+    __slots__ = ('name', 'notes')
+
+    def __init__(self, name):
+        self.name = name
+        self.notes = []
+
+class TagIndex(object):
+    """
+    Groups notes by normalized tag name in a single pass, leaving the notes'
+    own tag dicts untouched, and precomputes every ordering the tag index
+    pages are published in.
+    """
+
+    def __init__(self, notes):
+        self.byName = {}
+        normalized = {}
+
+        for note in notes:
+            for tag in getattr(note, 'tags', ()):
+                name = normalized.get(tag['name'])
+                if name is None:
+                    name = normalized[tag['name']] = normalizeTagName(tag['name'])
+                if name not in self.byName:
+                    self.byName[name] = Tag(name)
+                self.byName[name].notes.append(note)
+
+        for tag in self.byName.values():
+            # Notes normally arrive newest-first already, making this a linear pass.
+            tag.notes.sort(key=lambda note: note.createdTs, reverse=True)
+
+        self.nameAsc = sorted(self.byName.values(), key=lambda tag: tag.name)
+        self.nameDesc = self.nameAsc[::-1]
+        # Stable sorts of the name-ascending list, so equally frequent tags stay in name order.
+        self.frequencyAsc = sorted(self.nameAsc, key=lambda tag: len(tag.notes))
+        self.frequencyDesc = sorted(self.nameAsc, key=lambda tag: len(tag.notes), reverse=True)
+
+    def __len__(self):
+        return len(self.byName)
+
+    def __iter__(self):
+        return iter(self.nameAsc)
+
+    def get(self, name):
+        """@return Tag or None"""
+        return self.byName.get(name)
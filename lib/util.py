@@ -7,6 +7,12 @@ EverNote WebClipper publisher.
 @date 2013-06-30
 """
 
+import re
+
+import unidecode
+
+import settings
+
 def fileGetContents(fileName, flags='r'):
     with open(fileName, flags) as fh:
         return fh.read()
@@ -19,3 +25,34 @@ def safeUnicode(obj, *args):
         # obj is byte string
         ascii_text = str(obj).encode('string_escape')
         return str(ascii_text)
+
+def buildStatePath(fileName):
+    """
+    Where a file of build state (manifest, output files, search postings)
+    lives: DATA_PATH, or BUILD_STATE_PATH while publishing a site of its own
+    for some notebooks (see `app.py generate --notebook').
+    """
+    return '{0}/{1}'.format(getattr(settings, 'BUILD_STATE_PATH', None) or settings.DATA_PATH, fileName)
+
+def matchNotebooks(notebooks, fragments, allMatches=False):
+    """
+    Pick notebooks by (case-insensitive) name fragment.
+
+    @param notebooks list of objects with `guid' and `name' attributes.
+    @param fragments list of str Notebook names or name fragments.
+    @param allMatches bool When True, every notebook matching a fragment is picked, otherwise just the first.
+    @return tuple of (list of picked notebooks, without duplicates, list of fragments nothing matched).
+    """
+    picked = []
+    unmatched = []
+    for fragment in fragments:
+        matches = [notebook for notebook in notebooks if fragment.lower() in notebook.name.lower()]
+        if not matches:
+            unmatched.append(fragment)
+        for notebook in matches if allMatches else matches[0:1]:
+            if notebook.guid not in [other.guid for other in picked]:
+                picked.append(notebook)
+    return picked, unmatched
+
+def slugify(name):
+    return re.sub(r'[^a-z0-9]+', '-', unidecode.unidecode(safeUnicode(name.lower()))).strip('-') or 'notebook'
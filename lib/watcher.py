@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+"""Long-running collect + generate loop, see `app.py watch'."""
+
+import os
+import random
+import signal
+import simplejson
+import threading
+import time
+
+from .logger import logger
+from .metrics import metrics
+
+import settings
+
+WATCH_INTERVAL = getattr(settings, 'WATCH_INTERVAL', 300)
+WATCH_MAX_INTERVAL = getattr(settings, 'WATCH_MAX_INTERVAL', 3600)
+STATUS_FILENAME = 'watch.status.json'
+
+class Watcher(object):
+    """
+    Keeps one Collector (NoteStore client, tag cache) and one HtmlGenerator
+    (compiled templates, output state) warm, polls the account's update
+    sequence number every `interval' seconds and incrementally regenerates
+    when anything changed.  Consecutive failures back off exponentially up to
+    `maxInterval'.
+
+    Progress is published to a JSON status file (WATCH_STATUS_PATH, default
+    DATA_PATH/watch.status.json) after every step.
+    """
+
+    def __init__(self, collector, generator, interval=None, maxInterval=None, jobs=1, statusPath=None):
+        self.collector = collector
+        self.generator = generator
+        self.interval = interval or WATCH_INTERVAL
+        self.maxInterval = max(maxInterval or WATCH_MAX_INTERVAL, self.interval)
+        self.jobs = jobs
+        self.statusPath = statusPath or getattr(settings, 'WATCH_STATUS_PATH', '{0}/{1}'.format(settings.DATA_PATH, STATUS_FILENAME))
+        self.stopping = threading.Event()
+        self.failures = 0
+        # Notes synced but not yet rendered (e.g. because generate failed).
+        self.pending = 0
+        self.status = {
+            'pid': os.getpid(),
+            'state': 'starting',
+            'startedAt': time.time(),
+            'lastPollAt': None,
+            'lastSyncAt': None,
+            'lastChangeAt': None,
+            'lastGenerateAt': None,
+            'lastError': None,
+            'consecutiveFailures': 0,
+            'nextPollAt': None,
+            'queueDepth': 0,
+            'polls': 0,
+            'generations': 0,
+        }
+
+    def installSignalHandlers(self):
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.handleSignal)
+
+    def handleSignal(self, signum, frame):
+        logger.info('received signal %s, shutting down after the current step', signum)
+        self.stopping.set()
+
+    def stop(self):
+        self.stopping.set()
+
+    def writeStatus(self, **changes):
+        self.status.update(changes)
+        self.status['queueDepth'] = self.pending
+        self.status['consecutiveFailures'] = self.failures
+        tmpPath = '{0}.tmp'.format(self.statusPath)
+        with open(tmpPath, 'w') as fh:
+            simplejson.dump(self.status, fh, indent=2)
+        os.replace(tmpPath, self.statusPath)
+
+    def nextDelay(self):
+        """@return float Seconds until the next poll, backing off (with jitter) while polls keep failing."""
+        if self.failures == 0:
+            return self.interval
+        delay = min(self.interval * (2 ** self.failures), self.maxInterval)
+        return delay * random.uniform(0.8, 1.0)
+
+    def poll(self):
+        """Sync once and regenerate if anything changed (or is still waiting to be rendered)."""
+        self.writeStatus(state='syncing', lastPollAt=time.time(), polls=self.status['polls'] + 1)
+        removedBefore = self.collector.numRemoved
+        numChanged = self.collector.sync() + self.collector.numRemoved - removedBefore
+        now = time.time()
+        self.pending += numChanged
+        self.writeStatus(lastSyncAt=now, lastChangeAt=now if numChanged else self.status['lastChangeAt'])
+
+        if self.pending == 0 or self.stopping.is_set():
+            return
+        logger.info('%s changed notes, regenerating', self.pending)
+        self.writeStatus(state='generating')
+        self.generator.generate(jobs=self.jobs)
+        self.pending = 0
+        self.writeStatus(lastGenerateAt=time.time(), generations=self.status['generations'] + 1)
+
+    def run(self):
+        """Poll until stopped, then persist caches and exit."""
+        logger.info('watching every %ss (backing off to at most %ss on errors), status in %s', self.interval, self.maxInterval, self.statusPath)
+        try:
+            while not self.stopping.is_set():
+                try:
+                    self.poll()
+                    self.failures = 0
+                    self.status['lastError'] = None
+                except Exception as e:
+                    self.failures += 1
+                    logger.exception('watch poll failed (%s consecutive failures)', self.failures)
+                    self.status['lastError'] = '{0}: {1}'.format(type(e).__name__, e)
+                # Cumulative since the watcher started, so the textfile stays fresh between polls.
+                metrics.emit('watch')
+                delay = self.nextDelay()
+                self.writeStatus(state='backoff' if self.failures else 'idle', nextPollAt=time.time() + delay)
+                self.stopping.wait(delay)
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        logger.info('watcher stopping, persisting caches')
+        try:
+            self.collector.saveTagCache()
+        finally:
+            self.writeStatus(state='stopped', nextPollAt=None)
@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+
+"""Atomic, skip-if-identical writer for everything under OUTPUT_PATH."""
+
+import gzip
+import hashlib
+import os
+import shutil
+import simplejson
+import time
+
+from .logger import logger
+from .metrics import metrics
+from .util import buildStatePath
+
+import settings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATE_FILENAME = '.outputFiles.json'
+
+# Emit `.gz' (and, when the brotli module is installed, `.br') siblings of
+# text outputs for servers to send as-is.
+PRECOMPRESS = getattr(settings, 'PRECOMPRESS', False)
+PRECOMPRESS_EXTENSIONS = ('.html', '.json', '.css', '.js', '.svg', '.txt', '.xml')
+
+def variantSuffixes():
+    return ('.gz', '.br') if brotli is not None else ('.gz',)
+
+def compressedVariants(data):
+    """@return list of (suffix, compressed bytes)."""
+    # mtime=0 keeps the gzip output, and therefore its skip-identical digest, stable.
+    variants = [('.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(data)))
+    return variants
+
+def md5Hex(data):
+    return hashlib.md5(data).hexdigest()
+
+def fileMd5Hex(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 20), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+class OutputWriter(object):
+    """
+    Every output file is written through here.  Writes whose content is
+    identical to what is already on disk are skipped (so mtimes survive for
+    `rsync --update' and CDN caching), real writes go to a temporary file
+    which is then renamed into place, and at the end of a build the created,
+    changed and removed paths are emitted as a change manifest.
+
+    Paths are relative to OUTPUT_PATH.  State from the previous build
+    (path -> [md5, owner]) lives in DATA_PATH (see `buildStatePath').
+    """
+
+    def __init__(self, root=None, precompress=None):
+        self.root = root or settings.OUTPUT_PATH
+        self.precompress = PRECOMPRESS if precompress is None else precompress
+        self.statePath = buildStatePath(STATE_FILENAME)
+        self.changesPath = getattr(settings, 'CHANGE_MANIFEST_PATH', buildStatePath('changes.json'))
+        self.previous = {}
+        self.previousByOwner = {}
+        self.current = {}
+        self.created = []
+        self.changed = []
+        self.unchanged = 0
+
+    def load(self):
+        try:
+            with open(self.statePath, 'r') as fh:
+                self.previous = simplejson.load(fh)
+        except (IOError, OSError):
+            logger.info('no pre-existing output state found')
+        except simplejson.errors.JSONDecodeError:
+            logger.exception('output state %s is corrupted, ignoring it', self.statePath)
+        self.setPrevious(self.previous)
+
+    def setPrevious(self, state):
+        self.previous = state
+        self.previousByOwner = {}
+        for relPath, (_, owner) in state.items():
+            if owner is not None:
+                self.previousByOwner.setdefault(owner, []).append(relPath)
+
+    def isCurrent(self, relPath, digest):
+        """@return True when relPath already exists on disk with the given md5."""
+        path = '{0}/{1}'.format(self.root, relPath)
+        if relPath in self.previous:
+            return self.previous[relPath][0] == digest and os.path.exists(path)
+        # Not written by a previous build (or state was lost), so check the disk.
+        return os.path.exists(path) and fileMd5Hex(path) == digest
+
+    def record(self, relPath, digest, owner, written):
+        self.current[relPath] = [digest, owner]
+        metrics.incr('files_written' if written else 'files_unchanged')
+        if not written:
+            self.unchanged += 1
+        elif relPath in self.previous:
+            self.changed.append(relPath)
+        else:
+            self.created.append(relPath)
+
+    def tmpPathFor(self, path):
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        return '{0}/.{1}.{2}.tmp'.format(directory, os.path.basename(path), os.getpid())
+
+    def write(self, relPath, data, owner=None):
+        """
+        Write bytes (or str, as utf-8) to relPath unless identical content is already there.
+
+        @return bool True if the file was actually written.
+        """
+        with metrics.timer('phase', phase='write'):
+            return self.writeWithVariants(relPath, data, owner)
+
+    def writeWithVariants(self, relPath, data, owner):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        compress = self.precompress and relPath.lower().endswith(PRECOMPRESS_EXTENSIONS)
+        digest = md5Hex(data)
+        if self.isCurrent(relPath, digest) and (not compress or self.keepVariants(relPath, owner)):
+            self.record(relPath, digest, owner, False)
+            return False
+        self.writeFile(relPath, data, digest, owner)
+        if compress:
+            for suffix, compressed in compressedVariants(data):
+                self.writeFile(relPath + suffix, compressed, md5Hex(compressed), owner)
+        return True
+
+    def writeFile(self, relPath, data, digest, owner):
+        if self.isCurrent(relPath, digest):
+            self.record(relPath, digest, owner, False)
+            return
+        path = '{0}/{1}'.format(self.root, relPath)
+        tmpPath = self.tmpPathFor(path)
+        with open(tmpPath, 'wb') as fh:
+            fh.write(data)
+        os.replace(tmpPath, path)
+        metrics.incr('bytes_written', len(data))
+        self.record(relPath, digest, owner, True)
+
+    def keepVariants(self, relPath, owner):
+        """
+        Carry forward the compressed siblings of an unchanged file.
+
+        @return bool False if any are missing and the file should be rewritten.
+        """
+        for suffix in variantSuffixes():
+            if relPath + suffix not in self.previous or not os.path.exists('{0}/{1}{2}'.format(self.root, relPath, suffix)):
+                return False
+        for suffix in variantSuffixes():
+            self.current[relPath + suffix] = [self.previous[relPath + suffix][0], owner]
+            self.unchanged += 1
+            metrics.incr('files_unchanged')
+        return True
+
+    def link(self, relPath, sourcePath, digest, owner=None):
+        """
+        Hard-link (or copy, across file systems) sourcePath, whose md5 is
+        `digest', to relPath unless identical content is already there.
+
+        @return bool True if the file was actually written.
+        """
+        if self.isCurrent(relPath, digest):
+            self.record(relPath, digest, owner, False)
+            return False
+        path = '{0}/{1}'.format(self.root, relPath)
+        with metrics.timer('phase', phase='write'):
+            tmpPath = self.tmpPathFor(path)
+            try:
+                os.link(sourcePath, tmpPath)
+            except OSError:
+                shutil.copyfile(sourcePath, tmpPath)
+            os.replace(tmpPath, path)
+        self.record(relPath, digest, owner, True)
+        return True
+
+    def exists(self, relPath):
+        """@return True when relPath, and any compressed siblings it should have, are on disk."""
+        paths = [relPath]
+        if self.precompress and relPath.lower().endswith(PRECOMPRESS_EXTENSIONS):
+            paths.extend(relPath + suffix for suffix in variantSuffixes())
+        return all(os.path.exists('{0}/{1}'.format(self.root, path)) for path in paths)
+
+    def keep(self, relPath):
+        """Carry forward a file (and any compressed siblings) the build decided not to regenerate."""
+        paths = [relPath] + ([relPath + suffix for suffix in variantSuffixes()] if self.precompress else [])
+        for path in paths:
+            if path in self.previous and path not in self.current:
+                self.current[path] = self.previous[path]
+
+    def keepOwned(self, owner):
+        """Carry forward every file written on behalf of `owner' (e.g. a note id) by the previous build."""
+        for relPath in self.previousByOwner.get(owner, []):
+            self.keep(relPath)
+
+    def drain(self):
+        """@return dict of what this writer did, for merging into another (e.g. from a worker process)."""
+        delta = {'current': self.current, 'created': self.created, 'changed': self.changed, 'unchanged': self.unchanged}
+        self.current, self.created, self.changed, self.unchanged = {}, [], [], 0
+        return delta
+
+    def merge(self, delta):
+        self.current.update(delta['current'])
+        self.created.extend(delta['created'])
+        self.changed.extend(delta['changed'])
+        self.unchanged += delta['unchanged']
+
+    def removeEmptyParents(self, relPath):
+        """Remove directories under root left empty by a removed file (e.g. an old page directory)."""
+        directory = os.path.dirname(relPath)
+        while directory:
+            try:
+                os.rmdir('{0}/{1}'.format(self.root, directory))
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+
+    def saveState(self, state=None):
+        """Atomically persist output state (defaults to the previous build's, e.g. after moving files around)."""
+        with open(self.statePath + '.tmp', 'w') as fh:
+            simplejson.dump(self.previous if state is None else state, fh)
+        os.replace(self.statePath + '.tmp', self.statePath)
+
+    def finish(self, removeStale=True):
+        """
+        Persist output state and emit the change manifest.
+
+        @param removeStale bool Delete files produced by the previous build but
+            not by (or carried forward into) this one.  Pass False for partial
+            builds, whose unknown files are instead carried forward.
+        """
+        removed = []
+        for relPath in self.previous:
+            if relPath in self.current:
+                continue
+            if not removeStale:
+                self.current[relPath] = self.previous[relPath]
+                continue
+            path = '{0}/{1}'.format(self.root, relPath)
+            if os.path.exists(path):
+                os.remove(path)
+                self.removeEmptyParents(relPath)
+            removed.append(relPath)
+
+        self.saveState(self.current)
+
+        changes = {
+            'generatedAt': int(time.time()),
+            'root': self.root,
+            'created': sorted(self.created),
+            'changed': sorted(self.changed),
+            'removed': sorted(removed),
+        }
+        with open(self.changesPath + '.tmp', 'w') as fh:
+            simplejson.dump(changes, fh, indent=2)
+        os.replace(self.changesPath + '.tmp', self.changesPath)
+
+        logger.info('output: %s created, %s changed, %s removed, %s identical writes skipped', len(self.created), len(self.changed), len(removed), self.unchanged)
+
+        self.setPrevious(self.current)
+        self.current, self.created, self.changed, self.unchanged = {}, [], [], 0
+        return changes
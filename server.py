@@ -1,25 +1,228 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+"""
+Static file server for the generated site.
+
+    ./server.py [port] [directory]
+
+Threaded HTTP/1.1 with keep-alive.  Serves the `.br'/`.gz' siblings the
+generator precompresses (see PRECOMPRESS in settings.py.example) according
+to Accept-Encoding, answers conditional requests with 304, honours single
+byte-range requests (e.g. seeking around a large PDF) and sends bodies with
+sendfile(2) where available.
+"""
+
+import email.utils
+import functools
+import http
 import http.server
-import http.server
+import os
 import sys
 
-def run(handlerClass=http.server.SimpleHTTPRequestHandler, protocol='HTTP/1.0'):
-    if sys.argv[1:]:
-        port = int(sys.argv[1])
-    else:
-        port = 8000
-    server_address = ('', port)
+# Preferred first.
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+REVALIDATE_TYPES = ('text/html', 'application/json')
+
+def acceptedEncodings(header):
+    """@return set of content-codings the client accepts (q=0 excluded)."""
+    accepted = set()
+    for part in (header or '').split(','):
+        fields = [field.strip() for field in part.split(';')]
+        if not fields[0]:
+            continue
+        q = 1.0
+        for field in fields[1:]:
+            if field.startswith('q='):
+                try:
+                    q = float(field[2:])
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            accepted.add(fields[0].lower())
+    return accepted
+
+def parseRange(header, size):
+    """
+    @return (start, end) inclusive byte offsets, None to ignore the header
+        (absent, malformed or multiple ranges), or False when unsatisfiable.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    first, _, last = header[6:].strip().partition('-')
+    try:
+        if not first:
+            length = int(last)
+            if length <= 0:
+                return False
+            return (max(0, size - length), size - 1)
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        return False
+    if start > end:
+        return None
+    return (start, min(end, size - 1))
+
+class StaticHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Don't let idle keep-alive connections pin a thread forever.
+    timeout = 30
+
+    def do_GET(self):
+        self.serve(sendBody=True)
+
+    def do_HEAD(self):
+        self.serve(sendBody=False)
+
+    def serve(self, sendBody):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            if not self.path.split('?', 1)[0].endswith('/') or not os.path.isfile(os.path.join(path, 'index.html')):
+                # Redirects and directory listings, as before.
+                fh = self.send_head()
+                if fh is not None:
+                    try:
+                        if sendBody:
+                            self.copyfile(fh, self.wfile)
+                    finally:
+                        fh.close()
+                return
+            path = os.path.join(path, 'index.html')
+
+        if not os.path.isfile(path):
+            self.send_error(http.HTTPStatus.NOT_FOUND, 'File not found')
+            return
+
+        contentType = self.guess_type(path)
+        servedPath, encoding, compressible = path, None, False
+        accepted = acceptedEncodings(self.headers.get('Accept-Encoding'))
+        for name, suffix in ENCODINGS:
+            if os.path.isfile(path + suffix):
+                compressible = True
+                if name in accepted and encoding is None:
+                    servedPath, encoding = path + suffix, name
 
-    handlerClass.protocol_version = protocol
-    httpd = http.server.HTTPServer(server_address, handlerClass)
+        try:
+            fh = open(servedPath, 'rb')
+        except OSError:
+            self.send_error(http.HTTPStatus.NOT_FOUND, 'File not found')
+            return
+
+        try:
+            stat = os.fstat(fh.fileno())
+            etag = '"{0:x}-{1:x}{2}"'.format(stat.st_mtime_ns, stat.st_size, '-' + encoding if encoding else '')
+            lastModified = email.utils.formatdate(int(stat.st_mtime), usegmt=True)
+
+            if self.notModified(etag, stat.st_mtime):
+                self.send_response(http.HTTPStatus.NOT_MODIFIED)
+                self.sendCommonHeaders(etag, lastModified, contentType, compressible)
+                self.end_headers()
+                return
+
+            start, end = 0, stat.st_size - 1
+            status = http.HTTPStatus.OK
+            byteRange = None if encoding else parseRange(self.headers.get('Range'), stat.st_size)
+            if byteRange is not None and not self.rangeApplies(etag, stat.st_mtime):
+                byteRange = None
+            if byteRange is False:
+                self.send_response(http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header('Content-Range', 'bytes */{0}'.format(stat.st_size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if byteRange is not None:
+                start, end = byteRange
+                status = http.HTTPStatus.PARTIAL_CONTENT
+
+            self.send_response(status)
+            self.sendCommonHeaders(etag, lastModified, contentType, compressible)
+            if encoding:
+                self.send_header('Content-Encoding', encoding)
+            if status == http.HTTPStatus.PARTIAL_CONTENT:
+                self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(start, end, stat.st_size))
+            self.send_header('Content-Length', str(end - start + 1))
+            self.end_headers()
+
+            if sendBody:
+                self.sendBody(fh, start, end - start + 1)
+        finally:
+            fh.close()
+
+    def sendCommonHeaders(self, etag, lastModified, contentType, compressible):
+        self.send_header('Content-Type', contentType)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', lastModified)
+        self.send_header('Accept-Ranges', 'bytes')
+        if contentType.split(';')[0] in REVALIDATE_TYPES:
+            self.send_header('Cache-Control', 'no-cache')
+        else:
+            self.send_header('Cache-Control', 'public, max-age=3600')
+        if compressible:
+            self.send_header('Vary', 'Accept-Encoding')
+
+    def notModified(self, etag, mtime):
+        ifNoneMatch = self.headers.get('If-None-Match')
+        if ifNoneMatch is not None:
+            tags = [tag.strip() for tag in ifNoneMatch.split(',')]
+            return '*' in tags or etag in tags or 'W/' + etag in tags
+        return self.notModifiedSince(self.headers.get('If-Modified-Since'), mtime)
+
+    @staticmethod
+    def notModifiedSince(header, mtime):
+        if not header:
+            return False
+        try:
+            since = email.utils.parsedate_to_datetime(header)
+        except (TypeError, ValueError, IndexError):
+            return False
+        if since is None:
+            return False
+        return int(mtime) <= since.timestamp()
+
+    def rangeApplies(self, etag, mtime):
+        """If-Range: only honour Range when the client's copy is still current."""
+        ifRange = self.headers.get('If-Range')
+        if not ifRange:
+            return True
+        if ifRange.startswith('"') or ifRange.startswith('W/'):
+            return ifRange == etag
+        return self.notModifiedSince(ifRange, mtime)
+
+    def sendBody(self, fh, offset, count):
+        """
+        Zero-copy via sendfile(2) where available, otherwise copied.  The
+        socket has a timeout (so is non-blocking underneath), which
+        `socket.sendfile' copes with by waiting for a slow client to drain
+        it rather than failing with EAGAIN.
+        """
+        try:
+            self.connection.sendfile(fh, offset, count)
+        except OSError:
+            # e.g. the client hung up part way through.
+            self.close_connection = True
+            raise
+
+def run(port=8000, directory=None):
+    handlerClass = functools.partial(StaticHandler, directory=directory or os.getcwd())
+    httpd = http.server.ThreadingHTTPServer(('', port), handlerClass)
+    httpd.daemon_threads = True
 
     sa = httpd.socket.getsockname()
     print("Serving HTTP on", sa[0], "port", sa[1], "...")
-    httpd.serve_forever()
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
 
 
 if __name__ == '__main__':
-    run()
-
+    run(
+        port=int(sys.argv[1]) if sys.argv[1:] else 8000,
+        directory=sys.argv[2] if sys.argv[2:] else None,
+    )
@@ -0,0 +1,5 @@
+consumerKey=''
+consumerSecret=''
+developerToken=''
+DATA_PATH = '/tmp/smoke/data'
+OUTPUT_PATH = '/tmp/smoke/out'